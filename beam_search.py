@@ -19,18 +19,22 @@ from torch.autograd import Variable
 
 import pykp
 from pykp.eric_layers import GetMask
+from pykp.ensemble import EnsembleModel
 import numpy as np
 import collections
 import itertools
 import logging
 
+from nltk.stem.porter import PorterStemmer
 from torch.distributions import Categorical
 
+stemmer = PorterStemmer()
+
 
 class Sequence(object):
     """Represents a complete or partial sequence."""
 
-    def __init__(self, batch_id, sentence, dec_hidden, context, ctx_mask, src_oov, oov_list, logprobs, score, attention=None):
+    def __init__(self, batch_id, sentence, dec_hidden, context, ctx_mask, src_oov, oov_list, logprobs, score, attention=None, stems=()):
         """Initializes the Sequence.
 
         Args:
@@ -39,6 +43,7 @@ class Sequence(object):
           dec_hidden: Model state after generating the previous word.
           logprobs:  The log-probabilitu of each word in the sequence.
           score:    Score of the sequence (log-probability)
+          stems:    Stemmed words of the sequence (without EOS), only for duplicate-aware beam search.
         """
         self.batch_id = batch_id
         self.sentence = sentence
@@ -51,6 +56,9 @@ class Sequence(object):
         self.logprobs = logprobs
         self.score = score
         self.attention = attention
+        # (step, row) of the attention weights in the buffer of beam search, the attention is gathered only for the final results
+        self.attention_pointer = None
+        self.stems = stems
 
     '''
     def __cmp__(self, other):
@@ -128,9 +136,14 @@ class SequenceGenerator(object):
                  eos_id=None,
                  beam_size=3,
                  max_sequence_length=5,
-                 return_attention=True,
+                 return_attention=False,
                  length_normalization_factor=0.0,
                  length_normalization_const=5.,
+                 shortlist=None,
+                 quantize=False,
+                 n_best=0,
+                 dedup=False,
+                 block_ngram=0
                  ):
         """Initializes the generator.
 
@@ -139,13 +152,27 @@ class SequenceGenerator(object):
           eos_id: the token number symobling the end of sequence
           beam_size: Beam size to use when generating sequences.
           max_sequence_length: The maximum sequence length before stopping the search.
+          return_attention: if True, the attention weights of each step are returned in Sequence.attention (for visualization).
           length_normalization_factor: If != 0, a number x such that sequences are
             scored by logprob/length^x, rather than logprob. This changes the
             relative scores of sequences depending on their lengths. For example, if
             x > 0 then longer sequences will be favored.
             alpha in: https://arxiv.org/abs/1609.08144
           length_normalization_const: 5 in https://arxiv.org/abs/1609.08144
+          shortlist: optional list of word ids (e.g. frequent keyphrase words mined from training targets).
+            If given, beam search only computes logits over the shortlist plus the source words of each batch.
+          quantize: run with an int8 dynamic quantized copy of model on CPU, only for inference (not for sample()).
+          n_best: if > 0, beam search returns at most n_best complete sequences for each document, and stops searching a document
+            once none of its partial sequences can beat the n_best complete ones. 0 keeps all the complete sequences.
+          dedup: if True, hypotheses are compared by their stemmed words (as in evaluation). Only the best one of the stem-equivalent
+            hypotheses is kept in the beam, and the complete ones duplicating an emitted phrase of the document are dropped,
+            thus the beam is spent on unique phrases.
+          block_ngram: if > 0, hypotheses repeating a (stemmed) n-gram of this size are dropped, 1 means no repeated words.
         """
+        if quantize:
+            logging.info('Beam search with an int8 dynamic quantized model on CPU')
+            from pykp.model import quantize_model
+            model = quantize_model(model)
         self.model = model
         self.eos_id = eos_id
         self.beam_size = beam_size
@@ -153,7 +180,109 @@ class SequenceGenerator(object):
         self.length_normalization_factor = length_normalization_factor
         self.length_normalization_const = length_normalization_const
         self.return_attention = return_attention
+        self.n_best = n_best
+        self.dedup = dedup
+        self.block_ngram = block_ngram
+        self.word2id = None
+        self.id2word = None
+        self.stem_cache = {}
         self.get_mask = GetMask()
+        self.shortlist = torch.LongTensor(sorted(set(shortlist))) if shortlist is not None else None
+        if self.shortlist is not None:
+            logging.info('Beam search with a shortlist of %d words' % len(self.shortlist))
+
+    def build_candidates(self, src_input, word2id):
+        '''
+        The candidate vocab of a batch in shortlist mode: the shortlist, words in the sources and the special tokens
+        :param src_input: (batch_size, src_len), oov words have been replaced with <unk>
+        :return: sorted unique word ids (num_candidates)
+        '''
+        special_ids = torch.LongTensor([word2id[w] for w in [pykp.io.BOS_WORD, pykp.io.EOS_WORD, pykp.io.UNK_WORD]])
+        if src_input.is_cuda:
+            special_ids = special_ids.cuda()
+            if not self.shortlist.is_cuda:
+                self.shortlist = self.shortlist.cuda()
+        candidate_ids = torch.cat([self.shortlist, src_input.contiguous().view(-1), special_ids])
+        candidate_ids = candidate_ids[candidate_ids < self.model.vocab_size]
+        return torch.unique(candidate_ids, sorted=True)
+
+    def score_upper_bound(self, partial_seq):
+        '''
+        The best score that any completion of a partial sequence can get. The log-probability only decreases as words are appended,
+            and the length penalty of a complete sequence is at most the one of max_sequence_length
+        '''
+        if self.length_normalization_factor > 0:
+            L = self.length_normalization_const
+            length_penalty = (L + self.max_sequence_length) / (L + 1)
+            return partial_seq.score / length_penalty ** self.length_normalization_factor
+        return partial_seq.score
+
+    def prune_partial_sequences(self, partial_sequences, complete_sequences):
+        '''
+        Score-bound pruning: once the complete sequences of a document fill the n-best, drop the partial sequences that can not beat the worst of them.
+            The document is finished (dropped from the batch) when no partial sequence is left
+        :return: the TopN_heap of remaining partial sequences
+        '''
+        if not self.n_best or len(complete_sequences) < self.n_best:
+            return partial_sequences
+        worst_complete_score = min([seq.score for seq in complete_sequences.extract()])
+        remaining_sequences = TopN_heap(self.beam_size)
+        for seq in partial_sequences.extract():
+            if self.score_upper_bound(seq) > worst_complete_score:
+                remaining_sequences.push(seq)
+        return remaining_sequences
+
+    def stem_word(self, word_id, oov_list):
+        word = self.id2word[word_id] if word_id < self.model.vocab_size else oov_list[word_id - self.model.vocab_size]
+        if word not in self.stem_cache:
+            self.stem_cache[word] = stemmer.stem(word.strip().lower())
+        return self.stem_cache[word]
+
+    def repeats_ngram(self, stems):
+        '''
+        Whether the last n-gram (n=block_ngram) of the stemmed words has appeared before in them
+        '''
+        n = self.block_ngram
+        last_ngram = stems[-n:]
+        return any([stems[i: i + n] == last_ngram for i in range(len(stems) - n)])
+
+    def push_sequences(self, new_sequences, heap, emitted_phrases=None):
+        '''
+        Push the new hypotheses of a document into heap. In dedup mode, only the best one of the hypotheses with the same stemmed words is pushed,
+            and the ones in emitted_phrases (stemmed phrases of complete sequences) are ignored.
+        Stem-equivalent phrases always have the same length, thus they are generated in the same step and only compared with each other here.
+        :return: heap
+        '''
+        if not self.dedup:
+            for seq in new_sequences:
+                heap.push(seq)
+            return heap
+
+        seen_phrases = emitted_phrases if emitted_phrases is not None else set()
+        for seq in sorted(new_sequences, key=lambda seq: float(seq.score), reverse=True):
+            if seq.stems in seen_phrases:
+                continue
+            seen_phrases.add(seq.stems)
+            heap.push(seq)
+        return heap
+
+    def gather_attention(self, seq, attention_buffers, back_pointers):
+        '''
+        Follow the back-pointers of seq to collect its attention weights in the buffers of beam search
+        :param attention_buffers: a list of (max_sequence_length, batch_size * beam_size, src_len), one for attention and one more for copy attention
+        :param back_pointers: (max_sequence_length, batch_size * beam_size), the row of the parent hypothesis in the previous step, -1 for <BOS>
+        :return: a list of (src_len) tensors, or a list of (attn, copy_attn) tuples if it's copy model
+        '''
+        attention = []
+        if seq.attention_pointer is None:
+            return attention
+        step, row = seq.attention_pointer
+        while step >= 0 and row >= 0:
+            weights = tuple([buffer[step, row] for buffer in attention_buffers])
+            attention.append(weights if len(weights) > 1 else weights[0])
+            row = int(back_pointers[step, row])
+            step -= 1
+        return attention[::-1]
 
     def sequence_to_batch(self, sequence_lists):
         '''
@@ -180,9 +309,7 @@ class SequenceGenerator(object):
 
         # (batch_size, trg_hidden_dim)
         if isinstance(flattened_sequences[0].dec_hidden, tuple):
-            h_states = torch.cat([seq.dec_hidden[0] for seq in flattened_sequences]).view(1, batch_size, -1)
-            c_states = torch.cat([seq.dec_hidden[1] for seq in flattened_sequences]).view(1, batch_size, -1)
-            dec_hiddens = (h_states, c_states)
+            dec_hiddens = tuple([torch.cat([seq.dec_hidden[j] for seq in flattened_sequences]).view(1, batch_size, -1) for j in range(len(flattened_sequences[0].dec_hidden))])
         else:
             dec_hiddens = torch.cat([seq.state for seq in flattened_sequences])
 
@@ -194,7 +321,7 @@ class SequenceGenerator(object):
         if torch.cuda.is_available():
             inputs = inputs.cuda()
             if isinstance(flattened_sequences[0].dec_hidden, tuple):
-                dec_hiddens = (dec_hiddens[0].cuda(), dec_hiddens[1].cuda())
+                dec_hiddens = tuple([state.cuda() for state in dec_hiddens])
             else:
                 dec_hiddens = dec_hiddens.cuda()
             contexts = contexts.cuda()
@@ -203,6 +330,7 @@ class SequenceGenerator(object):
 
         return seq_id2batch_id, flattened_id_map, inputs, dec_hiddens, contexts, ctx_mask, src_oovs, oov_lists
 
+    @torch.no_grad()
     def beam_search(self, src_input, src_len, src_oov, oov_list, word2id):
         """Runs beam search sequence generation given input (padded word indexes)
 
@@ -211,9 +339,17 @@ class SequenceGenerator(object):
                          list of batch size holding the first input for every entry.
         Returns:
           A list of batch size, each the most likely sequence from the possible beam_size candidates.
+          If return_attention, the attention weights are kept in preallocated buffers with back-pointers during searching,
+            and only gathered for the returned sequences.
+          If n_best > 0, each document is searched until its n_best complete sequences can not be beaten by its partial sequences,
+            thus the later steps run on the unfinished documents only.
+          No gradient is recorded in beam search, so the model can reuse its inference buffers across steps.
         """
         self.model.eval()
         batch_size = len(src_input)
+        if (self.dedup or self.block_ngram > 0) and self.word2id is not word2id:
+            self.word2id = word2id
+            self.id2word = dict([(word_id, word) for word, word_id in word2id.items()])
 
         src_mask = self.get_mask(src_input)  # same size as input_src
         src_context, (src_h, src_c) = self.model.encode(src_input, src_len)
@@ -221,16 +357,25 @@ class SequenceGenerator(object):
         # prepare the init hidden vector, (batch_size, trg_seq_len, dec_hidden_dim)
         dec_hiddens = self.model.init_decoder_state(src_h, src_c)
 
+        # shortlist mode, the src_oov is mapped to the positions in candidates for merging copy probs
+        candidate_ids = None
+        if self.shortlist is not None:
+            candidate_ids = self.build_candidates(src_input, word2id)
+            src_oov = self.model.ids_to_candidates(src_oov, candidate_ids)
+
         # each dec_hidden is (trg_seq_len, dec_hidden_dim)
         initial_input = [word2id[pykp.io.BOS_WORD]] * batch_size
         if isinstance(dec_hiddens, tuple):
-            dec_hiddens = (dec_hiddens[0].squeeze(0), dec_hiddens[1].squeeze(0))
-            dec_hiddens = [(dec_hiddens[0][i], dec_hiddens[1][i]) for i in range(batch_size)]
+            # (h, c), plus (h_tilde, copy_h_tilde) if input-feeding
+            dec_hiddens = tuple([state.squeeze(0) for state in dec_hiddens])
+            dec_hiddens = [tuple([state[i] for state in dec_hiddens]) for i in range(batch_size)]
         elif isinstance(dec_hiddens, list):
             dec_hiddens = dec_hiddens
 
         partial_sequences = [TopN_heap(self.beam_size) for _ in range(batch_size)]
-        complete_sequences = [TopN_heap(sys.maxsize) for _ in range(batch_size)]
+        complete_sequences = [TopN_heap(self.n_best if self.n_best else sys.maxsize) for _ in range(batch_size)]
+        # stemmed phrases of the complete sequences of each document, for dedup mode
+        emitted_phrases = [set() for _ in range(batch_size)]
 
         for batch_i in range(batch_size):
             seq = Sequence(
@@ -243,9 +388,15 @@ class SequenceGenerator(object):
                 oov_list=oov_list[batch_i],
                 logprobs=[],
                 score=0.0,
-                attention=[])
+                attention=None)
             partial_sequences[batch_i].push(seq)
 
+        # the attention weights of all the hypotheses in each step, (max_sequence_length, batch_size * beam_size, src_len),
+        #   allocated at the first step (one more buffer for copy attention)
+        attention_buffers, back_pointers = None, None
+        if self.return_attention:
+            back_pointers = torch.LongTensor(self.max_sequence_length, batch_size * self.beam_size).fill_(-1)
+
         '''
         Run beam search.
         '''
@@ -260,7 +411,7 @@ class SequenceGenerator(object):
             seq_id2batch_id, flattened_id_map, inputs, dec_hiddens, contexts, ctx_mask, src_oovs, oov_lists = self.sequence_to_batch(partial_sequences)
 
             # Run one-step generation. probs=(batch_size, 1, K), dec_hidden=tuple of (1, batch_size, trg_hidden_dim)
-            log_probs, new_dec_hiddens, attn_weights = self.model.generate(
+            outputs = self.model.generate(
                 trg_input=inputs,
                 dec_hidden=dec_hiddens,
                 enc_context=contexts,
@@ -269,40 +420,52 @@ class SequenceGenerator(object):
                 oov_list=oov_lists,
                 # k           =self.beam_size+1,
                 max_len=1,
-                return_attention=self.return_attention
+                return_attention=self.return_attention,
+                vocab_ids=candidate_ids
             )
+            log_probs, new_dec_hiddens = outputs[:2]
 
             # squeeze these outputs, (hyp_seq_size, trg_len=1, K+1) -> (hyp_seq_size, K+1)
             probs, words = log_probs.data.topk(self.beam_size + 1, dim=-1)
+            if candidate_ids is not None:
+                # map the positions in candidates back to word ids
+                words = self.model.candidates_to_ids(words, candidate_ids)
             words = words.squeeze(1)
             probs = probs.squeeze(1)
-            # (hyp_seq_size, trg_len=1, src_len) -> (hyp_seq_size, src_len)
-            if isinstance(attn_weights, tuple):  # if it's (attn, copy_attn)
-                attn_weights = (attn_weights[0].squeeze(1), attn_weights[1].squeeze(1))
-            else:
-                attn_weights = attn_weights.squeeze(1)
+            if self.return_attention:
+                # write the attention of this step into buffers, (hyp_seq_size, trg_len=1, src_len) -> (hyp_seq_size, src_len)
+                attn_weights = outputs[2] if isinstance(outputs[2], tuple) else (outputs[2],)
+                if attention_buffers is None:
+                    attention_buffers = [weights.new_zeros(self.max_sequence_length, batch_size * self.beam_size, weights.size(2)) for weights in attn_weights]
+                for buffer, weights in zip(attention_buffers, attn_weights):
+                    buffer[current_len - 1, :num_partial_sequences] = weights.squeeze(1)
 
             # tuple of (num_layers * num_directions, batch_size, trg_hidden_dim)=(1, hyp_seq_size, trg_hidden_dim), squeeze the first dim
             if isinstance(new_dec_hiddens, tuple):
-                new_dec_hiddens1 = new_dec_hiddens[0].squeeze(0)
-                new_dec_hiddens2 = new_dec_hiddens[1].squeeze(0)
-                new_dec_hiddens = [(new_dec_hiddens1[i], new_dec_hiddens2[i]) for i in range(num_partial_sequences)]
+                new_dec_hiddens = tuple([state.squeeze(0) for state in new_dec_hiddens])
+                new_dec_hiddens = [tuple([state[i] for state in new_dec_hiddens]) for i in range(num_partial_sequences)]
 
             # For every partial_sequence (num_partial_sequences in total), find and trim to the best hypotheses (beam_size in total)
             for batch_i in range(batch_size):
                 num_new_hyp_in_batch = 0
-                new_partial_sequences = TopN_heap(self.beam_size)
+                new_partial_sequences = []
+                new_complete_sequences = []
 
                 for partial_id, partial_seq in enumerate(partial_sequences[batch_i].extract()):
                     num_new_hyp = 0
                     flattened_seq_id = flattened_id_map[batch_i][partial_id]
+                    if self.return_attention and partial_seq.attention_pointer is not None:
+                        back_pointers[current_len - 1, flattened_seq_id] = partial_seq.attention_pointer[1]
 
                     # check each new beam and decide to add to hypotheses or completed list
                     for beam_i in range(self.beam_size + 1):
                         w = int(words[flattened_seq_id][beam_i])
-                        # if w has appeared before, ignore current hypothese
-                        # if w in partial_seq.vocab:
-                        #     continue
+                        # if a (stemmed) n-gram has appeared before, ignore current hypothese
+                        new_stems = partial_seq.stems
+                        if (self.dedup or self.block_ngram > 0) and w != self.eos_id:
+                            new_stems = partial_seq.stems + (self.stem_word(w, partial_seq.oov_list),)
+                            if self.block_ngram > 0 and self.repeats_ngram(new_stems):
+                                continue
 
                         # score=0 means this is the first word <BOS>, empty the sentence
                         if partial_seq.score != 0:
@@ -326,7 +489,8 @@ class SequenceGenerator(object):
                             oov_list=partial_seq.oov_list,
                             logprobs=copy.copy(partial_seq.logprobs),
                             score=copy.copy(partial_seq.score),
-                            attention=copy.copy(partial_seq.attention)
+                            attention=None,
+                            stems=new_stems
                         )
 
                         # we have generated self.beam_size new hypotheses for current hyp, stop generating
@@ -335,15 +499,7 @@ class SequenceGenerator(object):
 
                         # dec_hidden and attention of this partial_seq are shared by its descendant beams
                         new_partial_seq.dec_hidden = new_dec_hiddens[flattened_seq_id]
-
-                        if self.return_attention:
-                            if isinstance(attn_weights, tuple):  # if it's (attn, copy_attn)
-                                attn_weights = (attn_weights[0].squeeze(1), attn_weights[1].squeeze(1))
-                                new_partial_seq.attention.append((attn_weights[0][flattened_seq_id], attn_weights[1][flattened_seq_id]))
-                            else:
-                                new_partial_seq.attention.append(attn_weights[flattened_seq_id])
-                        else:
-                            new_partial_seq.attention = None
+                        new_partial_seq.attention_pointer = (current_len - 1, flattened_seq_id)
 
                         new_partial_seq.logprobs.append(probs[flattened_seq_id][beam_i])
                         new_partial_seq.score = new_partial_seq.score + probs[flattened_seq_id][beam_i]
@@ -354,13 +510,9 @@ class SequenceGenerator(object):
                                 L = self.length_normalization_const
                                 length_penalty = (L + len(new_partial_seq.sentence)) / (L + 1)
                                 new_partial_seq.score /= length_penalty ** self.length_normalization_factor
-                            complete_sequences[new_partial_seq.batch_id].push(new_partial_seq)
+                            new_complete_sequences.append(new_partial_seq)
                         else:
-                            # print('Before pushing[%d]' % new_partial_sequences.size())
-                            # print(sorted([s.score for s in new_partial_sequences._data]))
-                            new_partial_sequences.push(new_partial_seq)
-                            # print('After pushing[%d]' % new_partial_sequences.size())
-                            # print(sorted([s.score for s in new_partial_sequences._data]))
+                            new_partial_sequences.append(new_partial_seq)
                             num_new_hyp += 1
                             num_new_hyp_in_batch += 1
 
@@ -368,7 +520,9 @@ class SequenceGenerator(object):
                     # print('\t#(hypothese) = %d' % (len(new_partial_sequences)))
                     # print('\t#(completed) = %d' % (sum([len(c) for c in complete_sequences])))
 
-                partial_sequences[batch_i] = new_partial_sequences
+                self.push_sequences(new_complete_sequences, complete_sequences[batch_i], emitted_phrases[batch_i])
+                new_partial_sequences = self.push_sequences(new_partial_sequences, TopN_heap(self.beam_size))
+                partial_sequences[batch_i] = self.prune_partial_sequences(new_partial_sequences, complete_sequences[batch_i])
 
                 logging.debug('Batch=%d, \t#(hypothese) = %d, \t#(completed) = %d \t #(new_hyp_explored)=%d' % (batch_i, len(partial_sequences[batch_i]), len(complete_sequences[batch_i]), num_new_hyp_in_batch))
                 '''
@@ -382,7 +536,7 @@ class SequenceGenerator(object):
                 print('*' * 50)
                 '''
 
-            logging.debug('Round=%d, \t#(batch) = %d, \t#(hypothese) = %d, \t#(completed) = %d' % (current_len, batch_size, sum([len(batch_heap) for batch_heap in partial_sequences]), sum([len(batch_heap) for batch_heap in complete_sequences])))
+            logging.debug('Round=%d, \t#(batch) = %d, \t#(active) = %d, \t#(hypothese) = %d, \t#(completed) = %d' % (current_len, batch_size, sum([len(batch_heap) > 0 for batch_heap in partial_sequences]), sum([len(batch_heap) for batch_heap in partial_sequences]), sum([len(batch_heap) for batch_heap in complete_sequences])))
 
             # print('Round=%d' % (current_len))
             # print('\t#(hypothese) = %d' % (sum([len(batch_heap) for batch_heap in partial_sequences])))
@@ -403,6 +557,11 @@ class SequenceGenerator(object):
             if len(complete_sequences[batch_i]) == 0:
                 complete_sequences[batch_i] = partial_sequences[batch_i]
             complete_sequences[batch_i] = complete_sequences[batch_i].extract(sort=True)
+            if self.n_best:
+                complete_sequences[batch_i] = complete_sequences[batch_i][:self.n_best]
+            if self.return_attention:
+                for seq in complete_sequences[batch_i]:
+                    seq.attention = self.gather_attention(seq, attention_buffers, back_pointers)
 
         return complete_sequences
 
@@ -427,8 +586,9 @@ class SequenceGenerator(object):
         # each dec_hidden is (trg_seq_len, dec_hidden_dim)
         initial_input = [word2id[pykp.io.BOS_WORD]] * batch_size
         if isinstance(dec_hiddens, tuple):
-            dec_hiddens = (dec_hiddens[0].squeeze(0), dec_hiddens[1].squeeze(0))
-            dec_hiddens = [(dec_hiddens[0][i], dec_hiddens[1][i]) for i in range(batch_size)]
+            # (h, c), plus (h_tilde, copy_h_tilde) if input-feeding
+            dec_hiddens = tuple([state.squeeze(0) for state in dec_hiddens])
+            dec_hiddens = [tuple([state[i] for state in dec_hiddens]) for i in range(batch_size)]
         elif isinstance(dec_hiddens, list):
             dec_hiddens = dec_hiddens
 
@@ -456,7 +616,7 @@ class SequenceGenerator(object):
             seq_id2batch_id, flattened_id_map, inputs, dec_hiddens, contexts, ctx_mask, src_oovs, oov_lists = self.sequence_to_batch(sampled_sequences)
 
             # Run one-step generation. log_probs=(batch_size, 1, K), dec_hidden=tuple of (1, batch_size, trg_hidden_dim)
-            log_probs, new_dec_hiddens, attn_weights = self.model.generate(
+            outputs = self.model.generate(
                 trg_input=inputs,
                 dec_hidden=dec_hiddens,
                 enc_context=contexts,
@@ -466,6 +626,7 @@ class SequenceGenerator(object):
                 max_len=1,
                 return_attention=self.return_attention
             )
+            log_probs, new_dec_hiddens = outputs[:2]
 
             # squeeze these outputs, (hyp_seq_size, trg_len=1, K+1) -> (hyp_seq_size, K+1)
             log_probs = log_probs.view(num_partial_sequences, -1)
@@ -491,16 +652,17 @@ class SequenceGenerator(object):
                     words = words.data
 
             # (hyp_seq_size, trg_len=1, src_len) -> (hyp_seq_size, src_len)
-            if isinstance(attn_weights, tuple):  # if it's (attn, copy_attn)
-                attn_weights = (attn_weights[0].squeeze(1), attn_weights[1].squeeze(1))
-            else:
-                attn_weights = attn_weights.squeeze(1)
+            if self.return_attention:
+                attn_weights = outputs[2]
+                if isinstance(attn_weights, tuple):  # if it's (attn, copy_attn)
+                    attn_weights = (attn_weights[0].squeeze(1), attn_weights[1].squeeze(1))
+                else:
+                    attn_weights = attn_weights.squeeze(1)
 
             # tuple of (num_layers * num_directions, batch_size, trg_hidden_dim)=(1, hyp_seq_size, trg_hidden_dim), squeeze the first dim
             if isinstance(new_dec_hiddens, tuple):
-                new_dec_hiddens1 = new_dec_hiddens[0].squeeze(0)
-                new_dec_hiddens2 = new_dec_hiddens[1].squeeze(0)
-                new_dec_hiddens = [(new_dec_hiddens1[i], new_dec_hiddens2[i]) for i in range(num_partial_sequences)]
+                new_dec_hiddens = tuple([state.squeeze(0) for state in new_dec_hiddens])
+                new_dec_hiddens = [tuple([state[i] for state in new_dec_hiddens]) for i in range(num_partial_sequences)]
 
             # For every partial_sequence (num_partial_sequences in total), find and trim to the best hypotheses (beam_size in total)
             for batch_i in range(batch_size):
@@ -534,7 +696,6 @@ class SequenceGenerator(object):
                         if self.return_attention:
                             new_attention = copy.copy(partial_seq.attention)
                             if isinstance(attn_weights, tuple):  # if it's (attn, copy_attn)
-                                attn_weights = (attn_weights[0].squeeze(1), attn_weights[1].squeeze(1))
                                 new_attention.append((attn_weights[0][flattened_seq_id], attn_weights[1][flattened_seq_id]))
                             else:
                                 new_attention.append(attn_weights[flattened_seq_id])
@@ -592,3 +753,92 @@ class SequenceGenerator(object):
             sampled_sequences[batch_i] = sampled_sequences[batch_i].extract(sort=True)
 
         return sampled_sequences
+
+    def sample_batch(self, src_input, src_len, src_oov, oov_list, word2id, k, greedy_baseline=False):
+        '''
+        Tensorized sample(): the k sequences of each document are decoded as rows of one batch, without Sequence objects.
+            Same to sample(), the first words are k different samples (top k if greedy) of each document and the later ones are sampled
+            (argmax if greedy) row by row, for max_sequence_length steps (the words after <EOS> should be cut off)
+        :param k: number of sequences to sample
+        :param greedy_baseline: if True, k greedy sequences of each document are decoded in the same forward pass, as the baseline of self-critic
+        :return: (sample_ids, sample_log_probs), both are (batch_size, k, max_sequence_length), the log-probs can be backpropagated.
+            If greedy_baseline, followed by (greedy_ids, greedy_log_probs) of the same size, the log-probs are detached
+        '''
+        batch_size = len(src_input)
+        num_groups = 2 if greedy_baseline else 1
+        num_sample_rows = batch_size * k
+
+        src_mask = self.get_mask(src_input)  # same size as input_src
+        src_context, (src_h, src_c) = self.model.encode(src_input, src_len)
+
+        # prepare the init hidden vector, tuple of (1, batch_size, dec_hidden_dim)
+        dec_hiddens = self.model.init_decoder_state(src_h, src_c)
+
+        # expand the documents to rows, ordered by (sampled/greedy, document, k)
+        row2batch = torch.arange(batch_size).long().unsqueeze(1).expand(batch_size, k).contiguous().view(-1).repeat(num_groups)
+        if src_input.is_cuda:
+            row2batch = row2batch.cuda()
+        contexts = src_context.index_select(0, row2batch)
+        ctx_mask = src_mask.index_select(0, row2batch)
+        src_oovs = src_oov.index_select(0, row2batch)
+        oov_lists = [oov_list[batch_i] for batch_i in row2batch.tolist()]
+        dec_hiddens = tuple([state.index_select(1, row2batch) for state in dec_hiddens])
+
+        inputs = row2batch.new_full((len(row2batch), 1), word2id[pykp.io.BOS_WORD])
+        word_ids = []
+        word_log_probs = []
+        for current_len in range(1, self.max_sequence_length + 1):
+            # log_probs=(num_rows, 1, K), dec_hidden=tuple of (1, num_rows, trg_hidden_dim)
+            log_probs, dec_hiddens = self.model.generate(
+                trg_input=inputs,
+                dec_hidden=dec_hiddens,
+                enc_context=contexts,
+                ctx_mask=ctx_mask,
+                src_map=src_oovs,
+                oov_list=oov_lists,
+                max_len=1
+            )[:2]
+            log_probs = log_probs.squeeze(1)
+
+            if current_len == 1:
+                # the k rows of a document start with the same distribution, draw k different words from the first one
+                first_log_probs = log_probs.view(num_groups, batch_size, k, -1)[:, :, 0]
+                words = [torch.multinomial(first_log_probs[0].exp().detach(), k, replacement=False).view(-1)]
+                if greedy_baseline:
+                    words.append(first_log_probs[1].detach().topk(k, dim=-1)[1].view(-1))
+            else:
+                words = [torch.multinomial(log_probs[:num_sample_rows].exp().detach(), 1).view(-1)]
+                if greedy_baseline:
+                    words.append(log_probs[num_sample_rows:].detach().max(dim=-1)[1])
+            words = torch.cat(words)
+
+            word_ids.append(words)
+            word_log_probs.append(log_probs.gather(1, words.unsqueeze(1)).squeeze(1))
+            # if it's oov, replace it with <unk>
+            inputs = words.masked_fill(words >= self.model.vocab_size, self.model.unk_word).unsqueeze(1)
+
+        # (num_rows, max_sequence_length) -> (num_groups, batch_size, k, max_sequence_length)
+        word_ids = torch.stack(word_ids, dim=1).view(num_groups, batch_size, k, -1)
+        word_log_probs = torch.stack(word_log_probs, dim=1).view(num_groups, batch_size, k, -1)
+
+        if greedy_baseline:
+            return word_ids[0], word_log_probs[0], word_ids[1], word_log_probs[1].detach()
+        return word_ids[0], word_log_probs[0]
+
+
+class EnsembleSequenceGenerator(SequenceGenerator):
+    """Beam search with an ensemble of models (pykp.ensemble.EnsembleModel), a single pass for all the models."""
+
+    def __init__(self, models, eos_id, beam_size, max_sequence_length, quantize=False, **kwargs):
+        """
+        Args:
+          models: a list of models sharing the vocab, e.g. checkpoints of different epochs.
+            Each batch is encoded once per model and the log-probs of the models are averaged at each step.
+          quantize: quantize each model, see SequenceGenerator.
+          the others are the same to SequenceGenerator.
+        """
+        if quantize:
+            logging.info('Beam search with an ensemble of %d int8 dynamic quantized models on CPU' % len(models))
+            from pykp.model import quantize_model
+            models = [quantize_model(model) for model in models]
+        super(EnsembleSequenceGenerator, self).__init__(EnsembleModel(models), eos_id, beam_size, max_sequence_length, quantize=False, **kwargs)
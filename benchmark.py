@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the fp32 and int8 dynamic quantized inference on CPU: latency of beam search, memory and F1@5/F1@10 on the test sets.
+Takes the same options as predict.py, e.g.
+    CUDA_VISIBLE_DEVICES="" python benchmark.py -data_path_prefix data/kp20k/kp20k -vocab_path data/kp20k/kp20k.vocab.pt -exp kp20k -copy_attention -train_from exp/.../model/xxx.model
+"""
+import io
+import os
+import resource
+import time
+
+import numpy as np
+import torch
+
+import config
+import pykp
+from beam_search import SequenceGenerator
+from evaluate import evaluate_beam_search
+from pykp.dataloader import load_vocab_and_datasets_for_testing
+from train import init_model
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+
+class TimedSequenceGenerator(SequenceGenerator):
+    '''
+    Record the wall time and the number of documents of each beam_search() call
+    '''
+    def __init__(self, *args, **kwargs):
+        super(TimedSequenceGenerator, self).__init__(*args, **kwargs)
+        self.batch_times = []
+        self.batch_sizes = []
+
+    def beam_search(self, src_input, src_len, src_oov, oov_list, word2id):
+        start_time = time.time()
+        sequences = super(TimedSequenceGenerator, self).beam_search(src_input, src_len, src_oov, oov_list, word2id)
+        self.batch_times.append(time.time() - start_time)
+        self.batch_sizes.append(len(sequences))
+        return sequences
+
+
+def model_size_mb(model):
+    '''
+    size of the serialized state_dict, int8 weights of quantized modules are packed in it
+    '''
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 1024. / 1024.
+
+
+def rss_mb():
+    '''
+    current resident memory of the process, fall back to the peak if /proc is not available
+    '''
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return float(line.split()[1]) / 1024.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def main():
+    opt = config.init_opt(description='benchmark.py')
+    logger = config.init_logging('benchmark', opt.exp_path + '/benchmark.log', redirect_to_stdout=True)
+
+    if torch.cuda.is_available():
+        logger.error('Benchmark of quantized inference only runs on CPU, please hide the GPUs with CUDA_VISIBLE_DEVICES=""')
+        return
+
+    logger.info('Running on CPU with %d threads' % torch.get_num_threads())
+
+    test_data_loaders, word2id, id2word, vocab = load_vocab_and_datasets_for_testing(dataset_names=opt.test_dataset_names, type='test', opt=opt)
+    opt.word2id = word2id
+    opt.id2word = id2word
+    opt.vocab = vocab
+
+    model = init_model(opt)
+    model.eval()
+    shortlist = torch.load(open(opt.shortlist_path, 'rb')) if opt.shortlist_path else None
+
+    results = []
+    for mode in ['fp32', 'int8']:
+        generator = TimedSequenceGenerator(model,
+                                           eos_id=opt.word2id[pykp.io.EOS_WORD],
+                                           beam_size=opt.beam_size,
+                                           max_sequence_length=opt.max_sent_length,
+                                           n_best=opt.n_best,
+                                           dedup=opt.beam_dedup,
+                                           block_ngram=opt.beam_block_ngram,
+                                           shortlist=shortlist,
+                                           quantize=(mode == 'int8')
+                                           )
+        size = model_size_mb(generator.model)
+
+        for dataset_name, data_loader in zip(opt.test_dataset_names, test_data_loaders):
+            logger.info('Benchmarking %s on %s' % (mode, dataset_name))
+            generator.batch_times = []
+            generator.batch_sizes = []
+            score_dict = evaluate_beam_search(generator, data_loader, opt,
+                                              title='benchmark.%s.%s' % (mode, dataset_name),
+                                              predict_save_path=os.path.join(opt.pred_path, 'benchmark', mode, dataset_name))
+
+            # latency per document of each batch
+            doc_latencies = np.asarray(generator.batch_times) / np.asarray(generator.batch_sizes) * 1000.
+            results.append((mode, dataset_name,
+                            np.sum(generator.batch_times) * 1000. / max(np.sum(generator.batch_sizes), 1),
+                            np.percentile(doc_latencies, 50), np.percentile(doc_latencies, 90),
+                            size, rss_mb(),
+                            np.average(score_dict['f_score@5_exact']), np.average(score_dict['f_score@10_exact'])))
+
+            # empty dataset to free memory
+            data_loader.dataset.offload_dataset()
+
+    logger.info('======================  Benchmark Results  =========================')
+    logger.info('%-6s %-14s %12s %12s %12s %14s %10s %8s %8s' % ('mode', 'dataset', 'ms/doc', 'p50 ms/doc', 'p90 ms/doc', 'model size MB', 'RSS MB', 'F1@5', 'F1@10'))
+    for result in results:
+        logger.info('%-6s %-14s %12.2f %12.2f %12.2f %14.2f %10.2f %8.4f %8.4f' % result)
+
+
+if __name__ == '__main__':
+    main()
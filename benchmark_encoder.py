@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the throughput of the LSTM (-encoder_type rnn) and self-attention (-encoder_type transformer) encoders on the kp20k test set.
+Only the encoders are timed (model.encode()), the weights are randomly initialized as the speed doesn't depend on them. e.g.
+    python benchmark_encoder.py -data_path_prefix data/kp20k/kp20k -vocab_path data/kp20k/kp20k.vocab.pt -exp kp20k -bidirectional -enc_layers 2
+"""
+import time
+
+import torch
+
+import config
+from pykp.dataloader import load_vocab_and_datasets_for_testing
+from pykp.model import Seq2SeqLSTMAttention
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+# number of batches to time, and the ones to warm up with beforehand
+NUM_BATCHES = 50
+NUM_WARMUP_BATCHES = 3
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def time_encoder(model, batches, train):
+    '''
+    :param train: if True, time forward and backward of the encoder, otherwise forward only without gradients
+    :return: the total seconds spent on the batches (excluding the warm-up ones)
+    '''
+    model.train(train)
+    total_time = 0.0
+    for batch_i, (src, src_len) in enumerate(batches):
+        synchronize()
+        start_time = time.time()
+        if train:
+            context, (h_t, c_t) = model.encode(src, src_len)
+            (context.sum() + h_t.sum() + c_t.sum()).backward()
+            model.zero_grad()
+        else:
+            with torch.no_grad():
+                model.encode(src, src_len)
+        synchronize()
+        if batch_i >= NUM_WARMUP_BATCHES:
+            total_time += time.time() - start_time
+    return total_time
+
+
+def main():
+    opt = config.init_opt(description='benchmark_encoder.py')
+    logger = config.init_logging('benchmark_encoder', opt.exp_path + '/benchmark_encoder.log', redirect_to_stdout=True)
+
+    test_data_loaders, word2id, id2word, vocab = load_vocab_and_datasets_for_testing(dataset_names=['kp20k'], type='test', opt=opt)
+    opt.word2id = word2id
+    opt.id2word = id2word
+    opt.vocab = vocab
+
+    batches = []
+    for batch in test_data_loaders[0]:
+        one2many_batch, _ = batch
+        src, src_len = one2many_batch[0], one2many_batch[1]
+        if torch.cuda.is_available():
+            src = src.cuda()
+        batches.append((src, src_len))
+        if len(batches) >= NUM_BATCHES + NUM_WARMUP_BATCHES:
+            break
+
+    timed_batches = batches[NUM_WARMUP_BATCHES:]
+    num_docs = sum([len(src_len) for _, src_len in timed_batches])
+    num_tokens = sum([sum(src_len) for _, src_len in timed_batches])
+    logger.info('Timing %d batches, %d documents, %.1f source tokens per document on average, max length=%d' %
+                (len(timed_batches), num_docs, float(num_tokens) / num_docs, max([max(src_len) for _, src_len in timed_batches])))
+
+    results = []
+    for encoder_type in ['rnn', 'transformer']:
+        opt.encoder_type = encoder_type
+        model = Seq2SeqLSTMAttention(opt)
+        if torch.cuda.is_available():
+            model.cuda()
+        num_params = sum([p.numel() for p in model.encoder.parameters()])
+
+        for train in [False, True]:
+            logger.info('Benchmarking %s encoder, %s' % (encoder_type, 'forward+backward' if train else 'inference'))
+            total_time = time_encoder(model, batches, train)
+            results.append((encoder_type, 'train' if train else 'infer', num_params / 1e6,
+                            num_tokens / total_time, num_docs / total_time, total_time * 1000. / len(timed_batches)))
+
+    logger.info('======================  Encoder Throughput  =========================')
+    logger.info('%-12s %-6s %10s %14s %10s %12s' % ('encoder', 'mode', 'params(M)', 'tokens/s', 'docs/s', 'ms/batch'))
+    for result in results:
+        logger.info('%-12s %-6s %10.2f %14.1f %10.1f %12.2f' % result)
+
+
+if __name__ == '__main__':
+    main()
@@ -85,6 +85,28 @@ def init_opt(description):
         prev_opt.run_valid_every = opt.run_valid_every
         prev_opt.report_every = opt.report_every
         prev_opt.test_dataset_names = opt.test_dataset_names
+        # inference options are always taken from the current command
+        prev_opt.shortlist_path = opt.shortlist_path
+        prev_opt.quantize = opt.quantize
+        prev_opt.export_serving_prefix = opt.export_serving_prefix
+        prev_opt.serving_model_prefix = opt.serving_model_prefix
+        prev_opt.prune_corpus = opt.prune_corpus
+        prev_opt.prune_min_freq = opt.prune_min_freq
+        prev_opt.prune_output_prefix = opt.prune_output_prefix
+        prev_opt.prune_benchmark = opt.prune_benchmark
+        prev_opt.n_best = opt.n_best
+        prev_opt.beam_dedup = opt.beam_dedup
+        prev_opt.beam_block_ngram = opt.beam_block_ngram
+        prev_opt.beam_search_memory_mb = opt.beam_search_memory_mb
+        prev_opt.predict_workers = opt.predict_workers
+        prev_opt.ensemble_checkpoints = opt.ensemble_checkpoints
+        prev_opt.prediction_cache_path = opt.prediction_cache_path
+        prev_opt.prediction_cache_size = opt.prediction_cache_size
+        prev_opt.predict_input = opt.predict_input
+        prev_opt.predict_input_format = opt.predict_input_format
+        prev_opt.predict_src_fields = opt.predict_src_fields
+        prev_opt.predict_output = opt.predict_output
+        prev_opt.stream_buffer_size = opt.stream_buffer_size
 
         prev_opt.exp = opt.exp
         prev_opt.vocab_path = opt.vocab_path
@@ -149,21 +171,27 @@ def model_opts(parser):
     parser.add_argument('-position_encoding', action='store_true',
                         help='Use a sin to mark relative words positions.')
     parser.add_argument('-share_decoder_embeddings', action='store_true',
-                        help='Share the word and out embeddings for decoder.')
+                        help="""Share the word and out embeddings for decoder (tie the weight of decoder2vocab with the embedding),
+                        the decoder outputs are projected to word_vec_size if it's different from rnn_size.""")
     parser.add_argument('-share_embeddings', action='store_true',
                         help="""Share the word embeddings between encoder
-                         and decoder.""")
+                         and decoder. Always on, as the model has only one embedding table.""")
 
     # RNN Options
     parser.add_argument('-encoder_type', type=str, default='rnn',
                         choices=['rnn', 'brnn', 'mean', 'transformer', 'cnn'],
-                        help="""Type of encoder layer to use.""")
+                        help="""Type of encoder layer to use. Only 'rnn' (LSTM) and 'transformer' are implemented, the
+                        transformer outputs contexts of size rnn_size * num_directions and mean-pools them for the decoder state""")
     parser.add_argument('-decoder_type', type=str, default='rnn',
                         choices=['rnn', 'transformer', 'cnn'],
                         help='Type of decoder layer to use.')
 
     parser.add_argument('-enc_layers', type=int, default=1,
                         help='Number of layers in the encoder')
+    parser.add_argument('-heads', type=int, default=8,
+                        help='Number of attention heads of the transformer encoder')
+    parser.add_argument('-transformer_ff', type=int, default=2048,
+                        help='Size of the feed-forward layers of the transformer encoder')
     parser.add_argument('-dec_layers', type=int, default=1,
                         help='Number of layers in the decoder')
 
@@ -220,6 +248,19 @@ def model_opts(parser):
     parser.add_argument('-copy_gate', action="store_true",
                         help="A gate controling the flow from generative model and copy model (see See et al.)")
 
+    parser.add_argument('-output_layer', type=str, default='softmax',
+                        choices=['softmax', 'adaptive', 'sampled'],
+                        help="""The output layer of decoder: full softmax,
+                        adaptive softmax (Grave et al.) with clusters on the frequency-sorted vocab,
+                        or sampled softmax in training (Jean et al.), which is full softmax in inference""")
+    parser.add_argument('-adaptive_cutoffs', type=int, nargs='+', default=[2000, 10000],
+                        help="Cutoffs of the clusters of adaptive softmax, the ids of vocab are sorted by frequency")
+    parser.add_argument('-adaptive_div_value', type=float, default=4.0,
+                        help="The hidden size of each tail cluster of adaptive softmax is divided by div_value^idx")
+    parser.add_argument('-sampled_softmax_size', type=int, default=4096,
+                        help="Number of words sampled from a log-uniform distribution for sampled softmax, "
+                             "besides all the words in the targets and sources of the batch")
+
     # parser.add_argument('-coverage_attn', action="store_true",
     #                     help='Train a coverage attention layer by Tu:2016:ACL.')
     # parser.add_argument('-lambda_coverage', type=float, default=1,
@@ -246,6 +287,8 @@ def preprocess_opts(parser):
                         help="Maximum number of unknown words the model supports (mainly for masking in loss).")
 
     parser.add_argument('-words_min_frequency', type=int, default=0)
+    parser.add_argument('-shortlist_size', type=int, default=5000,
+                        help="Number of the most frequent target words kept in the keyphrase shortlist for decoding")
 
     # Length filter options
     parser.add_argument('-max_src_seq_length', type=int, default=300,
@@ -333,6 +376,14 @@ def train_opts(parser):
     parser.add_argument('-optim', default='adam',
                         choices=['sgd', 'adagrad', 'adadelta', 'adam'],
                         help="""Optimization method.""")
+    parser.add_argument('-checkpoint_activations', action="store_true", default=False,
+                        help="""Activation checkpointing of the encoder, the attention/copy attention and the output layer with merging copy probs
+                        in training: their intermediate activations (e.g. the (batch_size, trg_len, src_len) attention energies) are
+                        recomputed in backward instead of being kept in memory. Trade about one more forward pass for memory""")
+    parser.add_argument('-accum_token_budget', type=int, default=0,
+                        help="""If > 0, accumulate the gradients of batches until the number of target words (non-padding) reaches it,
+                        then update once with the loss averaged over all these words. Use it with a small -batch_size to train with
+                        a large effective batch in bounded memory""")
     parser.add_argument('-max_grad_norm', type=float, default=2,
                         help="""If the norm of the gradient vector exceeds this,
                         renormalize it to have the norm equal to
@@ -341,6 +392,26 @@ def train_opts(parser):
                         help="""Truncated bptt.""")
     parser.add_argument('-dropout', type=float, default=0.0,
                         help="Dropout probability; applied in LSTM stacks.")
+    parser.add_argument('-fused_loss', action="store_true", default=False,
+                        help="Compute the output layer, log_softmax and NLL loss chunk by chunk over the (packed, non-padding) target words "
+                             "with gradient checkpointing, rather than materializing the log-probs of all the words at once")
+    parser.add_argument('-loss_chunk_size', type=int, default=4,
+                        help="Number of target time steps per chunk if -fused_loss is set, i.e. loss_chunk_size * batch_size target words")
+
+    # Knowledge distillation options
+    parser.add_argument('-teacher_model', default='', type=str,
+                        help="""If set, distill this trained model (the teacher) to the model being trained (the student),
+                        which is trained to the mixture of the ground-truth and the teacher's top-k distribution of each target word""")
+    parser.add_argument('-teacher_opts', default='', type=str,
+                        help="""Model options of the teacher in a string, e.g. "-rnn_size 512 -bidirectional -vocab_size 50000",
+                        the others are same to the student's. The vocab of the student (its -vocab_size and the data preprocessed with it) can be smaller""")
+    parser.add_argument('-distill_topk', type=int, default=8,
+                        help="Number of the teacher's top predictions kept as the soft targets of each word")
+    parser.add_argument('-distill_alpha', type=float, default=0.5,
+                        help="Weight of the teacher's soft targets, the ground-truth has the weight 1 - distill_alpha")
+    parser.add_argument('-distill_cache_path', default='', type=str,
+                        help="""File to cache the teacher's soft targets, thus the teacher only runs in the first epoch.
+                        Default is [teacher_model].top[distill_topk].cache""")
 
     # Learning options
     parser.add_argument('-train_ml', action="store_true", default=False,
@@ -356,6 +427,8 @@ def train_opts(parser):
                         help="""0: ori, 1: running average as baseline""")
     parser.add_argument('-rl_start_epoch', default=2, type=int,
                         help="""from which epoch rl training starts""")
+    parser.add_argument('-rl_reward_workers', default=0, type=int,
+                        help="""Number of processes computing the rewards of sampled sequences, 0 computes them in the training process""")
     # GPU
 
     # Teacher Forcing and Scheduled Sampling
@@ -425,11 +498,23 @@ def train_opts(parser):
                         help='Maximum batch size')
     parser.add_argument('-beam_search_batch_workers', type=int, default=4,
                         help='Number of workers for generating batches')
+    parser.add_argument('-beam_search_memory_mb', type=int, default=0,
+                        help="""If > 0, pack the examples into beam search batches by the estimated memory of beam search (given the model size,
+                        beam_size and source lengths) under this budget in MB, instead of -beam_search_batch_example/-beam_search_batch_size""")
 
     parser.add_argument('-beam_size',  type=int, default=32,
                         help='Beam size')
     parser.add_argument('-max_sent_length', type=int, default=5,
                         help='Maximum sentence length.')
+    parser.add_argument('-n_best', type=int, default=0,
+                        help="""If > 0, beam search returns the n_best complete sequences of each document, and stops searching
+                        a document once its partial sequences can not beat them. 0 keeps all the complete sequences""")
+    parser.add_argument('-beam_dedup', action='store_true', default=False,
+                        help="""Duplicate-aware beam search: keep only the best one of the hypotheses which are the same after stemming,
+                        thus a smaller beam_size produces the same number of unique phrases""")
+    parser.add_argument('-beam_block_ngram', type=int, default=0,
+                        help="""If > 0, beam search drops the hypotheses repeating a (stemmed) n-gram of this size,
+                        1 means a phrase can not contain a word twice""")
 
 def predict_opts(parser):
     parser.add_argument('-must_appear_in_src', action='store_true', default=False,
@@ -442,6 +527,57 @@ def predict_opts(parser):
 
     parser.add_argument('-test_dataset_root_path', type=str, default="data/")
 
+    parser.add_argument('-shortlist_path', type=str, default=None,
+                        help="""Path to the ".shortlist.pt" file from preprocess.py. If given, beam search
+                        only computes the logits of words in the shortlist and the source texts""")
+    parser.add_argument('-quantize', action='store_true', default=False,
+                        help="""Run inference with an int8 dynamic quantized model (LSTM, Linear layers and the embedding),
+                        only supported on CPU""")
+    parser.add_argument('-export_serving_prefix', type=str, default=None,
+                        help="""If given, script the encoder and the single-step decoder of the model loaded by -train_from
+                        and save them to <prefix>.encoder.pt, <prefix>.decode_step.pt and <prefix>.serving.json, then exit""")
+    parser.add_argument('-serving_model_prefix', type=str, default=None,
+                        help="""Run beam search with the scripted modules saved by -export_serving_prefix instead of
+                        building the model from -train_from""")
+    parser.add_argument('-ensemble_checkpoints', type=str, nargs='*', default=[],
+                        help="""Checkpoints (e.g. of different epochs) decoded as an ensemble instead of -train_from. All are built with the
+                        current model options, thus they must share them (e.g. different epochs or seeds of one configuration).
+                        Each batch is encoded once per model and their log-probs are averaged in a single beam search""")
+    parser.add_argument('-prediction_cache_path', type=str, default=None,
+                        help="""A sqlite file caching the predictions of each document, keyed by the hash of its tokenized source and
+                        the fingerprint of the checkpoint(s) and the decoding options, thus repeated documents are not decoded again""")
+    parser.add_argument('-prediction_cache_size', type=int, default=100000,
+                        help="Maximum number of documents in the prediction cache, the least recently used ones are evicted")
+    parser.add_argument('-predict_workers', type=int, default=0,
+                        help="""If > 0, decode each test set by this number of processes (CPU only), each loads the model once
+                        and runs on its own subset of the cores. The predictions are merged back in the order of documents""")
+
+    # streaming prediction on raw texts
+    parser.add_argument('-predict_input', type=str, default=None,
+                        help="""Path of raw documents to predict, '-' for stdin. If given, predict.py tokenizes them on the fly
+                        with the vocab of -vocab_path and streams the predictions to -predict_output, instead of evaluating -test_dataset_names""")
+    parser.add_argument('-predict_input_format', type=str, default='json', choices=['json', 'text'],
+                        help="Format of -predict_input: one json object per line (see -predict_src_fields) or one document per line")
+    parser.add_argument('-predict_src_fields', type=str, nargs='+', default=['title', 'abstract'],
+                        help="The fields of a json document concatenated as the source text")
+    parser.add_argument('-predict_output', type=str, default='-',
+                        help="Path of the predictions (JSON lines of id, keyphrases and scores), '-' for stdout")
+    parser.add_argument('-stream_buffer_size', type=int, default=1000,
+                        help="""Number of documents read at a time in the streaming mode, they are micro-batched by the
+                        source length (-beam_search_batch_example or -beam_search_memory_mb) and written in the order of input""")
+
+    # vocabulary pruning (prune_vocab.py)
+    parser.add_argument('-prune_corpus', type=str, nargs='*', default=[],
+                        help="""Text files of the deployment domain, one document per line. prune_vocab.py keeps the words
+                        appearing at least -prune_min_freq times in them. If not given, the frequencies in the training data are used""")
+    parser.add_argument('-prune_min_freq', type=int, default=1,
+                        help="Minimum frequency of a word to be kept in the pruned vocab")
+    parser.add_argument('-prune_output_prefix', type=str, default=None,
+                        help="""prune_vocab.py writes the pruned checkpoint and its config, vocab, shortlist and test datasets to
+                        <prefix>/model/<exp>.model and <exp>.initial.config, <prefix>.vocab.pt, <prefix>.shortlist.pt and <prefix>.data/""")
+    parser.add_argument('-prune_benchmark', action='store_true', default=False,
+                        help="Measure the decoding speed and F-scores of the original and the pruned models on -test_dataset_names")
+
     parser.add_argument('-test_dataset_names', type=str, nargs='+',
                         default=[],
                         help='(Set later) Name of each test dataset, also the name of folder from which we load processed test dataset.')
@@ -11,12 +11,13 @@ import numpy as np
 from collections import Counter
 
 import os
+import time
 
 from torch.autograd import Variable
 
 import config
 import pykp
-from utils import Progbar
+from utils import Progbar, OOMSplitStats, split_on_oom
 from pykp.metric.bleu import bleu
 
 stemmer = PorterStemmer()
@@ -156,14 +157,20 @@ def if_present_duplicate_phrases(src_str, trgs_str, do_stemming=True, check_dupl
     return present_flags, present_indices
 
 
-def evaluate_multiple_datasets(generator, data_loaders, opt, title='', epoch=1, predict_save_path=None):
+def evaluate_multiple_datasets(generator, data_loaders, opt, title='', epoch=1, predict_save_path=None, predict_fn=None):
+    '''
+    :param predict_fn: optional, a function decoding all the batches of a data loader at once (e.g. in multiple processes),
+        returns the predicted sequences of each batch and the decoding time. If not given, batches are decoded by generator one by one
+    '''
     # return the scores of all examples in multiple datasets
     datasets_score_dict = {}
     for dataset_name, data_loader in zip(opt.test_dataset_names, data_loaders):
         logging.getLogger().info('Evaluating %s' % dataset_name)
+        predictions, decode_time = predict_fn(data_loader) if predict_fn is not None else (None, 0.0)
         score_dict = evaluate_beam_search(generator, data_loader, opt,
                                                title=dataset_name + '.' + title, epoch=epoch,
-                                               predict_save_path=os.path.join(predict_save_path, dataset_name))
+                                               predict_save_path=os.path.join(predict_save_path, dataset_name),
+                                               predictions=predictions, decode_time=decode_time)
 
         # write the scores into file
         score_json_path = os.path.join(predict_save_path, dataset_name, 'detailed_score.json')
@@ -188,7 +195,25 @@ def evaluate_multiple_datasets(generator, data_loaders, opt, title='', epoch=1,
     return datasets_score_dict
 
 
-def evaluate_beam_search(generator, data_loader, opt, title='', epoch=1, predict_save_path=None):
+def decode_batch(generator, src_list, src_len, src_oov_map_list, oov_list, word2id, oom_stats=None):
+    '''
+    Beam search on a one2many batch, on out-of-memory the batch is split and predicted piece by piece
+    :return: a list of predicted sequences (sorted by score) of each example
+    '''
+    def beam_search_piece(start, end):
+        # trim the paddings of the shorter sources, the examples are sorted by the source length
+        piece_src_len = max(src_len[start: end])
+        return generator.beam_search(src_list[start: end, :piece_src_len], src_len[start: end], src_oov_map_list[start: end, :piece_src_len],
+                                     oov_list[start: end], word2id)
+
+    return [pred_seqs for piece in split_on_oom(beam_search_piece, 0, len(src_len), oom_stats) for pred_seqs in piece]
+
+
+def evaluate_beam_search(generator, data_loader, opt, title='', epoch=1, predict_save_path=None, predictions=None, decode_time=0.0):
+    '''
+    :param predictions: optional, the predicted sequences of each batch of data_loader decoded beforehand, then generator is not used
+    :param decode_time: the time of decoding the predictions
+    '''
     logger = config.init_logging(title, predict_save_path + '/%s.log' % title, redirect_to_stdout=False)
     progbar = Progbar(logger=logger, title=title, target=len(data_loader), batch_size=data_loader.batch_size,
                       total_examples=len(data_loader.dataset))
@@ -198,6 +223,9 @@ def evaluate_beam_search(generator, data_loader, opt, title='', epoch=1, predict
 
     example_idx = 0
     score_dict = {}  # {'precision@5':[],'recall@5':[],'f1score@5':[], 'precision@10':[],'recall@10':[],'f1score@10':[]}
+    # time spent on beam search only, to report the speed/quality trade-off (e.g. with or without shortlist)
+    decode_example_number = 0
+    oom_stats = OOMSplitStats(title)
 
     for i, batch in enumerate(data_loader):
         if i > 5:
@@ -214,11 +242,13 @@ def evaluate_beam_search(generator, data_loader, opt, title='', epoch=1, predict
         print("src size - %s" % str(src_list.size()))
         print("target size - %s" % len(trg_copy_target_list))
 
-        try:
-            pred_seq_list = generator.beam_search(src_list, src_len, src_oov_map_list, oov_list, opt.word2id)
-        except RuntimeError as re:
-            logging.exception('Encountered OOM RuntimeError, now trying to predict one by one')
-            raise re
+        if predictions is not None:
+            pred_seq_list = predictions[i]
+        else:
+            start_time = time.time()
+            pred_seq_list = decode_batch(generator, src_list, src_len, src_oov_map_list, oov_list, opt.word2id, oom_stats)
+            decode_time += time.time() - start_time
+        decode_example_number += len(pred_seq_list)
 
         '''
         process each example in current batch
@@ -381,6 +411,11 @@ def evaluate_beam_search(generator, data_loader, opt, title='', epoch=1, predict
 
     logger.info('#(f_score@5_exact)=%d, sum=%f' % (len(score_dict['f_score@5_exact']), sum(score_dict['f_score@5_exact'])))
     logger.info('#(f_score@10_exact)=%d, sum=%f' % (len(score_dict['f_score@10_exact']), sum(score_dict['f_score@10_exact'])))
+    logger.info('Decoding %s: #(doc)=%d, time=%.2fs, %.2f docs/s, shortlist=%s, f_score@5_exact=%.4f, f_score@10_exact=%.4f'
+                % (title, decode_example_number, decode_time, decode_example_number / max(decode_time, 1e-8),
+                   'None' if generator is None or generator.shortlist is None else str(len(generator.shortlist)),
+                   np.average(score_dict['f_score@5_exact']), np.average(score_dict['f_score@10_exact'])))
+    oom_stats.log_summary(logger)
 
     # Write score summary to disk. Each row is scores (precision, recall and f-score)
     if predict_save_path:
@@ -1,15 +1,20 @@
 # -*- coding: utf-8 -*-
+import copy
 import os
-from evaluate import evaluate_beam_search, evaluate_multiple_datasets
+import sys
+import time
+import multiprocessing
+from evaluate import evaluate_beam_search, evaluate_multiple_datasets, decode_batch
 import logging
 
 import config
 
 import torch
 
-from beam_search import SequenceGenerator
-from pykp.dataloader import KeyphraseDataLoader
-from train import init_model, load_vocab_and_datasets_for_testing
+from beam_search import SequenceGenerator, EnsembleSequenceGenerator
+from pykp.dataloader import KeyphraseDataLoader, load_vocab_and_datasets_for_testing
+from pykp.stream import predict_stream, open_stream
+from pykp.prediction_cache import PredictedSequence, PredictionCache, CachedSequenceGenerator, model_fingerprint
 
 import pykp
 from pykp.io import KeyphraseDatasetTorchText, KeyphraseDataset
@@ -20,6 +25,156 @@ __email__ = "rui.meng@pitt.edu"
 logger = logging.getLogger()
 
 
+def load_model(opt):
+    '''
+    :return: the model, or a list of models if -ensemble_checkpoints is given
+    '''
+    if opt.ensemble_checkpoints:
+        # all the checkpoints are built with the model options of opt
+        from train import init_model
+        ensemble_opt = copy.copy(opt)
+        models = []
+        for checkpoint_path in opt.ensemble_checkpoints:
+            ensemble_opt.train_from = checkpoint_path
+            models.append(init_model(ensemble_opt))
+        logging.getLogger().info('Loaded an ensemble of %d checkpoints' % len(models))
+        return models
+    if opt.serving_model_prefix:
+        # the scripted modules carry their own configuration, no need to import the training stack
+        from pykp.serving import load_serving_model
+        model = load_serving_model(opt.serving_model_prefix, map_location='cuda' if torch.cuda.is_available() else 'cpu')
+        logging.getLogger().info('Loaded the scripted model from %s.*' % opt.serving_model_prefix)
+    else:
+        from train import init_model
+        model = init_model(opt)
+    return model
+
+
+def build_generator(opt, model):
+    '''
+    :param model: a model, or a list of models decoded as an ensemble
+    '''
+    shortlist = torch.load(open(opt.shortlist_path, 'rb')) if opt.shortlist_path else None
+    generator_class = EnsembleSequenceGenerator if isinstance(model, list) else SequenceGenerator
+    generator = generator_class(model,
+                                  eos_id=opt.word2id[pykp.io.EOS_WORD],
+                                  beam_size=opt.beam_size,
+                                  max_sequence_length=opt.max_sent_length,
+                                  n_best=opt.n_best,
+                                  dedup=opt.beam_dedup,
+                                  block_ngram=opt.beam_block_ngram,
+                                  shortlist=shortlist,
+                                  quantize=opt.quantize
+                                  )
+    if opt.prediction_cache_path:
+        # opt.model_fingerprint is computed once by main()
+        generator = CachedSequenceGenerator(generator, PredictionCache(opt.prediction_cache_path, opt.model_fingerprint, opt.prediction_cache_size))
+    return generator
+
+
+# the generator and the vocab of each worker process, set by init_predict_worker()
+worker_generator = None
+worker_word2id = None
+
+
+def init_predict_worker(opt, core_queue):
+    '''
+    Pin the worker to its subset of cores and load the model once
+    '''
+    global worker_generator, worker_word2id
+    cores = core_queue.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+    worker_generator = build_generator(opt, load_model(opt))
+    worker_word2id = opt.word2id
+
+
+def decode_shard(shard):
+    '''
+    :param shard: a list of (src, src_len, src_oov, oov_list) one2many batches
+    :return: pid of the worker, the predictions of each batch, the number of documents, the decoding time and the cache stats (None if no cache)
+    '''
+    start_time = time.time()
+    predictions = []
+    for src_list, src_len, src_oov_map_list, oov_list in shard:
+        pred_seq_list = decode_batch(worker_generator, src_list, src_len, src_oov_map_list, oov_list, worker_word2id)
+        predictions.append([[PredictedSequence([int(x) for x in seq.sentence], seq.score) for seq in pred_seqs] for pred_seqs in pred_seq_list])
+    cache_stats = worker_generator.cache.stats() if isinstance(worker_generator, CachedSequenceGenerator) else None
+    return os.getpid(), predictions, sum([len(batch[1]) for batch in shard]), time.time() - start_time, cache_stats
+
+
+class ShardedPredictor(object):
+    '''
+    Decode a test set by -predict_workers processes (CPU only): the batches are split into contiguous shards, one per worker,
+        each worker loads the model once and runs with its own subset of cores (torch.set_num_threads),
+        then the predictions are merged back in the order of documents.
+    '''
+    def __init__(self, opt, num_workers):
+        self.num_workers = num_workers
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(multiprocessing.cpu_count()))
+        cores_per_worker = max(len(cores) // num_workers, 1)
+
+        context = multiprocessing.get_context('spawn')
+        core_queue = context.Queue()
+        for i in range(num_workers):
+            core_queue.put(cores[(i * cores_per_worker) % len(cores): (i * cores_per_worker) % len(cores) + cores_per_worker])
+        self.pool = context.Pool(num_workers, initializer=init_predict_worker, initargs=(opt, core_queue))
+
+    def __call__(self, data_loader):
+        '''
+        :return: the predicted sequences of each batch of data_loader, and the decoding time
+        '''
+        batches = []
+        for one2many_batch, _ in data_loader:
+            src_list, src_len, _, _, _, src_oov_map_list, oov_list, _, _ = one2many_batch
+            batches.append((src_list, src_len, src_oov_map_list, oov_list))
+
+        shard_size = (len(batches) + self.num_workers - 1) // self.num_workers
+        shards = [batches[i: i + shard_size] for i in range(0, len(batches), shard_size)]
+
+        start_time = time.time()
+        results = self.pool.map(decode_shard, shards)
+        decode_time = time.time() - start_time
+
+        for worker_id, (pid, _, num_docs, seconds, cache_stats) in enumerate(results):
+            logging.getLogger().info('Worker %d (pid=%d): %d docs in %.2fs, %.2f docs/s%s'
+                                     % (worker_id, pid, num_docs, seconds, num_docs / max(seconds, 1e-8),
+                                        '' if cache_stats is None else ', cache hits=%d, misses=%d' % (cache_stats['hits'], cache_stats['misses'])))
+        num_docs = sum([result[2] for result in results])
+        logging.getLogger().info('All %d workers: %d docs in %.2fs, %.2f docs/s' % (len(results), num_docs, decode_time, num_docs / max(decode_time, 1e-8)))
+
+        return [pred_seq_list for result in results for pred_seq_list in result[1]], decode_time
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def predict_raw_texts(opt):
+    '''
+    The streaming mode: predict the raw texts of -predict_input and write the predictions to -predict_output as JSON lines
+    '''
+    logger = logging.getLogger()
+    logger.info("Loading vocab from disk: %s" % (opt.vocab_path))
+    opt.word2id, opt.id2word, opt.vocab = torch.load(opt.vocab_path, 'rb')
+
+    if opt.prediction_cache_path:
+        opt.model_fingerprint = model_fingerprint(opt)
+    generator = build_generator(opt, load_model(opt))
+
+    input_file = open_stream(opt.predict_input, 'r')
+    output_file = open_stream(opt.predict_output, 'w')
+    num_docs = predict_stream(generator, input_file, output_file, opt)
+    logger.info('Predicted %d documents from %s to %s' % (num_docs, opt.predict_input, opt.predict_output))
+    for f in [input_file, output_file]:
+        if f not in [sys.stdin, sys.stdout]:
+            f.close()
+    if isinstance(generator, CachedSequenceGenerator):
+        generator.cache.log_stats()
+
+
 def main():
     opt = config.init_opt(description='predict.py')
     logger = config.init_logging('predict', opt.exp_path + '/output.log', redirect_to_stdout=False)
@@ -37,7 +192,31 @@ def main():
     else:
         logger.info('Running on CPU!')
 
+    if opt.quantize and torch.cuda.is_available():
+        logger.error('Quantized inference only runs on CPU, please hide the GPUs with CUDA_VISIBLE_DEVICES=""')
+        return
+
+    if opt.predict_workers > 0 and torch.cuda.is_available():
+        logger.error('-predict_workers only runs on CPU, please hide the GPUs with CUDA_VISIBLE_DEVICES=""')
+        return
+
+    if opt.ensemble_checkpoints and opt.serving_model_prefix:
+        logger.error('-ensemble_checkpoints is not supported by the scripted model')
+        return
+
+    if opt.quantize and opt.serving_model_prefix:
+        logger.error('-quantize is not supported by the scripted model')
+        return
+
+    if opt.predict_input and opt.predict_workers > 0:
+        logger.error('-predict_workers is not supported by the streaming mode (-predict_input)')
+        return
+
     try:
+        if opt.predict_input:
+            predict_raw_texts(opt)
+            return
+
         valid_data_loaders, word2id, id2word, vocab = load_vocab_and_datasets_for_testing(dataset_names=opt.test_dataset_names, type='valid', opt=opt)
         test_data_loaders, _, _, _ = load_vocab_and_datasets_for_testing(dataset_names=opt.test_dataset_names, type='test', opt=opt)
 
@@ -45,19 +224,36 @@ def main():
         opt.id2word = id2word
         opt.vocab = vocab
 
-        model = init_model(opt)
-        generator = SequenceGenerator(model,
-                                      eos_id=opt.word2id[pykp.io.EOS_WORD],
-                                      beam_size=opt.beam_size,
-                                      max_sequence_length=opt.max_sent_length
-                                      )
+        if opt.export_serving_prefix:
+            from train import init_model
+            from pykp.serving import export_serving_model
+            export_serving_model(init_model(opt), opt.export_serving_prefix)
+            return
+
+        if opt.prediction_cache_path:
+            opt.model_fingerprint = model_fingerprint(opt)
+            logger.info('Caching the predictions in %s, model fingerprint=%s' % (opt.prediction_cache_path, opt.model_fingerprint))
+
+        if opt.predict_workers > 0:
+            # each worker loads its own model, the main process only evaluates the predictions
+            generator = None
+            predict_fn = ShardedPredictor(opt, opt.predict_workers)
+        else:
+            generator = build_generator(opt, load_model(opt))
+            predict_fn = None
 
         valid_score_dict = evaluate_multiple_datasets(generator, valid_data_loaders, opt,
                                                                title='valid',
-                                                               predict_save_path=opt.pred_path)
+                                                               predict_save_path=opt.pred_path,
+                                                               predict_fn=predict_fn)
         test_score_dict = evaluate_multiple_datasets(generator, test_data_loaders, opt,
                                                               title='test',
-                                                              predict_save_path=opt.pred_path)
+                                                              predict_save_path=opt.pred_path,
+                                                              predict_fn=predict_fn)
+        if predict_fn is not None:
+            predict_fn.close()
+        if isinstance(generator, CachedSequenceGenerator):
+            generator.cache.log_stats()
 
         # test_data_loaders, word2id, id2word, vocab = load_vocab_and_datasets(opt)
         # for testset_name, test_data_loader in zip(opt.test_dataset_names, test_data_loaders):
@@ -96,6 +96,12 @@ def main():
     opt.vocab_path = os.path.join(opt.output_path, opt.dataset_name + '.vocab.pt')
     torch.save([word2id, id2word, vocab], open(opt.vocab_path, 'wb'))
 
+    print("Dumping keyphrase shortlist to disk")
+    shortlist = pykp.io.build_keyphrase_shortlist(tokenized_train_pairs, word2id, opt)
+    print('Shortlist size = %d' % len(shortlist))
+    torch.save(shortlist, open(os.path.join(opt.subset_output_path, opt.dataset_name + '.shortlist.pt'), 'wb'))
+    torch.save(shortlist, open(os.path.join(opt.output_path, opt.dataset_name + '.shortlist.pt'), 'wb'))
+
     print("Exporting a small dataset to %s (for debugging), "
           "size of train/valid/test is 20000" % opt.subset_output_path)
     pykp.io.process_and_export_dataset(tokenized_train_pairs[:20000],
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Prune the vocab of a trained checkpoint to the words used in a deployment domain, for faster inference.
+Only the rows of the kept words remain in the embedding and the output layer (decoder2vocab), the pruned words are re-indexed
+    after the new vocab_size thus treated as OOVs, which can still be generated by copying from the source (-copy_attention).
+The test datasets are re-indexed with the pruned vocab too. Takes the same options as predict.py, e.g.
+    python prune_vocab.py -data_path_prefix data/kp20k/kp20k -vocab_path data/kp20k/kp20k.vocab.pt -exp kp20k -copy_attention -train_from exp/.../xxx.model
+        -prune_corpus domain.txt -prune_min_freq 2 -prune_output_prefix exp/kp20k.pruned -prune_benchmark
+The pruned checkpoint is saved to [prefix]/model/[exp].model along with its [exp].initial.config (the options of the original model
+    with the pruned vocab_size, shortlist_path and test_dataset_root_path), thus run the pruned model by predict.py with the same options plus
+    -train_from [prefix]/model/[exp].model -vocab_path [prefix].vocab.pt [-shortlist_path [prefix].shortlist.pt]
+"""
+import copy
+import glob
+import os
+from collections import Counter
+
+import numpy as np
+import torch
+
+import config
+import pykp
+import pykp.io
+from benchmark import TimedSequenceGenerator
+from evaluate import evaluate_beam_search
+from pykp.dataloader import load_vocab_and_datasets_for_testing
+from train import init_model
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+# the parameters indexed by word ids, (vocab_size, ...)
+VOCAB_PARAMETER_NAMES = ['embedding.weight', 'decoder2vocab.weight', 'decoder2vocab.bias']
+# <pad>, <s>, </s>, <unk> and <sep> are always kept, see pykp.io.build_vocab()
+NUM_SPECIAL_WORDS = 5
+
+
+def count_words(opt, vocab):
+    '''
+    Word frequencies of the deployment domain (-prune_corpus), tokenized as the training data. Fall back to the ones of training data
+    '''
+    if len(opt.prune_corpus) == 0:
+        return Counter(vocab)
+
+    word_counter = Counter()
+    for corpus_path in opt.prune_corpus:
+        with open(corpus_path, 'r') as corpus_file:
+            for line in corpus_file:
+                word_counter.update(pykp.io.copyseq_tokenize(line.lower() if opt.lower else line))
+    return word_counter
+
+
+def prune_vocab(id2word, vocab_size, word_counter, min_freq):
+    '''
+    :return:
+        kept_ids    : the (old) ids of the kept words, in the order of frequency in training data as the original vocab
+        word2id, id2word: the kept words are indexed first, followed by all the others (pruned or out of the original vocab_size) in the original order,
+                            thus the words with id >= len(kept_ids) are OOVs to the pruned model
+    '''
+    kept_ids = [word_id for word_id in range(vocab_size) if word_id < NUM_SPECIAL_WORDS or word_counter[id2word[word_id]] >= min_freq]
+    kept_id_set = set(kept_ids)
+    new_order = kept_ids + [word_id for word_id in sorted(id2word.keys()) if word_id not in kept_id_set]
+
+    new_id2word = dict([(new_id, id2word[old_id]) for new_id, old_id in enumerate(new_order)])
+    new_word2id = dict([(word, new_id) for new_id, word in new_id2word.items()])
+    return kept_ids, new_word2id, new_id2word
+
+
+def prune_checkpoint(state_dict, kept_ids):
+    '''
+    Keep the rows of kept words in the parameters indexed by word ids
+    '''
+    for name in VOCAB_PARAMETER_NAMES:
+        if name in state_dict:
+            state_dict[name] = state_dict[name].index_select(0, torch.LongTensor(kept_ids).to(state_dict[name].device)).clone()
+    return state_dict
+
+
+def export_datasets(dataset_names, dataset_root_path, output_root_path, word2id, id2word, opt):
+    '''
+    Re-index the one2many datasets (with original texts) with the pruned vocab
+    '''
+    for dataset_name in dataset_names:
+        if not os.path.exists(os.path.join(output_root_path, dataset_name)):
+            os.makedirs(os.path.join(output_root_path, dataset_name))
+        for dataset_path in glob.glob(os.path.join(dataset_root_path, dataset_name, '%s.*.one2many.pt' % dataset_name)):
+            examples = torch.load(dataset_path, 'rb')
+            tokenized_pairs = [(e['src_str'], e['trg_str']) for e in examples]
+            examples = pykp.io.process_data_examples(tokenized_pairs, word2id, id2word, opt, mode='one2many', include_original=True)
+            torch.save(examples, open(os.path.join(output_root_path, dataset_name, os.path.basename(dataset_path)), 'wb'))
+
+
+def benchmark(opt, title, logger):
+    '''
+    Decode the test datasets with the model of opt
+    :return: a list of (title, dataset, ms/doc, F1@5, F1@10)
+    '''
+    test_data_loaders, word2id, id2word, vocab = load_vocab_and_datasets_for_testing(dataset_names=opt.test_dataset_names, type='test', opt=opt)
+    opt.word2id = word2id
+    opt.id2word = id2word
+    opt.vocab = vocab
+
+    model = init_model(opt)
+    model.eval()
+    shortlist = torch.load(open(opt.shortlist_path, 'rb')) if opt.shortlist_path else None
+    generator = TimedSequenceGenerator(model,
+                                       eos_id=opt.word2id[pykp.io.EOS_WORD],
+                                       beam_size=opt.beam_size,
+                                       max_sequence_length=opt.max_sent_length,
+                                       n_best=opt.n_best,
+                                       dedup=opt.beam_dedup,
+                                       block_ngram=opt.beam_block_ngram,
+                                       shortlist=shortlist
+                                       )
+
+    results = []
+    for dataset_name, data_loader in zip(opt.test_dataset_names, test_data_loaders):
+        logger.info('Benchmarking the %s model on %s' % (title, dataset_name))
+        generator.batch_times = []
+        generator.batch_sizes = []
+        score_dict = evaluate_beam_search(generator, data_loader, opt,
+                                          title='prune_vocab.%s.%s' % (title, dataset_name),
+                                          predict_save_path=os.path.join(opt.pred_path, 'prune_vocab', title, dataset_name))
+        results.append((title, dataset_name, np.sum(generator.batch_times) * 1000. / max(np.sum(generator.batch_sizes), 1),
+                        np.average(score_dict['f_score@5_exact']), np.average(score_dict['f_score@10_exact'])))
+
+        # empty dataset to free memory
+        data_loader.dataset.offload_dataset()
+
+    return results
+
+
+def main():
+    opt = config.init_opt(description='prune_vocab.py')
+    logger = config.init_logging('prune_vocab', opt.exp_path + '/prune_vocab.log', redirect_to_stdout=True)
+
+    if not opt.train_from or not opt.prune_output_prefix:
+        logger.error('Please specify the checkpoint to prune by -train_from and the output by -prune_output_prefix')
+        return
+    if opt.output_layer == 'adaptive':
+        logger.error('The clusters of adaptive softmax are fixed on the original vocab, it can not be pruned')
+        return
+
+    word2id, id2word, vocab = torch.load(opt.vocab_path, 'rb')
+    opt.vocab_size = min(opt.vocab_size, len(vocab))
+
+    word_counter = count_words(opt, vocab)
+    kept_ids, new_word2id, new_id2word = prune_vocab(id2word, opt.vocab_size, word_counter, opt.prune_min_freq)
+    logger.info('Pruned the vocab from %d to %d words (min frequency=%d in %s)'
+                % (opt.vocab_size, len(kept_ids), opt.prune_min_freq, ', '.join(opt.prune_corpus) if opt.prune_corpus else 'training data'))
+
+    pruned_opt = copy.copy(opt)
+    pruned_opt.vocab_size = len(kept_ids)
+    pruned_opt.vocab_path = opt.prune_output_prefix + '.vocab.pt'
+    # config.init_opt() restores the options of a checkpoint from the [exp].initial.config in the same model/ directory
+    pruned_model_path = os.path.join(opt.prune_output_prefix, 'model')
+    if not os.path.exists(pruned_model_path):
+        os.makedirs(pruned_model_path)
+    pruned_opt.train_from = os.path.join(pruned_model_path, opt.exp + '.model')
+    pruned_opt.test_dataset_root_path = opt.prune_output_prefix + '.data'
+
+    state_dict = torch.load(open(opt.train_from, 'rb'), map_location=lambda storage, loc: storage)
+    torch.save(prune_checkpoint(state_dict, kept_ids), open(pruned_opt.train_from, 'wb'))
+    torch.save([new_word2id, new_id2word, vocab], open(pruned_opt.vocab_path, 'wb'))
+    logger.info('Saved the pruned checkpoint to %s and the vocab to %s' % (pruned_opt.train_from, pruned_opt.vocab_path))
+
+    if opt.shortlist_path:
+        # the shortlist is a list of word ids
+        shortlist = torch.load(open(opt.shortlist_path, 'rb'))
+        pruned_opt.shortlist_path = opt.prune_output_prefix + '.shortlist.pt'
+        torch.save([new_word2id[id2word[word_id]] for word_id in shortlist if new_word2id[id2word[word_id]] < pruned_opt.vocab_size],
+                   open(pruned_opt.shortlist_path, 'wb'))
+        logger.info('Saved the pruned shortlist to %s' % pruned_opt.shortlist_path)
+
+    torch.save(pruned_opt, open(os.path.join(pruned_model_path, opt.exp + '.initial.config'), 'wb'))
+    logger.info('Saved the options of the pruned model to %s' % os.path.join(pruned_model_path, opt.exp + '.initial.config'))
+
+    export_datasets(opt.test_dataset_names, opt.test_dataset_root_path, pruned_opt.test_dataset_root_path, new_word2id, new_id2word, pruned_opt)
+    logger.info('Saved the test datasets indexed with the pruned vocab to %s' % pruned_opt.test_dataset_root_path)
+
+    if not opt.prune_benchmark:
+        return
+
+    results = benchmark(opt, 'original', logger) + benchmark(pruned_opt, 'pruned', logger)
+    logger.info('======================  Vocab Pruning Results  =========================')
+    logger.info('%-10s %-14s %12s %8s %8s' % ('model', 'dataset', 'ms/doc', 'F1@5', 'F1@10'))
+    for result in results:
+        logger.info('%-10s %-14s %12.2f %8.4f %8.4f' % result)
+    num_datasets = len(opt.test_dataset_names)
+    for original, pruned in zip(results[:num_datasets], results[num_datasets:]):
+        logger.info('%-14s speedup=%.2fx, delta F1@5=%+.4f, delta F1@10=%+.4f'
+                    % (original[1], original[2] / max(pruned[2], 1e-8), pruned[3] - original[3], pruned[4] - original[4]))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@
 Large chunk borrowed from PyTorch DataLoader
 """
 
+import logging
 import os
 
 __author__ = "Rui Meng"
@@ -276,8 +277,8 @@ class KeyphraseDataLoader(object):
         sampler (Sampler, optional): defines the strategy to draw samples from
             the dataset. If specified, ``shuffle`` must be False.
         batch_sampler (Sampler, optional): like sampler, but returns a batch of
-            indices at a time. Mutually exclusive with batch_size, shuffle,
-            sampler, and drop_last.
+            indices at a time (e.g. MemoryBudgetBatchSampler). Mutually exclusive with shuffle,
+            sampler, and drop_last, max_batch_example and max_batch_pair are ignored.
         num_workers (int, optional): how many subprocesses to use for data
             loading. 0 means that the data will be loaded in the main process
             (default: 0)
@@ -303,9 +304,9 @@ class KeyphraseDataLoader(object):
         self.drop_last          = drop_last
 
         if batch_sampler is not None:
-            if max_batch_pair > 1 or shuffle or sampler is not None or drop_last:
+            if shuffle or sampler is not None or drop_last:
                 raise ValueError('batch_sampler is mutually exclusive with '
-                                 'batch_size, shuffle, sampler, and drop_last')
+                                 'shuffle, sampler, and drop_last')
 
         if sampler is not None and shuffle:
             raise ValueError('sampler is mutually exclusive with shuffle')
@@ -317,7 +318,7 @@ class KeyphraseDataLoader(object):
                 else:
                     sampler = SequentialSampler(dataset)
 
-        batch_sampler = One2ManyBatchSampler(sampler, self.num_trgs, max_batch_example=max_batch_example, max_batch_pair=max_batch_pair, drop_last=drop_last)
+            batch_sampler = One2ManyBatchSampler(sampler, self.num_trgs, max_batch_example=max_batch_example, max_batch_pair=max_batch_pair, drop_last=drop_last)
 
         self.sampler = sampler
         self.batch_sampler = batch_sampler
@@ -390,3 +391,138 @@ class One2ManyBatchSampler(object):
     def __len__(self):
         return self.final_num_batch
 
+
+def estimate_beam_search_memory(num_examples, src_len, max_oov_number, opt):
+    '''
+    A rough estimate of the activation memory (bytes in float32) of beam search on a batch of examples, not including the model parameters.
+        The hypotheses of all the examples (num_examples * beam_size rows) are decoded together and each row carries a copy of
+        the source context (see SequenceGenerator.sequence_to_batch()) and its attention, plus the output distribution over the (extended) vocab
+    :param src_len: the padded source length of the batch, with <s> and </s>
+    :param max_oov_number: the maximum number of oov words of the examples
+    '''
+    ctx_dim = opt.rnn_size * (2 if opt.bidirectional else 1)
+    num_attention_layers = 2 if opt.copy_attention and not opt.reuse_copy_attn else 1
+    num_rows = num_examples * opt.beam_size
+
+    # context, mask and src_oov (int64) of each row, plus the projected context, logits and weights of each attention layer
+    row_per_position = ctx_dim + 3 + num_attention_layers * (opt.rnn_size + 2)
+    # logits, log-probs and the merged probs with copying
+    row_output = 3 * (opt.vocab_size + max_oov_number)
+    # embeddings, states and gates of the encoder
+    encoder = num_examples * src_len * (opt.word_vec_size + 5 * ctx_dim)
+
+    return 4 * (num_rows * (src_len * row_per_position + row_output) + encoder)
+
+
+class MemoryBudgetBatchSampler(object):
+    """
+    Pack examples into beam search batches of which the estimated memory (by estimate_beam_search_memory()) is under a budget,
+        thus short documents are decoded in large batches and long ones in small batches.
+    The examples are visited in the order of sampler, an example over the budget by itself forms a batch.
+
+    Args:
+        sampler (Sampler): Base sampler.
+        src_lens (list of int): Source length of each example, with <s> and </s>
+        oov_numbers (list of int): Number of oov words of each example
+        memory_budget (int): Maximum estimated bytes of a batch
+    """
+
+    def __init__(self, sampler, src_lens, oov_numbers, memory_budget, opt):
+        batches = []
+        batch = []
+        max_src_len, max_oov_number = 0, 0
+        for idx in sampler:
+            batch_src_len = max(max_src_len, src_lens[idx])
+            batch_oov_number = max(max_oov_number, oov_numbers[idx])
+            if len(batch) > 0 and estimate_beam_search_memory(len(batch) + 1, batch_src_len, batch_oov_number, opt) > memory_budget:
+                batches.append(batch)
+                batch = []
+                batch_src_len, batch_oov_number = src_lens[idx], oov_numbers[idx]
+            batch.append(idx)
+            max_src_len, max_oov_number = batch_src_len, batch_oov_number
+
+        if len(batch) > 0:
+            batches.append(batch)
+
+        self.batches         = batches
+        self.final_num_batch = len(batches)
+
+    def __iter__(self):
+        return self.batches.__iter__()
+
+    def __len__(self):
+        return self.final_num_batch
+
+
+def build_beam_search_batch_sampler(dataset, opt):
+    '''
+    :return: a MemoryBudgetBatchSampler of dataset if -beam_search_memory_mb is set, otherwise None (batches are limited by the numbers of examples and targets)
+    '''
+    if opt.beam_search_memory_mb <= 0:
+        return None
+    examples = dataset.get_examples()
+    # collate_fn_one2many() adds <s> and </s> and truncates the sources to 1000 words
+    src_lens = [min(len(e['src']) + 2, 1000) for e in examples]
+    oov_numbers = [len(e['oov_list']) for e in examples]
+    batch_sampler = MemoryBudgetBatchSampler(SequentialSampler(dataset), src_lens, oov_numbers, opt.beam_search_memory_mb * 1024 * 1024, opt)
+    logging.getLogger().info('Packed %d examples into %d beam search batches under %d MB, #(average examples/batch)=%.3f'
+                             % (len(examples), len(batch_sampler), opt.beam_search_memory_mb, len(examples) / max(len(batch_sampler), 1)))
+    return batch_sampler
+
+
+def load_vocab_and_datasets_for_testing(dataset_names, type, opt):
+    '''
+    Load additional datasets from disk
+    For now seven datasets are included: 'inspec', 'nus', 'semeval', 'krapivin', 'kp20k', 'duc', 'stackexchange'
+     Only 'kp20k', 'stackexchange' provide train/valid/test data.
+     The others have only train/test, and the train is mostly used for validation.
+    :param type:
+    :param opt:
+    :return:
+    '''
+    assert type == 'test' or type == 'valid'
+    from pykp.io import KeyphraseDataset
+    logger = logging.getLogger()
+
+    logger.info("Loading vocab from disk: %s" % (opt.vocab_path))
+    word2id, id2word, vocab = torch.load(opt.vocab_path, 'rb')
+    logger.info('#(vocab)=%d' % len(vocab))
+
+    pin_memory = torch.cuda.is_available()
+    one2many_loaders = []
+
+    for dataset_name in dataset_names:
+        logger.info("Loading test dataset %s" % dataset_name)
+        if type == 'test':
+            dataset_path = os.path.join(opt.test_dataset_root_path, dataset_name, dataset_name + '.test.one2many.pt')
+        elif type == 'valid' and dataset_name in ['kp20k', 'stackexchange', 'twacg']:
+            dataset_path = os.path.join(opt.test_dataset_root_path, dataset_name, dataset_name + '.valid.one2many.pt')
+        elif type == 'valid' and dataset_name in ['inspec', 'nus', 'semeval', 'krapivin', 'duc']:
+            dataset_path = os.path.join(opt.test_dataset_root_path, dataset_name, dataset_name + '.train.one2many.pt')
+        else:
+            raise Exception('Unsupported dataset: %s, type=%s' % (dataset_name, type))
+
+        one2many_dataset = KeyphraseDataset(dataset_path,
+                                            word2id=word2id,
+                                            id2word=id2word,
+                                            type='one2many',
+                                            include_original=True,
+                                            lazy_load=True)
+        one2many_loader = KeyphraseDataLoader(dataset=one2many_dataset,
+                                              collate_fn=one2many_dataset.collate_fn_one2many,
+                                              num_workers=opt.batch_workers,
+                                              max_batch_example=opt.beam_search_batch_example,
+                                              max_batch_pair=opt.beam_search_batch_size,
+                                              batch_sampler=build_beam_search_batch_sampler(one2many_dataset, opt),
+                                              pin_memory=pin_memory,
+                                              shuffle=False)
+
+        one2many_loaders.append(one2many_loader)
+
+        logger.info('#(%s data size:  #(one2many pair)=%d, #(one2one pair)=%d, #(batch)=%d' %
+                    (type, len(one2many_loader.dataset),
+                     one2many_loader.one2one_number(),
+                     len(one2many_loader)))
+        logger.info('*' * 50)
+
+    return one2many_loaders, word2id, id2word, vocab
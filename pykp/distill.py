@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Word-level knowledge distillation (Hinton et al. 2015, Kim and Rush 2016): a small student Seq2SeqLSTMAttention is trained
+to the per-word distributions of a big teacher, instead of the ground-truth only.
+The teacher's top-k predictions are cached to disk by SoftTargetCache, thus the teacher runs once per example rather than every epoch.
+"""
+import hashlib
+import logging
+import os
+
+import numpy as np
+import torch
+
+import pykp
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+
+class SoftTargetCache(object):
+    '''
+    Top-k soft targets of the teacher for the one2one examples: the ids (int32) and probs (float16) of the top-k predictions of each non-padding target word.
+    The examples are keyed by a 64-bit hash of their source and target ids (the batches are shuffled every epoch),
+        and the soft targets of all the examples are stored in two (num_words, topk) arrays, each example takes a slice of them.
+    '''
+    def __init__(self, path, topk):
+        self.path = path
+        self.topk = topk
+        self.index = {}  # key -> (offset, length) in self.ids and self.probs
+        self.ids = np.zeros((1024, topk), dtype=np.int32)
+        self.probs = np.zeros((1024, topk), dtype=np.float16)
+        self.size = 0
+        self.modified = False
+
+        if path and os.path.exists(path):
+            self.load()
+
+    @staticmethod
+    def example_key(src, trg):
+        '''
+        :param src: the source ids of an example (without paddings), in extended vocab
+        :param trg: the target ids of an example (without paddings), in extended vocab
+        '''
+        digest = hashlib.md5(np.asarray(src, dtype=np.int32).tobytes() + b'|' + np.asarray(trg, dtype=np.int32).tobytes()).digest()
+        return int.from_bytes(digest[:8], 'little', signed=True)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, key):
+        '''
+        :return: ids and probs, both are (num_target_words, topk)
+        '''
+        offset, length = self.index[key]
+        return self.ids[offset: offset + length], self.probs[offset: offset + length]
+
+    def put(self, key, ids, probs):
+        length = len(ids)
+        if self.size + length > len(self.ids):
+            capacity = max(2 * len(self.ids), self.size + length)
+            self.ids = np.resize(self.ids, (capacity, self.topk))
+            self.probs = np.resize(self.probs, (capacity, self.topk))
+        self.ids[self.size: self.size + length] = ids
+        self.probs[self.size: self.size + length] = probs
+        self.index[key] = (self.size, length)
+        self.size += length
+        self.modified = True
+
+    def save(self):
+        if not self.path or not self.modified:
+            return
+        keys = list(self.index.keys())
+        torch.save({'topk': self.topk,
+                    'keys': torch.LongTensor(keys),
+                    'offsets': torch.LongTensor([self.index[key][0] for key in keys]),
+                    'lengths': torch.LongTensor([self.index[key][1] for key in keys]),
+                    'ids': torch.from_numpy(self.ids[:self.size]),
+                    'probs': torch.from_numpy(self.probs[:self.size])},
+                   open(self.path, 'wb'))
+        self.modified = False
+        logging.info('Saved the soft targets of %d examples (%d words) to %s' % (len(self.index), self.size, self.path))
+
+    def load(self):
+        cache = torch.load(open(self.path, 'rb'))
+        assert cache['topk'] == self.topk, 'The cache %s stores top-%d soft targets, but -distill_topk=%d' % (self.path, cache['topk'], self.topk)
+        self.ids = cache['ids'].numpy()
+        self.probs = cache['probs'].numpy()
+        self.size = len(self.ids)
+        self.index = dict(zip(cache['keys'].tolist(), zip(cache['offsets'].tolist(), cache['lengths'].tolist())))
+        logging.info('Loaded the soft targets of %d examples (%d words) from %s' % (len(self.index), self.size, self.path))
+
+
+class Distiller(object):
+    '''
+    Build the targets of the student for a one2one batch: the mixture of the ground-truth (weight 1 - alpha)
+        and the teacher's top-k distribution renormalized over the k words (weight alpha) of each target word.
+    The student is trained on the data preprocessed with its own -vocab_size, which can be smaller than the teacher's.
+        The inputs of the teacher are mapped to its vocab on the fly, and its predictions are mapped back to the (extended) vocab of the student.
+        Predicted words out of the student's vocab are merged to <unk>, unless they are in the source (copied by their oov index).
+    '''
+    def __init__(self, teacher, cache, opt, teacher_opt):
+        self.teacher = teacher
+        self.cache = cache
+        self.topk = cache.topk
+        self.alpha = opt.distill_alpha
+        self.word2id = opt.word2id
+        self.student_vocab_size = opt.vocab_size
+        self.teacher_vocab_size = teacher_opt.vocab_size
+        self.student_copy = opt.copy_attention
+        self.teacher_copy = teacher_opt.copy_attention
+        self.pad_id = opt.word2id[pykp.io.PAD_WORD]
+        self.unk_id = opt.word2id[pykp.io.UNK_WORD]
+        assert self.student_vocab_size <= self.teacher_vocab_size, 'The vocab of the student (%d) must be a subset of the teacher\'s (%d)' \
+                                                                   % (self.student_vocab_size, self.teacher_vocab_size)
+
+    def soft_targets(self, one2one_batch):
+        '''
+        :return: (target_ids, target_weights), both are (batch_size, trg_len - 1, topk + 1), the first one is the ground-truth. On CPU
+        '''
+        src, src_len, trg, trg_target, trg_copy_target, src_oov, oov_lists = one2one_batch
+        targets = trg_copy_target if self.student_copy else trg_target
+
+        # the batches are shuffled every epoch, thus the keys must not depend on the paddings of the batch
+        keys = [self.cache.example_key(src_oov[i, :src_len[i]].numpy(), trg_copy_target[i][trg_copy_target[i].ne(self.pad_id)].numpy())
+                for i in range(len(src_len))]
+        missing = [i for i, key in enumerate(keys) if key not in self.cache]
+        if len(missing) > 0:
+            self.run_teacher(one2one_batch, missing, [keys[i] for i in missing])
+
+        batch_size, trg_len = targets.size()
+        teacher_ids = torch.LongTensor(batch_size, trg_len, self.topk).fill_(self.pad_id)
+        teacher_probs = torch.zeros(batch_size, trg_len, self.topk)
+        for i, key in enumerate(keys):
+            ids, probs = self.cache.get(key)
+            teacher_ids[i, :len(ids)] = torch.from_numpy(ids.astype(np.int64))
+            teacher_probs[i, :len(probs)] = torch.from_numpy(probs.astype(np.float32))
+        teacher_probs = teacher_probs / teacher_probs.sum(dim=2, keepdim=True).clamp(min=1e-12)
+
+        target_ids = torch.cat([targets.unsqueeze(2), teacher_ids], dim=2)
+        target_weights = torch.cat([torch.full((batch_size, trg_len, 1), 1.0 - self.alpha), self.alpha * teacher_probs], dim=2)
+        return target_ids, target_weights
+
+    def run_teacher(self, one2one_batch, indices, keys):
+        '''
+        Predict the top-k soft targets of the examples (indices of a batch) by the teacher and cache them
+        '''
+        src, src_len, trg, trg_target, trg_copy_target, src_oov, oov_lists = one2one_batch
+        sv, tv = self.student_vocab_size, self.teacher_vocab_size
+
+        # map the student's oov index of each example to the teacher's vocab, words in the teacher's vocab get their ids
+        #   and the others are re-indexed as the teacher's oovs
+        teacher_oov_lists, teacher_to_student = [], []
+        t_src_oov, t_copy_target = [], []
+        for i in indices:
+            student_to_teacher, teacher_oov_list = {}, []
+            for j, word in enumerate(oov_lists[i]):
+                word_id = self.word2id.get(word, tv)
+                if word_id < tv:
+                    student_to_teacher[sv + j] = word_id
+                else:
+                    student_to_teacher[sv + j] = tv + len(teacher_oov_list)
+                    teacher_oov_list.append(word)
+            teacher_oov_lists.append(teacher_oov_list)
+            teacher_to_student.append(dict([(t, s) for s, t in student_to_teacher.items()]))
+            t_src_oov.append([student_to_teacher.get(w, w) for w in src_oov[i].tolist()])
+            t_copy_target.append([student_to_teacher.get(w, w) for w in trg_copy_target[i].tolist()])
+
+        # the examples are sorted by the source length, trim the paddings of the shorter sources
+        max_src_len = max([src_len[i] for i in indices])
+        t_src_oov = torch.LongTensor(t_src_oov)[:, :max_src_len]
+        t_copy_target = torch.LongTensor(t_copy_target)
+        t_src = t_src_oov.masked_fill(t_src_oov >= tv, self.unk_id)
+        # the decoder inputs are [BOS] + targets, the words out of the student's vocab are known only if they appear in the source (copy targets)
+        index = torch.LongTensor(indices)
+        t_trg = trg.index_select(0, index).clone()
+        trg_words = t_copy_target[:, :-1].masked_fill(t_copy_target[:, :-1] >= tv, self.unk_id)
+        t_trg[:, 1: trg_words.size(1) + 1] = torch.where(t_trg[:, 1: trg_words.size(1) + 1].eq(self.pad_id), t_trg[:, 1: trg_words.size(1) + 1], trg_words)
+        t_target = t_copy_target if self.teacher_copy else t_copy_target.masked_fill(t_copy_target >= tv, self.unk_id)
+
+        if torch.cuda.is_available():
+            t_src, t_trg, t_target, t_src_oov = t_src.cuda(), t_trg.cuda(), t_target.cuda(), t_src_oov.cuda()
+
+        self.teacher.eval()
+        with torch.no_grad():
+            _, log_probs, ids = self.teacher.forward_nll(t_src, [src_len[i] for i in indices], t_trg, t_target, t_src_oov, teacher_oov_lists,
+                                                         pred_topk=self.topk)
+        log_probs, ids = log_probs.view(len(indices), -1, self.topk).cpu(), ids.view(len(indices), -1, self.topk).cpu()
+
+        # map the predictions back to the student's extended vocab, words out of it are merged to <unk>
+        student_ids = ids.masked_fill(ids >= sv, self.unk_id)
+        num_words = trg_copy_target.index_select(0, index).ne(self.pad_id).sum(dim=1).tolist()
+        for i, key in enumerate(keys):
+            if self.student_copy:
+                for teacher_id, student_id in teacher_to_student[i].items():
+                    student_ids[i].masked_fill_(ids[i].eq(teacher_id), student_id)
+            self.cache.put(key, student_ids[i, :num_words[i]].numpy().astype(np.int32), log_probs[i, :num_words[i]].exp().numpy().astype(np.float16))
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Ensemble of checkpoints (e.g. the ones saved by train.train_model at different epochs) in a single beam search.
+EnsembleModel has the same inference interface as Seq2SeqLSTMAttention (encode, init_decoder_state, generate), thus
+    beam_search.SequenceGenerator runs on it as on a single model: each batch is encoded once per model and at each step
+    the log-probs over the extended vocab (vocab_size + max_oov_number, see Seq2SeqLSTMAttention.merge_copy_probs()) are averaged.
+"""
+import torch
+import torch.nn as nn
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+
+class EnsembleModel(nn.Module):
+    '''
+    The models must share the vocab and all be copy models or not. predict.py builds all of -ensemble_checkpoints with the current model
+        options, thus the checkpoints must share them too (e.g. hidden sizes, attention, input-feeding).
+    The source contexts of the models are concatenated along the last dim, and their decoder states are concatenated as one tuple,
+        thus each hypothesis of beam search carries the states of all the models and they are split again in generate().
+    '''
+    def __init__(self, models):
+        super(EnsembleModel, self).__init__()
+        assert len(models) > 0, 'No model to ensemble'
+        assert all([model.vocab_size == models[0].vocab_size for model in models]), 'The models of an ensemble must share the vocab'
+        assert all([model.copy_attention == models[0].copy_attention for model in models]), \
+            'The models of an ensemble must all be copy models or not, otherwise the extended vocabs differ'
+        self.models = nn.ModuleList(models)
+        self.vocab_size = models[0].vocab_size
+        self.unk_word = models[0].unk_word
+        self.copy_attention = models[0].copy_attention
+        # sizes of the source context and the number of decoder states of each model, set by encode() and init_decoder_state()
+        self.context_sizes = None
+        self.state_numbers = None
+
+    def encode(self, input_src, input_src_len):
+        '''
+        :return: contexts of all the models concatenated (batch_size, src_len, sum of context_dim), and the lists of final states of each model
+        '''
+        contexts, src_hs, src_cs = [], [], []
+        for model in self.models:
+            context, (src_h, src_c) = model.encode(input_src, input_src_len)
+            contexts.append(context)
+            src_hs.append(src_h)
+            src_cs.append(src_c)
+        self.context_sizes = [context.size(2) for context in contexts]
+        return torch.cat(contexts, dim=2), (src_hs, src_cs)
+
+    def init_decoder_state(self, enc_hs, enc_cs):
+        states = [model.init_decoder_state(enc_h, enc_c) for model, enc_h, enc_c in zip(self.models, enc_hs, enc_cs)]
+        self.state_numbers = [len(state) for state in states]
+        return tuple([s for state in states for s in state])
+
+    def split_states(self, dec_hidden):
+        states, start = [], 0
+        for number in self.state_numbers:
+            states.append(tuple(dec_hidden[start: start + number]))
+            start += number
+        return states
+
+    def ids_to_candidates(self, ids, candidate_ids):
+        return self.models[0].ids_to_candidates(ids, candidate_ids)
+
+    def candidates_to_ids(self, positions, candidate_ids):
+        return self.models[0].candidates_to_ids(positions, candidate_ids)
+
+    def generate(self, trg_input, dec_hidden, enc_context, ctx_mask=None, src_map=None, oov_list=None, max_len=1, return_attention=False, vocab_ids=None):
+        '''
+        One step of all the models, see Seq2SeqLSTMAttention.generate()
+        :return: the average of the log_probs of the models (batch_size, 1, vocab_size + max_oov_number), the concatenated decoder states,
+            and the average attention weights if return_attention
+        '''
+        assert max_len == 1, 'The ensemble only decodes one step at a time'
+        contexts = torch.split(enc_context, self.context_sizes, dim=2)
+        log_probs, dec_hiddens, attentions = 0., [], []
+        for model, state, context in zip(self.models, self.split_states(dec_hidden), contexts):
+            outputs = model.generate(trg_input, state, context, ctx_mask=ctx_mask, src_map=src_map, oov_list=oov_list,
+                                     max_len=1, return_attention=return_attention, vocab_ids=vocab_ids)
+            log_probs = log_probs + outputs[0]
+            dec_hiddens.extend(outputs[1])
+            if return_attention:
+                attentions.append(outputs[2] if isinstance(outputs[2], tuple) else (outputs[2],))
+
+        log_probs = log_probs / len(self.models)
+        dec_hiddens = tuple(dec_hiddens)
+        if not return_attention:
+            return log_probs, dec_hiddens
+
+        attentions = tuple([sum(weights) / len(self.models) for weights in zip(*attentions)])
+        return log_probs, dec_hiddens, attentions if self.copy_attention else attentions[0]
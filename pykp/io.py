@@ -674,6 +674,25 @@ def build_vocab(tokenized_src_trgs_pairs, opt):
     return word2id, id2word, vocab
 
 
+def build_keyphrase_shortlist(tokenized_src_trgs_pairs, word2id, opt):
+    '''
+    Mine the most frequent words in the targets (keyphrases) of training data, used as the global shortlist for decoding
+    :return: a list of word ids (within vocab_size), sorted by frequency in targets
+    '''
+    trg_word_counter = Counter()
+    for _, trgs_tokens in tokenized_src_trgs_pairs:
+        trg_word_counter.update(itertools.chain(*trgs_tokens))
+
+    shortlist = []
+    for word, _ in trg_word_counter.most_common():
+        if len(shortlist) >= opt.shortlist_size:
+            break
+        if word in word2id and word2id[word] < opt.vocab_size:
+            shortlist.append(word2id[word])
+
+    return shortlist
+
+
 class One2OneKPDatasetOpenNMT(torchtext.data.Dataset):
     def __init__(self, src_trgs_pairs, fields,
                  src_seq_length=0, trg_seq_length=0,
@@ -2,13 +2,17 @@
 """
 Python File Template 
 """
+import copy
+import inspect
 import logging
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 import torch.nn.functional as func
 from torch.autograd import Variable
 import numpy as np
 import random
+from typing import Optional
 
 import pykp
 from pykp.eric_layers import GetMask, masked_softmax, TimeDistributedDense
@@ -33,6 +37,18 @@ def time_usage(func):
     return wrapper
 
 
+def checkpoint(function, *args, reentrant=False):
+    '''
+    torch.utils.checkpoint.checkpoint(), only keep the inputs for backward and recompute function() then.
+    Newer versions of PyTorch require use_reentrant to be explicit, which is not accepted by the early ones.
+    :param reentrant: required by the scripted functions (input_feeding_decode), the graph executor may optimize the recomputation
+        differently from the first run and save other tensors for backward, which the non-reentrant checkpoint rejects
+    '''
+    if 'use_reentrant' in inspect.signature(torch.utils.checkpoint.checkpoint).parameters:
+        return torch.utils.checkpoint.checkpoint(function, *args, use_reentrant=reentrant)
+    return torch.utils.checkpoint.checkpoint(function, *args)
+
+
 class AttentionExample(nn.Module):
     def __init__(self, hidden_size, method='concat'):
         super(AttentionExample, self).__init__()
@@ -82,6 +98,7 @@ class Attention(nn.Module):
     def __init__(self, enc_dim, trg_dim, method='general'):
         super(Attention, self).__init__()
         self.method = method
+        self.trg_dim = trg_dim
 
         if self.method == 'general':
             self.attn = nn.Linear(enc_dim, trg_dim)
@@ -138,6 +155,28 @@ class Attention(nn.Module):
 
         return energies.contiguous()
 
+    def precompute_keys(self, encoder_outputs, encoder_mask):
+        '''
+        The part of score() that doesn't depend on the decoder hiddens, computed once for all the decoding steps (see attention_step())
+        :param encoder_outputs: (batch, src_len, src_hidden_dim)
+        :return: keys (batch, src_len, trg_hidden_dim)
+        '''
+        if self.method == 'dot':
+            return encoder_outputs
+        elif self.method == 'general':
+            return self.attn(encoder_outputs) * encoder_mask.unsqueeze(2)
+        else:
+            # the inputs of concat attention are [hidden; encoder_output], split the weight into two
+            return func.linear(encoder_outputs, self.attn.mlp.weight[:, self.trg_dim:], self.attn.mlp.bias)
+
+    def step_params(self):
+        '''
+        :return: the parameters attention_step() needs besides the keys: (weight of W_c, weight of hidden in concat, weight of v, bias of v)
+        '''
+        if self.method == 'concat':
+            return self.linear_out.weight, self.attn.mlp.weight[:, :self.trg_dim], self.v.mlp.weight, self.v.mlp.bias
+        return self.linear_out.weight, None, None, None
+
     def forward(self, hidden, encoder_outputs, encoder_mask=None):
         '''
         Compute the attention and h_tilde, inputs/outputs must be batch first
@@ -223,6 +262,199 @@ class Attention(nn.Module):
         return h_tilde, attn
 
 
+@torch.jit.script
+def attention_step(query, keys, context, ctx_mask, out_weight, query_weight: Optional[torch.Tensor], v_weight: Optional[torch.Tensor], v_bias: Optional[torch.Tensor]):
+    '''
+    One step of Attention.forward() with the keys from Attention.precompute_keys(), the same numerics as masked_softmax()
+    :param query: (batch_size, trg_hidden_dim), the decoder hidden of current step
+    :param keys: (batch_size, src_len, trg_hidden_dim)
+    :param context: (batch_size, src_len, context_dim)
+    :return: h_tilde (batch_size, trg_hidden_dim), attn_weights and attn_energies (batch_size, src_len)
+    '''
+    if query_weight is None:
+        # dot and general
+        energies = torch.bmm(keys, query.unsqueeze(2)).squeeze(2)
+    else:
+        # concat
+        assert v_weight is not None
+        energies = func.linear(torch.tanh(keys + func.linear(query, query_weight).unsqueeze(1)), v_weight, v_bias).squeeze(2)
+    energies = energies * ctx_mask
+
+    x = torch.clamp(energies, min=-15.0, max=15.0) * ctx_mask
+    e_x = torch.exp(x - torch.max(x, dim=-1, keepdim=True)[0]) * ctx_mask
+    weights = e_x / (torch.sum(e_x, dim=-1, keepdim=True) + 1e-6)
+
+    weighted_context = torch.bmm(weights.unsqueeze(1), context).squeeze(1)
+    h_tilde = torch.tanh(func.linear(torch.cat((weighted_context, query), 1), out_weight))
+    return h_tilde, weights, energies
+
+
+@torch.jit.script
+def input_feeding_decode(emb_inputs, feed_weight, h, c, w_ih, w_hh, b_ih, b_hh, context, ctx_mask,
+                         keys, out_weight, query_weight: Optional[torch.Tensor], v_weight: Optional[torch.Tensor], v_bias: Optional[torch.Tensor],
+                         copy_keys: Optional[torch.Tensor], copy_out_weight: Optional[torch.Tensor], copy_query_weight: Optional[torch.Tensor], copy_v_weight: Optional[torch.Tensor], copy_v_bias: Optional[torch.Tensor],
+                         h_tilde, copy_h_tilde, input_feeding: bool, copy_input_feeding: bool):
+    '''
+    Unroll the one-layer LSTM decoder step by step with input-feeding (Luong et al. 2015), the attentional vectors of the previous step
+        are fed to the next step through dec_input_bridge: dec_input = tanh(W_b [trg_emb; h_tilde; copy_h_tilde] + b)
+    :param emb_inputs: (trg_len, batch_size, emb_dim), the word embedding part of dec_input_bridge precomputed for all steps, W_b[:, :emb_dim] trg_emb + b
+    :param feed_weight: (emb_dim, trg_hidden_dim * number of fed vectors), W_b[:, emb_dim:]
+    :param h, c: (batch_size, trg_hidden_dim), the initial state
+    :param w_ih, w_hh, b_ih, b_hh: parameters of the LSTM decoder
+    :param keys, out_weight, query_weight, v_weight, v_bias: the attention, see attention_step()
+    :param copy_keys, ...: the copy attention, only used if copy_input_feeding. copy_keys=None means copy attention reuses the attention
+    :param h_tilde, copy_h_tilde: (batch_size, trg_hidden_dim), the fed vectors of the first step
+    :return:
+        decoder_outputs                 : (trg_len, batch_size, trg_hidden_dim)
+        h_tildes                        : (trg_len, batch_size, trg_hidden_dim)
+        attn_weights, attn_energies     : (trg_len, batch_size, src_len)
+        copy_weights, copy_energies     : (trg_len, batch_size, src_len), empty if not copy_input_feeding or the attention is reused
+        h, c, h_tilde, copy_h_tilde     : (batch_size, trg_hidden_dim), the states of last step
+    '''
+    trg_len, batch_size = emb_inputs.size(0), emb_inputs.size(1)
+    hidden_dim = h.size(1)
+    src_len = context.size(1)
+    copy_in_loop = copy_input_feeding and copy_keys is not None
+
+    # output buffers are allocated once and filled step by step
+    decoder_outputs = h.new_empty(trg_len, batch_size, hidden_dim)
+    h_tildes = h.new_empty(trg_len, batch_size, hidden_dim)
+    attn_weights = h.new_empty(trg_len, batch_size, src_len)
+    attn_energies = h.new_empty(trg_len, batch_size, src_len)
+    copy_weights = h.new_empty(trg_len if copy_in_loop else 0, batch_size, src_len)
+    copy_energies = h.new_empty(trg_len if copy_in_loop else 0, batch_size, src_len)
+
+    for t in range(trg_len):
+        if input_feeding and copy_input_feeding:
+            fed = torch.cat((h_tilde, copy_h_tilde), 1)
+        elif input_feeding:
+            fed = h_tilde
+        else:
+            fed = copy_h_tilde
+        dec_input = torch.tanh(emb_inputs[t] + func.linear(fed, feed_weight))
+
+        # LSTM cell, gates are in the order of nn.LSTM (input, forget, cell, output)
+        gates = func.linear(dec_input, w_ih, b_ih) + func.linear(h, w_hh, b_hh)
+        in_gate, forget_gate, cell_gate, out_gate = gates.chunk(4, 1)
+        c = torch.sigmoid(forget_gate) * c + torch.sigmoid(in_gate) * torch.tanh(cell_gate)
+        h = torch.sigmoid(out_gate) * torch.tanh(c)
+
+        h_tilde, attn_weight, attn_energy = attention_step(h, keys, context, ctx_mask, out_weight, query_weight, v_weight, v_bias)
+        if copy_input_feeding:
+            if copy_keys is None:
+                copy_h_tilde = h_tilde
+            else:
+                assert copy_out_weight is not None
+                copy_h_tilde, copy_weight, copy_energy = attention_step(h, copy_keys, context, ctx_mask, copy_out_weight, copy_query_weight, copy_v_weight, copy_v_bias)
+                copy_weights[t] = copy_weight
+                copy_energies[t] = copy_energy
+
+        decoder_outputs[t] = h
+        h_tildes[t] = h_tilde
+        attn_weights[t] = attn_weight
+        attn_energies[t] = attn_energy
+
+    return decoder_outputs, h_tildes, attn_weights, attn_energies, copy_weights, copy_energies, h, c, h_tilde, copy_h_tilde
+
+
+class PositionalEncoding(nn.Module):
+    '''
+    Add the sinusoidal position embeddings (Vaswani et al. 2017) to the word embeddings
+    '''
+    def __init__(self, dim, max_len=5000):
+        super(PositionalEncoding, self).__init__()
+        position = torch.arange(0, max_len).float().unsqueeze(1)
+        div_term = torch.exp(torch.arange(0, dim, 2).float() * -(np.log(10000.0) / dim))
+        pe = torch.zeros(max_len, dim)
+        pe[:, 0::2] = torch.sin(position * div_term)
+        pe[:, 1::2] = torch.cos(position * div_term)[:, :dim // 2]
+        self.register_buffer('pe', pe.unsqueeze(0))
+
+    def forward(self, emb):
+        # emb (batch_size, src_len, dim)
+        return emb + self.pe[:, :emb.size(1)]
+
+
+class SelfAttentionEncoder(nn.Module):
+    '''
+    Transformer encoder (Vaswani et al. 2017), all the source positions are encoded in parallel.
+    It's a replacement of the LSTM encoder: the contexts are in the same dim of LSTM outputs (src_hidden_dim * num_directions),
+        and the final states for initializing decoder are the mean of contexts over the non-padding words.
+    '''
+    def __init__(self, emb_dim, hidden_dim, num_layers, heads, ff_dim, dropout):
+        super(SelfAttentionEncoder, self).__init__()
+        assert hidden_dim % heads == 0, 'The dim of contexts (%d) must be divisible by the number of heads (%d)' % (hidden_dim, heads)
+        self.input_proj = nn.Linear(emb_dim, hidden_dim) if emb_dim != hidden_dim else nn.Identity()
+        self.position_encoding = PositionalEncoding(hidden_dim)
+        self.dropout = nn.Dropout(dropout)
+        self.layers = nn.ModuleList([nn.TransformerEncoderLayer(hidden_dim, heads, ff_dim, dropout, batch_first=True) for _ in range(num_layers)])
+
+    def forward(self, src_emb, src_mask):
+        '''
+        :param src_emb: (batch_size, src_len, emb_dim)
+        :param src_mask: (batch_size, src_len), 1 for words and 0 for paddings
+        :return:
+            context: (batch_size, src_len, hidden_dim), zeros on the paddings as the outputs of pad_packed_sequence()
+            (h_t, c_t): (batch_size, hidden_dim), both are the masked mean pooling of context
+        '''
+        context = self.dropout(self.position_encoding(self.input_proj(src_emb)))
+        padding_mask = src_mask.eq(0)
+        for layer in self.layers:
+            context = layer(context, src_key_padding_mask=padding_mask)
+        context = context * src_mask.unsqueeze(-1)
+
+        pooled = context.sum(1) / src_mask.sum(1, keepdim=True).clamp(min=1)
+        return context, (pooled, pooled)
+
+
+class QuantizedEmbedding(nn.Module):
+    '''
+    An embedding table stored in int8 with a float scale of each row (symmetric quantization), only for inference.
+    It takes 1/4 of the memory of the fp32 nn.Embedding and the rows are dequantized after lookup.
+    '''
+    def __init__(self, num_embeddings, embedding_dim, padding_idx=None):
+        super(QuantizedEmbedding, self).__init__()
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.padding_idx = padding_idx
+        self.register_buffer('weight_int8', torch.zeros(num_embeddings, embedding_dim).char())
+        self.register_buffer('scale', torch.ones(num_embeddings))
+
+    @classmethod
+    def from_float(cls, embedding):
+        weight = embedding.weight.data.float()
+        quantized = cls(embedding.num_embeddings, embedding.embedding_dim, embedding.padding_idx)
+        scale = weight.abs().max(dim=1)[0] / 127.
+        scale[scale == 0] = 1.
+        quantized.weight_int8.copy_(torch.round(weight / scale.unsqueeze(1)).clamp(-127, 127).char())
+        quantized.scale.copy_(scale)
+        return quantized
+
+    def forward(self, input):
+        return self.weight_int8[input].float() * self.scale[input].unsqueeze(-1)
+
+
+def quantize_model(model):
+    '''
+    Return a copy of model for int8 inference on CPU: dynamic quantization (int8 weights, activations are quantized on the fly) of
+        nn.LSTM and nn.Linear layers (encoder/decoder, attentions and decoder2vocab), plus an int8 embedding table.
+    The returned model can only be used for inference, e.g. beam search.
+    '''
+    model = copy.deepcopy(model).cpu().eval()
+    model.embedding = QuantizedEmbedding.from_float(model.embedding)
+    # nn.TransformerEncoderLayer reads the weights of its Linear layers directly, thus the self-attention encoder is kept in fp32
+    encoder = model.encoder if model.encoder_type == 'transformer' else None
+    if encoder is not None:
+        model.encoder = None
+    model = torch.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+    if encoder is not None:
+        model.encoder = encoder
+    # buffers of merging copy probs are not valid for the new model
+    model._oov_logits_cache = None
+    model._extended_logits_buffer = None
+    return model
+
+
 class Seq2SeqLSTMAttention(nn.Module):
     """Container module with an encoder, deocder, embeddings."""
 
@@ -279,14 +511,25 @@ class Seq2SeqLSTMAttention(nn.Module):
             self.pad_token_src
         )
 
-        self.encoder = nn.LSTM(
-            input_size=self.emb_dim,
-            hidden_size=self.src_hidden_dim,
-            num_layers=self.nlayers_src,
-            bidirectional=self.bidirectional,
-            batch_first=True,
-            dropout=self.dropout
-        )
+        self.encoder_type = opt.encoder_type
+        if self.encoder_type == 'transformer':
+            self.encoder = SelfAttentionEncoder(
+                emb_dim=self.emb_dim,
+                hidden_dim=self.src_hidden_dim * self.num_directions,
+                num_layers=self.nlayers_src,
+                heads=opt.heads,
+                ff_dim=opt.transformer_ff,
+                dropout=self.dropout
+            )
+        else:
+            self.encoder = nn.LSTM(
+                input_size=self.emb_dim,
+                hidden_size=self.src_hidden_dim,
+                num_layers=self.nlayers_src,
+                bidirectional=self.bidirectional,
+                batch_first=True,
+                dropout=self.dropout
+            )
 
         self.decoder = nn.LSTM(
             input_size=self.emb_dim,
@@ -309,7 +552,32 @@ class Seq2SeqLSTMAttention(nn.Module):
             self.trg_hidden_dim
         )
 
-        self.decoder2vocab = nn.Linear(self.trg_hidden_dim, self.vocab_size)
+        # output layer: 'softmax' is the full linear projection, 'adaptive' is the adaptive softmax (Grave et al.) with clusters on the frequency-sorted ids,
+        #   'sampled' shares the full projection but only computes logits of a sampled candidate list in training (Jean et al.)
+        self.output_layer = opt.output_layer
+        self.sampled_softmax_size = opt.sampled_softmax_size
+        self.checkpoint_activation_blocks = opt.checkpoint_activations
+        # the encoder and decoder always share self.embedding, thus -share_embeddings is satisfied already
+        self.share_decoder_embeddings = opt.share_decoder_embeddings
+        assert not (self.share_decoder_embeddings and self.output_layer == 'adaptive'), 'Adaptive softmax can not share the word embeddings'
+        if self.output_layer == 'adaptive':
+            cutoffs = [cutoff for cutoff in sorted(opt.adaptive_cutoffs) if 0 < cutoff < self.vocab_size]
+            logging.info("Applying adaptive softmax, cutoffs=%s" % str(cutoffs))
+            self.decoder2vocab = nn.AdaptiveLogSoftmaxWithLoss(self.trg_hidden_dim, self.vocab_size, cutoffs=cutoffs, div_value=opt.adaptive_div_value, head_bias=True)
+        else:
+            if self.output_layer == 'sampled':
+                logging.info("Applying sampled softmax in training, number of samples=%d" % self.sampled_softmax_size)
+            if self.share_decoder_embeddings:
+                # tie the output layer with the word embeddings (Press and Wolf 2017), h_tilde is projected to emb_dim first if the sizes differ
+                logging.info("Sharing the word embeddings with the output layer")
+                self.decoder2vocab = nn.Linear(self.emb_dim, self.vocab_size)
+                self.decoder2vocab.weight = self.embedding.weight
+            else:
+                self.decoder2vocab = nn.Linear(self.trg_hidden_dim, self.vocab_size)
+        if self.share_decoder_embeddings and self.trg_hidden_dim != self.emb_dim:
+            self.decoder2emb = nn.Linear(self.trg_hidden_dim, self.emb_dim, bias=False)
+        else:
+            self.decoder2emb = None
 
         # copy attention
         if self.copy_attention:
@@ -340,6 +608,10 @@ class Seq2SeqLSTMAttention(nn.Module):
         else:
             self.dec_input_bridge = nn.Linear(self.dec_input_dim, self.emb_dim)
 
+        # caches for merging copy probs, not parameters and not saved in state_dict
+        self._oov_logits_cache = None
+        self._extended_logits_buffer = None
+
         self.init_weights()
 
     def init_weights(self):
@@ -350,7 +622,8 @@ class Seq2SeqLSTMAttention(nn.Module):
         # self.embedding.weight.data.fill_(0.01)
         self.encoder2decoder_hidden.bias.data.fill_(0)
         self.encoder2decoder_cell.bias.data.fill_(0)
-        self.decoder2vocab.bias.data.fill_(0)
+        if isinstance(self.decoder2vocab, nn.Linear):
+            self.decoder2vocab.bias.data.fill_(0)
 
     def init_encoder_state(self, input):
         """Get cell states and hidden states."""
@@ -379,8 +652,21 @@ class Seq2SeqLSTMAttention(nn.Module):
         decoder_init_hidden = nn.Tanh()(self.encoder2decoder_hidden(enc_h)).unsqueeze(0)
         decoder_init_cell = nn.Tanh()(self.encoder2decoder_cell(enc_c)).unsqueeze(0)
 
+        # with input-feeding, the attentional vectors (h_tilde, copy_h_tilde) of the previous step are part of the decoder state, zeros at the beginning
+        if self.input_feeding or self.copy_input_feeding:
+            return decoder_init_hidden, decoder_init_cell, torch.zeros_like(decoder_init_hidden), torch.zeros_like(decoder_init_hidden)
+
         return decoder_init_hidden, decoder_init_cell
 
+    def checkpoint_activations(self, function, *args, reentrant=False):
+        '''
+        Run function with activation checkpointing if -checkpoint_activations is set in training,
+            only the inputs are kept for backward and the intermediate activations are recomputed then
+        '''
+        if self.checkpoint_activation_blocks and self.training and torch.is_grad_enabled():
+            return checkpoint(function, *args, reentrant=reentrant)
+        return function(*args)
+
     def forward(self, input_src, input_src_len, input_trg, input_src_ext, oov_lists, trg_mask=None, ctx_mask=None):
         '''
         The differences of copy model from normal seq2seq here are:
@@ -409,20 +695,36 @@ class Seq2SeqLSTMAttention(nn.Module):
         """
         Propogate input through the network.
         """
+        if self.encoder_type == 'transformer':
+            # no packing is needed, the paddings are masked in self-attention
+            src_mask = input_src.ne(self.pad_token_src).float()
+
+            def run_transformer_encoder(src_emb):
+                src_h, (h_t, c_t) = self.encoder(src_emb, src_mask)
+                return src_h, h_t, c_t
+
+            src_h, h_t, c_t = self.checkpoint_activations(run_transformer_encoder, self.embedding(input_src))
+            return src_h, (h_t, c_t)
+
         # initial encoder state, two zero-matrix as h and c at time=0
         self.h0_encoder, self.c0_encoder = self.init_encoder_state(input_src)  # (self.encoder.num_layers * self.num_directions, batch_size, self.src_hidden_dim)
 
         # input (batch_size, src_len), src_emb (batch_size, src_len, emb_dim)
         src_emb = self.embedding(input_src)
-        src_emb = nn.utils.rnn.pack_padded_sequence(src_emb, input_src_len, batch_first=True)
 
-        # src_h (batch_size, seq_len, hidden_size * num_directions): outputs (h_t) of all the time steps
-        # src_h_t, src_c_t (num_layers * num_directions, batch, hidden_size): hidden and cell state at last time step
-        src_h, (src_h_t, src_c_t) = self.encoder(
-            src_emb, (self.h0_encoder, self.c0_encoder)
-        )
+        def run_rnn_encoder(src_emb):
+            src_emb = nn.utils.rnn.pack_padded_sequence(src_emb, input_src_len, batch_first=True)
+
+            # src_h (batch_size, seq_len, hidden_size * num_directions): outputs (h_t) of all the time steps
+            # src_h_t, src_c_t (num_layers * num_directions, batch, hidden_size): hidden and cell state at last time step
+            src_h, (src_h_t, src_c_t) = self.encoder(
+                src_emb, (self.h0_encoder, self.c0_encoder)
+            )
 
-        src_h, _ = nn.utils.rnn.pad_packed_sequence(src_h, batch_first=True)
+            src_h, _ = nn.utils.rnn.pad_packed_sequence(src_h, batch_first=True)
+            return src_h, src_h_t, src_c_t
+
+        src_h, src_h_t, src_c_t = self.checkpoint_activations(run_rnn_encoder, src_emb)
 
         # concatenate to (batch_size, hidden_size * num_directions)
         if self.bidirectional:
@@ -487,60 +789,29 @@ class Seq2SeqLSTMAttention(nn.Module):
         init_hidden = self.init_decoder_state(enc_hidden[0], enc_hidden[1])
 
         # enc_context has to be reshaped before dot attention (batch_size, src_len, context_dim) -> (batch_size, src_len, trg_hidden_dim)
-        if self.attention_layer.method == 'dot':
-            enc_context = nn.Tanh()(self.encoder2decoder_hidden(enc_context.contiguous().view(-1, context_dim))).view(batch_size, src_len, trg_hidden_dim)
-            enc_context = enc_context * ctx_mask.view(ctx_mask.size() + (1,))
+        enc_context = self.prepare_context(enc_context, ctx_mask)
 
         # maximum length to unroll, ignore the last word (must be padding)
         max_length = trg_inputs.size(1) - 1
 
         # Teacher Forcing
         self.current_batch += 1
-        # because sequence-wise training is not compatible with input-feeding, so discard it
+        # input-feeding is handled by decode_teacher_forcing() (decode_input_feeding()), the word-by-word branch below is only for sampling
         # TODO 20180722, do_word_wisely_training=True is buggy
         do_word_wisely_training = False
         if not do_word_wisely_training:
-            '''
-            Teacher Forcing
-            (1) Feedforwarding RNN
-            '''
-            # truncate the last word, as there's no further word after it for decoder to predict
-            trg_inputs = trg_inputs[:, :-1]
-
-            # initialize target embedding and reshape the targets to be time step first
-            trg_emb = self.embedding(trg_inputs)  # (batch_size, trg_len, embed_dim)
-            trg_emb = trg_emb.permute(1, 0, 2)  # (trg_len, batch_size, embed_dim)
-
-            # both in/output of decoder LSTM is batch-second (trg_len, batch_size, trg_hidden_dim)
-            decoder_outputs, dec_hidden = self.decoder(
-                trg_emb, init_hidden
-            )
-            '''
-            (2) Standard Attention
-            '''
-            # Get the h_tilde (batch_size, trg_len, trg_hidden_dim) and attention weights (batch_size, trg_len, src_len)
-            h_tildes, attn_weights, attn_logits = self.attention_layer(decoder_outputs.permute(1, 0, 2), enc_context, encoder_mask=ctx_mask)
+            h_tildes, decoder_outputs, attn_weights, copy_weights, copy_logits = self.decode_teacher_forcing(trg_inputs, enc_context, init_hidden, ctx_mask)
 
             # compute the output decode_logit and read-out as probs: p_x = Softmax(W_s * h_tilde), (batch_size, trg_len, trg_hidden_size) -> (batch_size * trg_len, vocab_size)
             # h_tildes=(batch_size, trg_len, trg_hidden_size) -> decoder2vocab(h_tildes.view)=(batch_size * trg_len, vocab_size) -> decoder_logits=(batch_size, trg_len, vocab_size)
-            decoder_logits = self.decoder2vocab(h_tildes.view(-1, trg_hidden_dim)).view(batch_size, max_length, -1)
+            decoder_logits = self.vocab_projection(h_tildes.contiguous().view(-1, trg_hidden_dim)).view(batch_size, max_length, -1)
 
-            '''
-            (3) Copy Attention
-            '''
             if self.copy_attention:
-                # copy_weights and copy_logits is (batch_size, trg_len, src_len)
-                if not self.reuse_copy_attn:
-                    _, copy_weights, copy_logits = self.copy_attention_layer(decoder_outputs.permute(1, 0, 2), enc_context, encoder_mask=ctx_mask)
-                else:
-                    copy_logits = attn_logits
-
                 # merge the generative and copying probs, (batch_size, trg_len, vocab_size + max_oov_number)
                 decoder_log_probs = self.merge_copy_probs(decoder_logits, copy_logits, src_map, oov_list)  # (batch_size, trg_len, vocab_size + max_oov_number)
                 decoder_outputs = decoder_outputs.permute(1, 0, 2)  # (batch_size, trg_len, trg_hidden_dim)
             else:
                 decoder_log_probs = torch.nn.functional.log_softmax(decoder_logits, dim=-1).view(batch_size, -1, self.vocab_size)
-                copy_weights = []
 
         else:
             '''
@@ -577,7 +848,7 @@ class Seq2SeqLSTMAttention(nn.Module):
 
                 # compute the output decode_logit and read-out as probs: p_x = Softmax(W_s * h_tilde)
                 # h_tilde=(batch_size, 1, trg_hidden_size) -> decoder2vocab(h_tilde.view)=(batch_size * 1, vocab_size) -> decoder_logit=(batch_size, 1, vocab_size)
-                decoder_logit = self.decoder2vocab(h_tilde.view(-1, trg_hidden_dim)).view(batch_size, 1, -1)
+                decoder_logit = self.vocab_projection(h_tilde.contiguous().view(-1, trg_hidden_dim)).view(batch_size, 1, -1)
 
                 '''
                 (3) Copy Attention
@@ -628,6 +899,279 @@ class Seq2SeqLSTMAttention(nn.Module):
         # Return final outputs (logits after log_softmax), hidden states, and attention weights (for visualization)
         return decoder_log_probs, decoder_outputs, attn_weights, copy_weights
 
+    def prepare_context(self, enc_context, ctx_mask):
+        '''
+        enc_context has to be reshaped before dot attention (batch_size, src_len, context_dim) -> (batch_size, src_len, trg_hidden_dim)
+        '''
+        if self.attention_layer.method == 'dot':
+            batch_size, src_len, context_dim = enc_context.size()
+            enc_context = nn.Tanh()(self.encoder2decoder_hidden(enc_context.contiguous().view(-1, context_dim))).view(batch_size, src_len, self.trg_hidden_dim)
+            enc_context = enc_context * ctx_mask.view(ctx_mask.size() + (1,))
+        return enc_context
+
+    def decode_teacher_forcing(self, trg_inputs, enc_context, init_hidden, ctx_mask):
+        '''
+        Run the decoder RNN and attentions with teacher forcing, everything before the output layer
+        :param trg_inputs: (batch_size, trg_len), the last word is truncated here as there's no further word after it for decoder to predict
+        :param enc_context: (batch_size, src_len, context_dim), has been processed by prepare_context()
+        :return:
+            h_tildes            : (batch_size, trg_len - 1, trg_hidden_dim)
+            decoder_outputs     : (trg_len - 1, batch_size, trg_hidden_dim), time step first
+            attn_weights        : (batch_size, trg_len - 1, src_len)
+            copy_weights        : (batch_size, trg_len - 1, src_len), [] if no copy attention
+            copy_logits         : (batch_size, trg_len - 1, src_len), None if no copy attention
+        '''
+        '''
+        (1) Feedforwarding RNN
+        '''
+        # truncate the last word, as there's no further word after it for decoder to predict
+        trg_inputs = trg_inputs[:, :-1]
+
+        # initialize target embedding and reshape the targets to be time step first
+        trg_emb = self.embedding(trg_inputs)  # (batch_size, trg_len, embed_dim)
+        trg_emb = trg_emb.permute(1, 0, 2)  # (trg_len, batch_size, embed_dim)
+
+        if self.input_feeding or self.copy_input_feeding:
+            return self.decode_input_feeding(trg_emb, enc_context, init_hidden, ctx_mask)
+
+        # both in/output of decoder LSTM is batch-second (trg_len, batch_size, trg_hidden_dim)
+        decoder_outputs, dec_hidden = self.decoder(
+            trg_emb, init_hidden
+        )
+        '''
+        (2) Standard Attention
+        '''
+        # Get the h_tilde (batch_size, trg_len, trg_hidden_dim) and attention weights (batch_size, trg_len, src_len)
+        h_tildes, attn_weights, attn_logits = self.checkpoint_activations(self.attention_layer, decoder_outputs.permute(1, 0, 2), enc_context, ctx_mask)
+
+        '''
+        (3) Copy Attention
+        '''
+        if self.copy_attention:
+            # copy_weights and copy_logits is (batch_size, trg_len, src_len)
+            if not self.reuse_copy_attn:
+                _, copy_weights, copy_logits = self.checkpoint_activations(self.copy_attention_layer, decoder_outputs.permute(1, 0, 2), enc_context, ctx_mask)
+            else:
+                copy_weights, copy_logits = attn_weights, attn_logits
+        else:
+            copy_weights, copy_logits = [], None
+
+        return h_tildes, decoder_outputs, attn_weights, copy_weights, copy_logits
+
+    def decode_input_feeding(self, trg_emb, enc_context, init_hidden, ctx_mask):
+        '''
+        Teacher forcing with input-feeding, the decoder has to be unrolled step by step as the inputs depend on the attention of previous step.
+        The loop is compiled with TorchScript (input_feeding_decode()), the attention keys and the embedding part of dec_input_bridge
+            are precomputed for all the steps, thus each step only runs the LSTM cell and the attention over the precomputed keys.
+        :param trg_emb: (trg_len, batch_size, embed_dim)
+        :return: same to decode_teacher_forcing()
+        '''
+        assert self.decoder.num_layers == 1, 'Input-feeding only supports a one-layer decoder'
+        ctx_mask = ctx_mask.type_as(enc_context)
+        emb_inputs = func.linear(trg_emb, self.dec_input_bridge.weight[:, :self.emb_dim], self.dec_input_bridge.bias)
+        feed_weight = self.dec_input_bridge.weight[:, self.emb_dim:]
+
+        keys = self.attention_layer.precompute_keys(enc_context, ctx_mask)
+        out_weight, query_weight, v_weight, v_bias = self.attention_layer.step_params()
+        copy_keys, copy_out_weight, copy_query_weight, copy_v_weight, copy_v_bias = None, None, None, None, None
+        if self.copy_input_feeding and not self.reuse_copy_attn:
+            copy_keys = self.copy_attention_layer.precompute_keys(enc_context, ctx_mask)
+            copy_out_weight, copy_query_weight, copy_v_weight, copy_v_bias = self.copy_attention_layer.step_params()
+
+        h_0, c_0 = init_hidden[0].squeeze(0), init_hidden[1].squeeze(0)
+        if len(init_hidden) > 2:
+            h_tilde_0, copy_h_tilde_0 = init_hidden[2].squeeze(0), init_hidden[3].squeeze(0)
+        else:
+            h_tilde_0, copy_h_tilde_0 = torch.zeros_like(h_0), torch.zeros_like(h_0)
+
+        decoder_outputs, h_tildes, attn_weights, attn_energies, copy_weights, copy_energies, _, _, _, _ = self.checkpoint_activations(
+            input_feeding_decode,
+            emb_inputs, feed_weight, h_0, c_0,
+            self.decoder.weight_ih_l0, self.decoder.weight_hh_l0, self.decoder.bias_ih_l0, self.decoder.bias_hh_l0,
+            enc_context, ctx_mask, keys, out_weight, query_weight, v_weight, v_bias,
+            copy_keys, copy_out_weight, copy_query_weight, copy_v_weight, copy_v_bias,
+            h_tilde_0, copy_h_tilde_0, self.input_feeding, self.copy_input_feeding, reentrant=True)
+
+        # batch first (batch_size, trg_len, ...) as decode_teacher_forcing()
+        h_tildes = h_tildes.permute(1, 0, 2)
+        attn_weights = attn_weights.permute(1, 0, 2)
+        attn_energies = attn_energies.permute(1, 0, 2)
+
+        if self.copy_attention:
+            if self.reuse_copy_attn:
+                copy_weights, copy_logits = attn_weights, attn_energies
+            elif self.copy_input_feeding:
+                copy_weights, copy_logits = copy_weights.permute(1, 0, 2), copy_energies.permute(1, 0, 2)
+            else:
+                # the copy attention isn't fed to next step, compute it for all the steps at once
+                _, copy_weights, copy_logits = self.checkpoint_activations(self.copy_attention_layer, decoder_outputs.permute(1, 0, 2), enc_context, ctx_mask)
+        else:
+            copy_weights, copy_logits = [], None
+
+        return h_tildes, decoder_outputs, attn_weights, copy_weights, copy_logits
+
+    def forward_nll(self, input_src, input_src_len, input_trg, input_trg_target, input_src_ext, oov_lists, chunk_size=None, ctx_mask=None,
+                    soft_targets=None, pred_topk=1):
+        '''
+        Same to forward() with teacher forcing but returns the NLL of targets directly.
+        The decoder outputs are packed to the non-padding target positions (gathered by a flat index), thus the output layer, merging copy probs and log_softmax
+            only run on the real target words, then the results are scattered back to (batch_size, trg_len - 1).
+        If chunk_size is given, the packed outputs are computed chunk by chunk, thus the full (num_words, vocab_size + max_oov_number) log-probs are never kept alive together.
+            In training, each chunk is wrapped with torch.utils.checkpoint so only its inputs are saved for backward and the logits are recomputed then.
+        :param input_trg_target: (batch_size, trg_len - 1), the targets to predict, which is trg_copy_target for the copy model (contains temporary oov index)
+        :param chunk_size: number of target time steps per chunk, i.e. chunk_size * batch_size packed words. None to compute all the words at once
+        :param soft_targets: (target_ids, target_weights), both are (batch_size, trg_len - 1, k), ids in extended vocab and their weights (e.g. for distillation).
+            If given, the loss of each word is the cross-entropy to these weighted targets instead of the NLL of input_trg_target, which still decides the paddings
+        :param pred_topk: number of top predictions returned for each word, e.g. the soft targets of a distillation teacher
+        :returns
+            nll                 : (batch_size, trg_len - 1), negative log-likelihood of each target word, 0 for the paddings
+            pred_log_probs      : (batch_size, trg_len - 1), log-prob of the greedy (top 1) prediction, for reporting. 0 for the paddings
+                                    (batch_size, trg_len - 1, pred_topk) if pred_topk > 1
+            pred_ids            : (batch_size, trg_len - 1), the greedy (top 1) prediction in extended vocab. PAD for the paddings
+                                    (batch_size, trg_len - 1, pred_topk) if pred_topk > 1
+        '''
+        if not ctx_mask:
+            ctx_mask = self.get_mask(input_src)
+        src_h, (src_h_t, src_c_t) = self.encode(input_src, input_src_len)
+        init_hidden = self.init_decoder_state(src_h_t, src_c_t)
+        enc_context = self.prepare_context(src_h, ctx_mask)
+        self.current_batch += 1
+
+        h_tildes, _, _, _, copy_logits = self.decode_teacher_forcing(input_trg, enc_context, init_hidden, ctx_mask)
+
+        # pack the non-padding positions, (batch_size * trg_len) -> (num_words)
+        batch_size, trg_len = input_trg_target.size()
+        flat_index = input_trg_target.contiguous().view(-1).ne(self.pad_token_trg).nonzero().view(-1)
+
+        # the targets of each word, (batch_size, trg_len, 1) or k weighted soft targets (batch_size, trg_len, k)
+        if soft_targets is None:
+            targets, target_weights = input_trg_target.unsqueeze(2), None
+        else:
+            targets, target_weights = soft_targets
+
+        # sampled softmax, only compute the logits of candidate words, the targets and src_map are remapped to the positions in candidates
+        candidate_ids = None
+        if self.output_layer == 'sampled' and self.training:
+            candidate_ids, targets, input_src_ext = self.sample_candidates(targets, input_src_ext)
+        packed_h_tildes = h_tildes.contiguous().view(batch_size * trg_len, -1).index_select(0, flat_index)
+        packed_targets = targets.contiguous().view(batch_size * trg_len, -1).index_select(0, flat_index)
+        if target_weights is not None:
+            packed_target_weights = target_weights.contiguous().view(batch_size * trg_len, -1).index_select(0, flat_index)
+        if self.copy_attention:
+            # each packed word is an example of trg_len=1 for merge_copy_probs(), with the src_map and oovs of its source
+            batch_index = flat_index // trg_len
+            packed_copy_logits = copy_logits.contiguous().view(batch_size * trg_len, -1).index_select(0, flat_index)
+            packed_src_map = input_src_ext.index_select(0, batch_index)
+            packed_oov_lists = [oov_lists[i] for i in batch_index.tolist()]
+
+        def nll_chunk(h_tilde, trg_target, target_weight=None, copy_logit=None, src_map=None, oov_list=None):
+            decoder_logit = self.vocab_projection(h_tilde.unsqueeze(1), vocab_ids=candidate_ids)  # (num_words, 1, vocab_size or num_candidates)
+            if self.copy_attention:
+                decoder_log_prob = self.merge_copy_probs(decoder_logit, copy_logit.unsqueeze(1), src_map, oov_list)
+            else:
+                decoder_log_prob = torch.nn.functional.log_softmax(decoder_logit, dim=-1)
+            decoder_log_prob = decoder_log_prob.squeeze(1)
+            target_log_prob = decoder_log_prob.gather(1, trg_target)
+            if target_weight is not None:
+                target_log_prob = target_log_prob * target_weight
+            nll = -target_log_prob.sum(1)
+            pred_log_prob, pred_id = decoder_log_prob.topk(pred_topk, dim=1)
+            return nll, pred_log_prob, pred_id
+
+        num_words = flat_index.size(0)
+        chunk_words = num_words if chunk_size is None else max(chunk_size * batch_size, 1)
+        nlls, pred_log_probs, pred_ids = [], [], []
+        for start in range(0, num_words, chunk_words):
+            end = start + chunk_words
+            chunk_inputs = [packed_h_tildes[start: end], packed_targets[start: end],
+                            packed_target_weights[start: end] if target_weights is not None else None]
+            if self.copy_attention:
+                chunk_inputs += [packed_copy_logits[start: end], packed_src_map[start: end], packed_oov_lists[start: end]]
+            if (chunk_size is not None or self.checkpoint_activation_blocks) and torch.is_grad_enabled() and h_tildes.requires_grad:
+                nll, pred_log_prob, pred_id = checkpoint(nll_chunk, *chunk_inputs)
+            else:
+                nll, pred_log_prob, pred_id = nll_chunk(*chunk_inputs)
+            nlls.append(nll)
+            pred_log_probs.append(pred_log_prob.detach())
+            pred_ids.append(pred_id)
+
+        pred_ids = torch.cat(pred_ids, 0) if num_words > 0 else packed_targets.new_zeros((0, pred_topk))
+        if candidate_ids is not None:
+            # map the predictions back to the (extended) vocab
+            pred_ids = self.candidates_to_ids(pred_ids, candidate_ids)
+
+        # scatter back to (batch_size, trg_len)
+        nll = packed_h_tildes.new_zeros(batch_size * trg_len)
+        full_pred_log_probs = packed_h_tildes.new_zeros((batch_size * trg_len, pred_topk))
+        full_pred_ids = input_trg_target.new_full((batch_size * trg_len, pred_topk), self.pad_token_trg)
+        if num_words > 0:
+            nll = nll.index_copy(0, flat_index, torch.cat(nlls, 0))
+            full_pred_log_probs = full_pred_log_probs.index_copy(0, flat_index, torch.cat(pred_log_probs, 0))
+            full_pred_ids = full_pred_ids.index_copy(0, flat_index, pred_ids)
+
+        pred_size = (batch_size, trg_len) if pred_topk == 1 else (batch_size, trg_len, pred_topk)
+        return nll.view(batch_size, trg_len), full_pred_log_probs.view(pred_size), full_pred_ids.view(pred_size)
+
+    def vocab_projection(self, h_tilde, vocab_ids=None):
+        '''
+        The output layer, project the attentional hidden vectors to the vocab.
+        Note that adaptive softmax returns the log-probs, they are used as the logits of generative part (normalized up to a constant) and compatible with merge_copy_probs()
+        :param h_tilde: (..., trg_hidden_dim)
+        :param vocab_ids: (num_candidates), only compute the logits of these words, for sampled softmax
+        :return: (..., vocab_size) or (..., num_candidates) if vocab_ids is given
+        '''
+        if self.decoder2emb is not None:
+            h_tilde = self.decoder2emb(h_tilde)
+        if self.output_layer == 'adaptive':
+            size = h_tilde.size()[:-1] + (self.vocab_size,)
+            log_probs = self.decoder2vocab.log_prob(h_tilde.contiguous().view(-1, self.trg_hidden_dim)).view(size)
+            if vocab_ids is not None:
+                log_probs = log_probs.index_select(-1, vocab_ids)
+            return log_probs
+        if vocab_ids is not None:
+            if not isinstance(self.decoder2vocab, nn.Linear):
+                # quantized, the int8 weights can't be sliced
+                return self.decoder2vocab(h_tilde).index_select(-1, vocab_ids)
+            return func.linear(h_tilde, self.decoder2vocab.weight.index_select(0, vocab_ids), self.decoder2vocab.bias.index_select(0, vocab_ids))
+        return self.decoder2vocab(h_tilde)
+
+    def sample_candidates(self, trg_target, src_map):
+        '''
+        Build the candidate list of sampled softmax for a batch (Jean et al. 2015): all the in-vocab words of targets and sources,
+            plus sampled_softmax_size words drawn from a log-uniform (Zipfian) distribution, since ids of vocab are sorted by frequency.
+        :param trg_target: (batch_size, trg_len), may contain temporary oov index
+        :param src_map: (batch_size, src_len), may contain temporary oov index
+        :return:
+            candidate_ids   : (num_candidates), sorted unique word ids
+            trg_target      : remapped to the positions in candidates, oov index v+i is mapped to num_candidates+i
+            src_map         : remapped as trg_target
+        '''
+        # P(k) = log((k + 2) / (k + 1)) / log(vocab_size + 1)
+        uniform = trg_target.new(self.sampled_softmax_size).float().uniform_()
+        sampled_ids = (torch.exp(uniform * np.log(self.vocab_size + 1)) - 1).long().clamp(0, self.vocab_size - 1)
+
+        candidate_ids = torch.cat([trg_target[trg_target < self.vocab_size], src_map[src_map < self.vocab_size], sampled_ids])
+        candidate_ids = torch.unique(candidate_ids, sorted=True)
+
+        return candidate_ids, self.ids_to_candidates(trg_target, candidate_ids), self.ids_to_candidates(src_map, candidate_ids)
+
+    def ids_to_candidates(self, ids, candidate_ids):
+        '''
+        Map word ids (may contain temporary oov index) to the positions in a candidate list, oov index vocab_size+i is mapped to num_candidates+i.
+        The in-vocab ids must be in candidate_ids.
+        '''
+        num_candidates = candidate_ids.size(0)
+        id2position = candidate_ids.new(self.vocab_size).zero_()
+        id2position[candidate_ids] = torch.arange(0, num_candidates).type_as(candidate_ids)
+        return torch.where(ids < self.vocab_size, id2position[ids.clamp(max=self.vocab_size - 1)], ids - self.vocab_size + num_candidates)
+
+    def candidates_to_ids(self, positions, candidate_ids):
+        '''
+        Inverse of ids_to_candidates(), map the positions in a candidate list back to word ids in the extended vocab.
+        '''
+        num_candidates = candidate_ids.size(0)
+        return torch.where(positions < num_candidates, candidate_ids[positions.clamp(max=num_candidates - 1)], positions - num_candidates + self.vocab_size)
+
     def merge_oov2unk(self, decoder_log_prob, max_oov_number):
         '''
         Merge the probs of oov words to the probs of <unk>, in order to generate the next word
@@ -663,44 +1207,79 @@ class Seq2SeqLSTMAttention(nn.Module):
         To the sentences that have oovs it's fine. But if some sentences in a batch don't have oovs but mixed with sentences have oovs, the extended oov part would be ranked highly after softmax (zero is larger than other negative values in logits).
         Thus we have to carefully initialize the oov-extended part of no-oov sentences to negative infinite floats.
         Note that it may cause exception on early versions like on '0.3.1.post2', but it works well on 0.4 ({RuntimeError}in-place operations can be only used on variables that don't share storage with any other variables, but detected that there are 2 objects sharing it)
-        :param decoder_logits: (batch_size, trg_seq_len, vocab_size)
+        :param decoder_logits: (batch_size, trg_seq_len, vocab_size), vocab_size can be the number of candidates of sampled softmax
         :param copy_logits:    (batch_size, trg_len, src_len) the pointing/copying logits of each target words
-        :param src_map:        (batch_size, src_len)
+        :param src_map:        (batch_size, src_len), oov words are indexed from vocab_size
         :return:
             decoder_copy_probs: return the log_probs (batch_size, trg_seq_len, vocab_size + max_oov_number)
         '''
-        batch_size, max_length, _ = decoder_logits.size()
+        batch_size, max_length, vocab_size = decoder_logits.size()
         src_len = src_map.size(1)
 
         # set max_oov_number to be the max number of oov
         max_oov_number = max([len(oovs) for oovs in oov_list])
 
-        # flatten and extend size of decoder_probs from (vocab_size) to (vocab_size+max_oov_number)
-        flattened_decoder_logits = decoder_logits.view(batch_size * max_length, self.vocab_size)
+        # extend size of decoder_logits from (vocab_size) to (vocab_size+max_oov_number), (batch_size, trg_len, vocab_size + max_oov_number)
         if max_oov_number > 0:
-            '''
-            extended_zeros           = Variable(torch.zeros(batch_size * max_length, max_oov_number))
-            extended_zeros           = extended_zeros.cuda() if torch.cuda.is_available() else extended_zeros
-            flattened_decoder_logits = torch.cat((flattened_decoder_logits, extended_zeros), dim=1)
-            '''
-            extended_logits = Variable(torch.FloatTensor([[0.0] * len(oov) + [float('-inf')] * (max_oov_number - len(oov)) for oov in oov_list]))
-            extended_logits = extended_logits.unsqueeze(1).expand(batch_size, max_length, max_oov_number).contiguous().view(batch_size * max_length, -1)
-            extended_logits = extended_logits.cuda() if torch.cuda.is_available() else extended_logits
-            flattened_decoder_logits = torch.cat((flattened_decoder_logits, extended_logits), dim=1)
-
-        # add probs of copied words by scatter_add_(dim, index, src), index should be in the same shape with src. decoder_probs=(batch_size * trg_len, vocab_size+max_oov_number), copy_weights=(batch_size, trg_len, src_len)
-        expanded_src_map = src_map.unsqueeze(1).expand(batch_size, max_length, src_len).contiguous().view(batch_size * max_length, -1)  # (batch_size, src_len) -> (batch_size * trg_len, src_len)
-        # flattened_decoder_logits.scatter_add_(dim=1, index=expanded_src_map, src=copy_logits.view(batch_size * max_length, -1))
-        flattened_decoder_logits = flattened_decoder_logits.scatter_add_(1, expanded_src_map, copy_logits.view(batch_size * max_length, -1))
+            # (batch_size, 1, max_oov_number), 0 for the valid oov slots and -inf for the padded ones. Broadcast along trg_len without copying
+            oov_logits = self.get_oov_logits(oov_list, max_oov_number, decoder_logits).unsqueeze(1).expand(batch_size, max_length, max_oov_number)
+            if torch.is_grad_enabled():
+                # must be a new tensor every time as autograd keeps it for backward
+                extended_logits = torch.cat((decoder_logits, oov_logits), dim=2)
+            else:
+                # no graph refers to it in inference (e.g. beam search), thus reuse the buffer of previous steps
+                extended_logits = self.get_extended_logits_buffer((batch_size, max_length, vocab_size + max_oov_number), decoder_logits)
+                extended_logits[:, :, :vocab_size].copy_(decoder_logits)
+                extended_logits[:, :, vocab_size:].copy_(oov_logits)
+        else:
+            extended_logits = decoder_logits
 
-        # apply log softmax to normalize, ensuring it meets the properties of probability, (batch_size * trg_len, src_len)
-        flattened_decoder_logits = torch.nn.functional.log_softmax(flattened_decoder_logits, dim=1)
+        # add logits of copied words by scatter_add_(dim, index, src), the src_map is broadcast along trg_len instead of being copied. copy_logits=(batch_size, trg_len, src_len)
+        expanded_src_map = src_map.unsqueeze(1).expand(batch_size, max_length, src_len)
+        extended_logits = extended_logits.scatter_add_(2, expanded_src_map, copy_logits)
 
-        # reshape to batch first before returning (batch_size, trg_len, src_len)
-        decoder_log_probs = flattened_decoder_logits.view(batch_size, max_length, self.vocab_size + max_oov_number)
+        # apply log softmax to normalize, ensuring it meets the properties of probability, (batch_size, trg_len, vocab_size + max_oov_number)
+        decoder_log_probs = torch.nn.functional.log_softmax(extended_logits, dim=2)
 
         return decoder_log_probs
 
+    def get_oov_logits(self, oov_list, max_oov_number, like):
+        '''
+        The logits of oov-extended part before adding the copying logits: 0.0 for the oov words of each example and -inf for the paddings.
+        It only depends on the number of oovs of each example, thus it's cached and reused until the batch changes (e.g. through all the steps of beam search)
+        :param oov_list: list of oov words of each example
+        :param like: a tensor to decide the type and device of the mask
+        :return: (batch_size, max_oov_number)
+        '''
+        oov_numbers = tuple([len(oov) for oov in oov_list])
+        cache_key = (oov_numbers, max_oov_number, like.type(), like.get_device() if like.is_cuda else -1)
+        if self._oov_logits_cache is not None and self._oov_logits_cache[0] == cache_key:
+            return self._oov_logits_cache[1]
+
+        oov_numbers = torch.LongTensor(oov_numbers).unsqueeze(1)  # (batch_size, 1)
+        oov_index = torch.arange(0, max_oov_number).long().unsqueeze(0)  # (1, max_oov_number)
+        oov_logits = torch.zeros(len(oov_list), max_oov_number)
+        oov_logits.masked_fill_(oov_index >= oov_numbers, float('-inf'))
+        oov_logits = oov_logits.type(like.type())
+        if like.is_cuda:
+            oov_logits = oov_logits.cuda(like.get_device())
+
+        self._oov_logits_cache = (cache_key, oov_logits)
+        return oov_logits
+
+    def get_extended_logits_buffer(self, size, like):
+        '''
+        A reusable buffer for the extended logits (vocab_size + max_oov_number), only for inference as autograd doesn't allow reusing it.
+        It's enlarged when necessary and never shrinks.
+        '''
+        numel = int(np.prod(size))
+        buffer = self._extended_logits_buffer
+        if buffer is None or buffer.numel() < numel or buffer.type() != like.type() or buffer.is_cuda != like.is_cuda \
+                or (like.is_cuda and buffer.get_device() != like.get_device()):
+            buffer = like.new(numel)
+            self._extended_logits_buffer = buffer
+        return buffer[:numel].view(*size)
+
     def do_teacher_forcing(self):
         if self.scheduled_sampling:
             if self.scheduled_sampling_type == 'linear':
@@ -726,14 +1305,16 @@ class Seq2SeqLSTMAttention(nn.Module):
 
         return do_tf
 
-    def generate(self, trg_input, dec_hidden, enc_context, ctx_mask=None, src_map=None, oov_list=None, max_len=1, return_attention=False):
+    def generate(self, trg_input, dec_hidden, enc_context, ctx_mask=None, src_map=None, oov_list=None, max_len=1, return_attention=False, vocab_ids=None):
         '''
         Given the initial input, state and the source contexts, return the top K restuls for each time step
         :param trg_input: just word indexes of target texts (usually zeros indicating BOS <s>)
         :param dec_hidden: hidden states for decoder RNN to start with
         :param enc_context: context encoding vectors
-        :param src_map: required if it's copy model
+        :param src_map: required if it's copy model. If vocab_ids is given, it has to be mapped to the positions in vocab_ids by ids_to_candidates()
         :param oov_list: required if it's copy model
+        :param vocab_ids: a shortlist of word ids (num_candidates), if given only the logits of these words are computed
+            and the returned log_probs are over (num_candidates + max_oov_number), map them back with candidates_to_ids()
         :param k (deprecated): Top K to return
         :param feed_all_timesteps: it's one-step predicting or feed all inputs to run through all the time steps
         :param get_attention: return attention vectors?
@@ -747,8 +1328,13 @@ class Seq2SeqLSTMAttention(nn.Module):
         context_dim = enc_context.size(2)
         trg_hidden_dim = self.trg_hidden_dim
 
-        h_tilde = Variable(torch.zeros(batch_size, 1, trg_hidden_dim)).cuda() if torch.cuda.is_available() else Variable(torch.zeros(batch_size, 1, trg_hidden_dim))
-        copy_h_tilde = Variable(torch.zeros(batch_size, 1, trg_hidden_dim)).cuda() if torch.cuda.is_available() else Variable(torch.zeros(batch_size, 1, trg_hidden_dim))
+        if len(dec_hidden) > 2:
+            # input-feeding, continue with the attentional vectors of the previous step, (1, batch_size, trg_hidden) -> (batch_size, 1, trg_hidden)
+            h_tilde, copy_h_tilde = dec_hidden[2].permute(1, 0, 2), dec_hidden[3].permute(1, 0, 2)
+            dec_hidden = dec_hidden[:2]
+        else:
+            h_tilde = Variable(torch.zeros(batch_size, 1, trg_hidden_dim)).cuda() if torch.cuda.is_available() else Variable(torch.zeros(batch_size, 1, trg_hidden_dim))
+            copy_h_tilde = Variable(torch.zeros(batch_size, 1, trg_hidden_dim)).cuda() if torch.cuda.is_available() else Variable(torch.zeros(batch_size, 1, trg_hidden_dim))
         attn_weights = []
         copy_weights = []
         log_probs = []
@@ -775,12 +1361,12 @@ class Seq2SeqLSTMAttention(nn.Module):
 
             # compute the output decode_logit and read-out as probs: p_x = Softmax(W_s * h_tilde)
             # (batch_size, trg_len, trg_hidden_size) -> (batch_size, 1, vocab_size)
-            decoder_logit = self.decoder2vocab(h_tilde.view(-1, trg_hidden_dim))
+            decoder_logit = self.vocab_projection(h_tilde.contiguous().view(-1, trg_hidden_dim), vocab_ids=vocab_ids)
 
             if not self.copy_attention:
-                decoder_log_prob = torch.nn.functional.log_softmax(decoder_logit, dim=-1).view(batch_size, 1, self.vocab_size)
+                decoder_log_prob = torch.nn.functional.log_softmax(decoder_logit, dim=-1).view(batch_size, 1, -1)
             else:
-                decoder_logit = decoder_logit.view(batch_size, 1, self.vocab_size)
+                decoder_logit = decoder_logit.view(batch_size, 1, -1)
                 # copy_weights and copy_logits is (batch_size, trg_len, src_len)
                 if not self.reuse_copy_attn:
                     copy_h_tilde, copy_weight, copy_logit = self.copy_attention_layer(decoder_output.permute(1, 0, 2), enc_context, encoder_mask=ctx_mask)
@@ -792,6 +1378,8 @@ class Seq2SeqLSTMAttention(nn.Module):
 
             # Prepare for the next iteration, get the top word, top_idx and next_index are (batch_size, K)
             top_1_v, top_1_idx = decoder_log_prob.data.topk(1, dim=-1)  # (batch_size, 1)
+            if vocab_ids is not None:
+                top_1_idx = self.candidates_to_ids(top_1_idx, vocab_ids)
             trg_input = Variable(top_1_idx.squeeze(2))
             # trg_input           = Variable(top_1_idx).cuda() if torch.cuda.is_available() else Variable(top_1_idx) # (batch_size, 1)
 
@@ -805,6 +1393,8 @@ class Seq2SeqLSTMAttention(nn.Module):
 
         # Only return the hidden vectors of the last time step.
         #   tuple of (num_layers * num_directions, batch_size, trg_hidden_dim)=(1, batch_size, trg_hidden_dim)
+        if self.input_feeding or self.copy_input_feeding:
+            dec_hidden = (dec_hidden[0], dec_hidden[1], h_tilde.permute(1, 0, 2), copy_h_tilde.permute(1, 0, 2))
 
         # Return final outputs, hidden states, and attention weights (for visualization)
         if return_attention:
@@ -898,7 +1488,7 @@ class Seq2SeqLSTMAttention(nn.Module):
 
             # compute the output decode_logit and read-out as probs: p_x = Softmax(W_s * h_tilde)
             # (batch_size, trg_len, trg_hidden_size) -> (batch_size, trg_len, vocab_size)
-            decoder_logits = self.decoder2vocab(h_tildes.view(-1, trg_hidden_dim))
+            decoder_logits = self.vocab_projection(h_tildes.contiguous().view(-1, trg_hidden_dim))
             decoder_log_probs = torch.nn.functional.log_softmax(decoder_logits, dim=-1).view(batch_size, max_length, self.vocab_size)
 
             decoder_outputs = decoder_outputs.permute(1, 0, 2)
@@ -928,7 +1518,7 @@ class Seq2SeqLSTMAttention(nn.Module):
 
                 # compute the output decode_logit and read-out as probs: p_x = Softmax(W_s * h_tilde)
                 # (batch_size, trg_hidden_size) -> (batch_size, 1, vocab_size)
-                decoder_logit = self.decoder2vocab(h_tilde.view(-1, trg_hidden_dim))
+                decoder_logit = self.vocab_projection(h_tilde.contiguous().view(-1, trg_hidden_dim))
                 decoder_log_prob = torch.nn.functional.log_softmax(decoder_logit, dim=-1).view(batch_size, 1, self.vocab_size)
 
                 '''
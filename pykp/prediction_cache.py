@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of the predictions of beam search, for the documents submitted again (re-crawls, duplicate records).
+The predictions are stored in a sqlite file, keyed by the hash of the tokenized source and a fingerprint of the checkpoint(s)
+    and the decoding options, thus a cached prediction is only reused by the same model decoding in the same way.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+# options changing the results of beam search
+DECODING_OPTION_NAMES = ['vocab_size', 'beam_size', 'max_sent_length', 'n_best', 'beam_dedup', 'beam_block_ngram', 'quantize']
+
+
+class PredictedSequence(object):
+    '''
+    The word ids and score of a predicted sequence, without the decoder states of beam_search.Sequence
+    '''
+    def __init__(self, sentence, score):
+        self.sentence = sentence
+        self.score = score
+
+
+def file_digest(path, digest):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+
+
+def model_fingerprint(opt):
+    '''
+    Hash of the contents of the checkpoint(s), vocab and shortlist files, and the decoding options
+    '''
+    if opt.ensemble_checkpoints:
+        model_paths = opt.ensemble_checkpoints
+    elif opt.serving_model_prefix:
+        model_paths = [opt.serving_model_prefix + suffix for suffix in ['.encoder.pt', '.decode_step.pt', '.serving.json']]
+    else:
+        model_paths = [opt.train_from]
+
+    digest = hashlib.md5()
+    for path in model_paths + [opt.vocab_path] + ([opt.shortlist_path] if opt.shortlist_path else []):
+        file_digest(path, digest)
+    digest.update(json.dumps([getattr(opt, name, None) for name in DECODING_OPTION_NAMES]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class PredictionCache(object):
+    '''
+    A sqlite table of (key, predictions, last access time), the least recently used entries are evicted beyond max_entries.
+    Several processes (e.g. predict.py -predict_workers) can share the file, each opens its own cache and keeps its own hit/miss counters.
+    '''
+    def __init__(self, path, fingerprint, max_entries=100000):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, predictions TEXT, last_access REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS predictions_last_access ON predictions (last_access)')
+        self.connection.commit()
+
+    def document_key(self, src_oov, oov_list):
+        '''
+        :param src_oov: the source ids of a document in extended vocab (without paddings)
+        :param oov_list: the oov words of the document, the ids >= vocab_size refer to them
+        '''
+        digest = hashlib.md5(self.fingerprint.encode('utf-8'))
+        digest.update(np.asarray(src_oov, dtype=np.int64).tobytes())
+        digest.update('\t'.join(oov_list).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get_many(self, keys):
+        '''
+        :return: a list of the cached predictions (a list of PredictedSequence) of each key, None if not cached
+        '''
+        rows = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start: start + 500]
+            rows.update(self.connection.execute('SELECT key, predictions FROM predictions WHERE key IN (%s)' % ','.join('?' * len(chunk)), chunk).fetchall())
+
+        hit_keys = [key for key in keys if key in rows]
+        if len(hit_keys) > 0:
+            now = time.time()
+            self.connection.executemany('UPDATE predictions SET last_access = ? WHERE key = ?', [(now, key) for key in hit_keys])
+            self.connection.commit()
+        self.hits += len(hit_keys)
+        self.misses += len(keys) - len(hit_keys)
+
+        return [[PredictedSequence(sentence, score) for sentence, score in json.loads(rows[key])] if key in rows else None for key in keys]
+
+    def put_many(self, keys, predictions):
+        now = time.time()
+        self.connection.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)',
+                                    [(key, json.dumps([[[int(w) for w in seq.sentence], float(seq.score)] for seq in pred_seqs]), now)
+                                     for key, pred_seqs in zip(keys, predictions)])
+        num_entries = self.connection.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+        if num_entries > self.max_entries:
+            self.connection.execute('DELETE FROM predictions WHERE key IN (SELECT key FROM predictions ORDER BY last_access LIMIT ?)',
+                                    (num_entries - self.max_entries,))
+            self.evictions += num_entries - self.max_entries
+        self.connection.commit()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': float(self.hits) / max(self.hits + self.misses, 1)}
+
+    def log_stats(self):
+        logging.getLogger().info('Prediction cache %s: %d hits, %d misses (hit rate=%.4f), %d evictions'
+                                 % (self.path, self.hits, self.misses, self.stats()['hit_rate'], self.evictions))
+
+    def close(self):
+        self.connection.close()
+
+
+class CachedSequenceGenerator(object):
+    '''
+    Wrap a beam_search.SequenceGenerator: the documents of a batch found in the cache are returned at once,
+        only the others are decoded (as a smaller batch) and then cached. Attentions of the sequences are not cached.
+    '''
+    def __init__(self, generator, cache):
+        assert not generator.return_attention, 'The attentions of the predictions are not cached'
+        self.generator = generator
+        self.cache = cache
+
+    @property
+    def shortlist(self):
+        return self.generator.shortlist
+
+    def beam_search(self, src_input, src_len, src_oov, oov_list, word2id):
+        '''
+        Same to SequenceGenerator.beam_search(), returns a list of PredictedSequence of each document
+        '''
+        keys = [self.cache.document_key(src_oov[i, :src_len[i]].cpu().numpy(), oov_list[i]) for i in range(len(src_len))]
+        results = self.cache.get_many(keys)
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        if len(missing) > 0:
+            # the documents are sorted by the source length, so are the missing ones. Trim the paddings of the shorter sources
+            index = src_oov.new_tensor(missing)
+            max_src_len = max([src_len[i] for i in missing])
+            pred_seq_list = self.generator.beam_search(src_input.index_select(0, index)[:, :max_src_len], [src_len[i] for i in missing],
+                                                       src_oov.index_select(0, index)[:, :max_src_len], [oov_list[i] for i in missing], word2id)
+            pred_seq_list = [[PredictedSequence([int(w) for w in seq.sentence], float(seq.score)) for seq in pred_seqs] for pred_seqs in pred_seq_list]
+            self.cache.put_many([keys[i] for i in missing], pred_seq_list)
+            for i, pred_seqs in zip(missing, pred_seq_list):
+                results[i] = pred_seqs
+
+        return results
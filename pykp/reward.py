@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Rewards of the sampled keyphrases for RL training (train.train_rl_0/1), computed on word ids instead of strings.
+Same to the rewards given by evaluate.get_match_result() and evaluate.evaluate(): the predictions and targets are stemmed, and
+    a prediction is correct if it matches a target exactly (the sequences keep the <EOS> at the end).
+"""
+import multiprocessing
+
+import numpy as np
+from nltk.stem.porter import PorterStemmer
+
+from pykp.metric.bleu import bleu
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+stemmer = PorterStemmer()
+BLEU_WEIGHTS = [0.1, 0.3, 0.6]
+
+# the RewardEngine of each worker process, set by init_reward_worker()
+worker_engine = None
+
+
+def init_reward_worker(engine):
+    global worker_engine
+    worker_engine = engine
+
+
+def score_documents_in_worker(documents):
+    return [worker_engine.score_document(*document) for document in documents]
+
+
+def f_score_at_k(match_list, num_predictions, num_targets, topk):
+    '''
+    Micro-averaged F-score of the top k predictions, same to evaluate.evaluate()
+    '''
+    match_list = match_list[:topk]
+    num_predictions = min(num_predictions, topk)
+    precision = float(sum(match_list)) / float(num_predictions) if num_predictions > 0 else 0.0
+    recall = float(sum(match_list)) / float(num_targets) if num_targets > 0 else 0.0
+    if precision + recall > 0:
+        return float(2 * (precision * recall)) / (precision + recall)
+    return 0.0
+
+
+class RewardEngine(object):
+    '''
+    Each word is mapped to the id of its stem, cached by the word id (words in vocab) or the word (oovs),
+        thus the sequences are compared as tuples of stem ids.
+    With num_workers > 0, the documents of a batch are scored in a pool of processes, each keeps its own stem cache.
+    '''
+    def __init__(self, id2word, vocab_size, eos_id, alpha=0.0, topk=5, num_workers=0):
+        '''
+        :param alpha: weight of BLEU in the reward, alpha * BLEU + (1 - alpha) * F-score@topk. BLEU is not computed if alpha is 0
+        '''
+        self.id2word = id2word
+        self.vocab_size = vocab_size
+        self.eos_id = eos_id
+        self.alpha = alpha
+        self.topk = topk
+        self.num_workers = num_workers
+
+        self.word_id2stem_id = {}
+        self.oov2stem_id = {}
+        self.stem2id = {}
+        self.pool = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pool'] = None
+        return state
+
+    def stem_id(self, word):
+        stem = stemmer.stem(word.strip().lower())
+        if stem not in self.stem2id:
+            self.stem2id[stem] = len(self.stem2id)
+        return self.stem2id[stem]
+
+    def stem_ids(self, word_ids, oov_list):
+        stem_ids = []
+        for word_id in word_ids:
+            if word_id < self.vocab_size:
+                if word_id not in self.word_id2stem_id:
+                    self.word_id2stem_id[word_id] = self.stem_id(self.id2word[word_id])
+                stem_ids.append(self.word_id2stem_id[word_id])
+            else:
+                word = oov_list[word_id - self.vocab_size]
+                if word not in self.oov2stem_id:
+                    self.oov2stem_id[word] = self.stem_id(word)
+                stem_ids.append(self.oov2stem_id[word])
+        return tuple(stem_ids)
+
+    def cut_after_eos(self, word_ids):
+        return word_ids[:word_ids.index(self.eos_id) + 1] if self.eos_id in word_ids else word_ids
+
+    def sequence_rewards(self, pred_seqs, trg_seqs):
+        '''
+        :return: the rewards of each prediction, and the reward of the predictions as a whole (the baseline of self-critic)
+        '''
+        trg_set = set(trg_seqs)
+        match_list = [1.0 if seq in trg_set else 0.0 for seq in pred_seqs]
+        f_score = f_score_at_k(match_list, len(pred_seqs), len(trg_seqs), self.topk)
+        if self.alpha == 0:
+            return np.full(len(pred_seqs), f_score), f_score
+
+        bleu_scores = np.asarray([bleu(list(seq), [list(trg_seq) for trg_seq in trg_seqs], BLEU_WEIGHTS) for seq in pred_seqs])
+        return self.alpha * bleu_scores + (1.0 - self.alpha) * f_score, self.alpha * np.average(bleu_scores) + (1.0 - self.alpha) * f_score
+
+    def score_document(self, sampled_seqs, trg_seqs, oov_list, baseline_seqs=None):
+        '''
+        :param sampled_seqs: lists of word ids (in extended vocab) of the sampled sequences
+        :param trg_seqs: lists of word ids of the targets (trg_copy_target ending with <EOS>)
+        :return: rewards of the sampled sequences (k), and the reward of baseline_seqs if given
+        '''
+        trg_seqs = [self.stem_ids(seq, oov_list) for seq in trg_seqs]
+        rewards, _ = self.sequence_rewards([self.stem_ids(self.cut_after_eos(seq), oov_list) for seq in sampled_seqs], trg_seqs)
+        baseline = None
+        if baseline_seqs is not None:
+            _, baseline = self.sequence_rewards([self.stem_ids(self.cut_after_eos(seq), oov_list) for seq in baseline_seqs], trg_seqs)
+        return rewards, baseline
+
+    def score(self, sampled_ids, trg_copy_lists, oov_lists, baseline_ids=None):
+        '''
+        :param sampled_ids: (batch_size, k, max_len) ids of the sampled sequences, moved to CPU at once
+        :param trg_copy_lists: the trg_copy_target of each document in the one2many batch
+        :param baseline_ids: (batch_size, k, max_len) ids of the baseline (greedy) sequences, optional
+        :return: rewards (batch_size, k) and baselines (batch_size), the latter is None if baseline_ids is not given
+        '''
+        sampled_ids = sampled_ids.cpu().tolist()
+        baseline_ids = baseline_ids.cpu().tolist() if baseline_ids is not None else [None] * len(sampled_ids)
+        documents = list(zip(sampled_ids, trg_copy_lists, oov_lists, baseline_ids))
+
+        if self.num_workers > 0:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.num_workers, initializer=init_reward_worker, initargs=(self,))
+            chunk_size = (len(documents) + self.num_workers - 1) // self.num_workers
+            chunks = [documents[i: i + chunk_size] for i in range(0, len(documents), chunk_size)]
+            results = [result for chunk_results in self.pool.map(score_documents_in_worker, chunks) for result in chunk_results]
+        else:
+            results = [self.score_document(*document) for document in documents]
+
+        rewards = np.stack([result[0] for result in results])
+        baselines = np.asarray([result[1] for result in results]) if baseline_ids[0] is not None else None
+        return rewards, baselines
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+TorchScript modules for serving a trained Seq2SeqLSTMAttention: an encoder and a single-step decoder with the configuration fixed at export time.
+They are exported with export_serving_model() and loaded with load_serving_model(), which returns an adapter usable by SequenceGenerator.
+Loading them requires neither pykp.model nor train.py.
+"""
+import json
+import logging
+
+import torch
+import torch.nn as nn
+from typing import Optional
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+
+class DotScore(nn.Module):
+    def forward(self, hidden, context):
+        # (batch_size, 1, trg_hidden_dim) * (batch_size, src_len, trg_hidden_dim).transpose(1, 2) -> (batch_size, 1, src_len)
+        return torch.bmm(hidden, context.transpose(1, 2))
+
+
+class GeneralScore(nn.Module):
+    def __init__(self, attn):
+        super(GeneralScore, self).__init__()
+        self.attn = attn
+
+    def forward(self, hidden, context):
+        return torch.bmm(hidden, self.attn(context).transpose(1, 2))
+
+
+class ConcatScore(nn.Module):
+    def __init__(self, attn, v):
+        super(ConcatScore, self).__init__()
+        self.attn = attn
+        self.v = v
+
+    def forward(self, hidden, context):
+        hidden = hidden.expand(-1, context.size(1), -1)  # (batch_size, src_len, trg_hidden_dim)
+        energy = torch.tanh(self.attn(torch.cat((hidden, context), 2)))  # (batch_size, src_len, trg_hidden_dim)
+        return self.v(energy).squeeze(-1).unsqueeze(1)  # (batch_size, 1, src_len)
+
+
+class ServingAttention(nn.Module):
+    '''
+    One-step version of pykp.model.Attention
+    '''
+    def __init__(self, attention):
+        super(ServingAttention, self).__init__()
+        if attention.method == 'dot':
+            self.score = DotScore()
+        elif attention.method == 'general':
+            self.score = GeneralScore(attention.attn)
+        else:
+            self.score = ConcatScore(attention.attn.mlp, attention.v.mlp)
+        self.linear_out = attention.linear_out
+
+    def forward(self, hidden, context, ctx_mask):
+        '''
+        :param hidden: (batch_size, 1, trg_hidden_dim)
+        :param context: (batch_size, src_len, context_dim)
+        :param ctx_mask: (batch_size, src_len)
+        :return: h_tilde (batch_size, 1, trg_hidden_dim), attn_weights and attn_energies (batch_size, 1, src_len)
+        '''
+        mask = ctx_mask.unsqueeze(1)  # (batch_size, 1, src_len)
+        energies = self.score(hidden, context) * mask
+
+        # same to pykp.eric_layers.masked_softmax()
+        clamped = torch.clamp(energies, min=-15.0, max=15.0) * mask
+        e_x = torch.exp(clamped - torch.max(clamped, dim=-1, keepdim=True)[0]) * mask
+        attn_weights = e_x / (torch.sum(e_x, dim=-1, keepdim=True) + 1e-6)
+
+        weighted_context = torch.bmm(attn_weights, context)
+        h_tilde = torch.tanh(self.linear_out(torch.cat((weighted_context, hidden), 2)))
+        return h_tilde, attn_weights, energies
+
+
+class ServingEncoder(nn.Module):
+    '''
+    Encode the source and return everything needed by ServingDecodeStep
+    '''
+    bidirectional: torch.jit.Final[bool]
+    dot_attention: torch.jit.Final[bool]
+    transformer_encoder: torch.jit.Final[bool]
+
+    def __init__(self, model):
+        super(ServingEncoder, self).__init__()
+        self.embedding = model.embedding
+        self.encoder = model.encoder
+        self.encoder2decoder_hidden = model.encoder2decoder_hidden
+        self.encoder2decoder_cell = model.encoder2decoder_cell
+        self.bidirectional = model.bidirectional
+        self.dot_attention = model.attention_layer.method == 'dot'
+        self.transformer_encoder = model.encoder_type == 'transformer'
+        self.pad_token = model.pad_token_src
+        self.num_states = 0 if self.transformer_encoder else model.encoder.num_layers * model.num_directions
+        self.src_hidden_dim = model.src_hidden_dim
+
+    def forward(self, src, src_len):
+        '''
+        :param src: (batch_size, src_len), sorted by length in descending order
+        :param src_len: (batch_size), a LongTensor on CPU
+        :return:
+            context     : (batch_size, src_len, context_dim)
+            ctx_mask    : (batch_size, src_len)
+            h, c        : (1, batch_size, trg_hidden_dim), the initial state of decoder
+        '''
+        ctx_mask = src.ne(self.pad_token).float()
+        if self.transformer_encoder:
+            context, (h_t, c_t) = self.encoder(self.embedding(src), ctx_mask)
+        else:
+            h0 = torch.zeros(self.num_states, src.size(0), self.src_hidden_dim, dtype=ctx_mask.dtype, device=src.device)
+            c0 = torch.zeros(self.num_states, src.size(0), self.src_hidden_dim, dtype=ctx_mask.dtype, device=src.device)
+
+            src_emb = nn.utils.rnn.pack_padded_sequence(self.embedding(src), src_len, batch_first=True)
+            src_h, (src_h_t, src_c_t) = self.encoder(src_emb, (h0, c0))
+            context, _ = nn.utils.rnn.pad_packed_sequence(src_h, batch_first=True, total_length=src.size(1))
+
+            if self.bidirectional:
+                h_t = torch.cat((src_h_t[-1], src_h_t[-2]), 1)
+                c_t = torch.cat((src_c_t[-1], src_c_t[-2]), 1)
+            else:
+                h_t = src_h_t[-1]
+                c_t = src_c_t[-1]
+
+        h = torch.tanh(self.encoder2decoder_hidden(h_t)).unsqueeze(0)
+        c = torch.tanh(self.encoder2decoder_cell(c_t)).unsqueeze(0)
+
+        # dot attention requires the context in trg_hidden_dim, done once here instead of every step
+        if self.dot_attention:
+            context = torch.tanh(self.encoder2decoder_hidden(context))
+
+        return context, ctx_mask, h, c
+
+
+class ServingDecodeStep(nn.Module):
+    '''
+    One step of pykp.model.Seq2SeqLSTMAttention.generate()
+    '''
+    copy_attention: torch.jit.Final[bool]
+    reuse_copy_attn: torch.jit.Final[bool]
+    input_feeding: torch.jit.Final[bool]
+    copy_input_feeding: torch.jit.Final[bool]
+
+    def __init__(self, model):
+        super(ServingDecodeStep, self).__init__()
+        self.embedding = model.embedding
+        self.decoder = model.decoder
+        self.attention_layer = ServingAttention(model.attention_layer)
+        self.decoder2emb = model.decoder2emb if model.decoder2emb is not None else nn.Identity()
+        self.decoder2vocab = model.decoder2vocab
+
+        self.copy_attention = model.copy_attention
+        self.reuse_copy_attn = model.reuse_copy_attn
+        if self.copy_attention and not self.reuse_copy_attn:
+            self.copy_attention_layer = ServingAttention(model.copy_attention_layer)
+        else:
+            self.copy_attention_layer = None
+
+        self.input_feeding = model.input_feeding
+        self.copy_input_feeding = model.copy_input_feeding
+        self.dec_input_bridge = model.dec_input_bridge
+
+    def forward(self, trg_input, h, c, h_tilde, copy_h_tilde, context, ctx_mask, src_map, oov_logits, vocab_ids: Optional[torch.Tensor] = None):
+        '''
+        :param trg_input: (batch_size, 1), word ids within vocab
+        :param h, c: (1, batch_size, trg_hidden_dim)
+        :param h_tilde, copy_h_tilde: (1, batch_size, trg_hidden_dim), the attentional vectors of previous step for input-feeding, ignored otherwise
+        :param src_map: (batch_size, src_len), source in extended vocab, mapped to the positions in vocab_ids if it's given
+        :param oov_logits: (batch_size, max_oov_number), 0 for valid oov slots and -inf for paddings
+        :param vocab_ids: (num_candidates), compute the logits of these words only (shortlist)
+        :return:
+            log_probs   : (batch_size, vocab_size + max_oov_number) or (batch_size, num_candidates + max_oov_number)
+            h, c, h_tilde, copy_h_tilde : (1, batch_size, trg_hidden_dim)
+            attn_weights, copy_weights : (batch_size, src_len)
+        '''
+        trg_emb = self.embedding(trg_input).permute(1, 0, 2)  # (1, batch_size, emb_dim)
+        if self.input_feeding and self.copy_input_feeding:
+            dec_input = torch.tanh(self.dec_input_bridge(torch.cat((trg_emb, h_tilde, copy_h_tilde), 2)))
+        elif self.input_feeding:
+            dec_input = torch.tanh(self.dec_input_bridge(torch.cat((trg_emb, h_tilde), 2)))
+        elif self.copy_input_feeding:
+            dec_input = torch.tanh(self.dec_input_bridge(torch.cat((trg_emb, copy_h_tilde), 2)))
+        else:
+            dec_input = trg_emb
+        decoder_output, (h, c) = self.decoder(dec_input, (h, c))
+        decoder_output = decoder_output.permute(1, 0, 2)  # (batch_size, 1, trg_hidden_dim)
+
+        h_tilde, attn_weights, attn_energies = self.attention_layer(decoder_output, context, ctx_mask)
+        output = self.decoder2emb(h_tilde.squeeze(1))
+        if vocab_ids is not None:
+            decoder_logits = torch.nn.functional.linear(output, self.decoder2vocab.weight.index_select(0, vocab_ids), self.decoder2vocab.bias.index_select(0, vocab_ids))
+        else:
+            decoder_logits = self.decoder2vocab(output)
+
+        copy_weights = attn_weights
+        if self.copy_attention:
+            copy_energies = attn_energies
+            copy_h_tilde = h_tilde.permute(1, 0, 2)
+            if not self.reuse_copy_attn:
+                copy_h_tilde, copy_weights, copy_energies = self.copy_attention_layer(decoder_output, context, ctx_mask)
+                copy_h_tilde = copy_h_tilde.permute(1, 0, 2)
+            extended_logits = torch.cat((decoder_logits, oov_logits), 1)
+            extended_logits = extended_logits.scatter_add(1, src_map, copy_energies.squeeze(1))
+            log_probs = torch.log_softmax(extended_logits, dim=1)
+        else:
+            log_probs = torch.log_softmax(decoder_logits, dim=1)
+
+        return log_probs, h, c, h_tilde.permute(1, 0, 2), copy_h_tilde, attn_weights.squeeze(1), copy_weights.squeeze(1)
+
+
+class ScriptedSeq2Seq(object):
+    '''
+    Adapter of the scripted encoder/decode step, with the interfaces used by SequenceGenerator.beam_search()
+    '''
+    def __init__(self, encoder, decode_step, meta):
+        self.encoder = encoder
+        self.decode_step = decode_step
+        self.vocab_size = meta['vocab_size']
+        self.unk_word = meta['unk_word']
+        self.copy_attention = meta['copy_attention']
+        self.input_feeding = meta.get('input_feeding', False)
+        self._oov_logits_cache = None
+
+    def eval(self):
+        self.encoder.eval()
+        self.decode_step.eval()
+        return self
+
+    def cuda(self):
+        self.encoder.cuda()
+        self.decode_step.cuda()
+        return self
+
+    def encode(self, input_src, input_src_len):
+        context, _, h, c = self.encoder(input_src, torch.LongTensor(input_src_len))
+        return context, (h, c)
+
+    def init_decoder_state(self, enc_h, enc_c):
+        # ServingEncoder has returned the initial state of decoder, append the zero attentional vectors for input-feeding
+        if self.input_feeding:
+            return enc_h, enc_c, torch.zeros_like(enc_h), torch.zeros_like(enc_h)
+        return enc_h, enc_c
+
+    def get_oov_logits(self, oov_list, like):
+        oov_numbers = tuple([len(oov) for oov in oov_list])
+        cache_key = (oov_numbers, like.device)
+        if self._oov_logits_cache is not None and self._oov_logits_cache[0] == cache_key:
+            return self._oov_logits_cache[1]
+
+        oov_index = torch.arange(0, max(oov_numbers)).unsqueeze(0)
+        oov_logits = torch.zeros(len(oov_list), max(oov_numbers))
+        oov_logits.masked_fill_(oov_index >= torch.LongTensor(oov_numbers).unsqueeze(1), float('-inf'))
+        oov_logits = oov_logits.to(like.device)
+        self._oov_logits_cache = (cache_key, oov_logits)
+        return oov_logits
+
+    def ids_to_candidates(self, ids, candidate_ids):
+        num_candidates = candidate_ids.size(0)
+        id2position = candidate_ids.new(self.vocab_size).zero_()
+        id2position[candidate_ids] = torch.arange(0, num_candidates).type_as(candidate_ids)
+        return torch.where(ids < self.vocab_size, id2position[ids.clamp(max=self.vocab_size - 1)], ids - self.vocab_size + num_candidates)
+
+    def candidates_to_ids(self, positions, candidate_ids):
+        num_candidates = candidate_ids.size(0)
+        return torch.where(positions < num_candidates, candidate_ids[positions.clamp(max=num_candidates - 1)], positions - num_candidates + self.vocab_size)
+
+    def generate(self, trg_input, dec_hidden, enc_context, ctx_mask=None, src_map=None, oov_list=None, max_len=1, return_attention=False, vocab_ids=None):
+        assert max_len == 1, 'Scripted decoder only supports one-step generation'
+        oov_logits = self.get_oov_logits(oov_list, enc_context)
+        h, c = dec_hidden[0], dec_hidden[1]
+        h_tilde, copy_h_tilde = (dec_hidden[2], dec_hidden[3]) if self.input_feeding else (h, h)
+        log_probs, h, c, h_tilde, copy_h_tilde, attn_weights, copy_weights = self.decode_step(trg_input, h, c, h_tilde, copy_h_tilde, enc_context, ctx_mask, src_map, oov_logits, vocab_ids)
+        dec_hidden = (h, c, h_tilde, copy_h_tilde) if self.input_feeding else (h, c)
+
+        log_probs = log_probs.unsqueeze(1)
+        if return_attention:
+            if not self.copy_attention:
+                return log_probs, dec_hidden, attn_weights.unsqueeze(1)
+            else:
+                return log_probs, dec_hidden, (attn_weights.unsqueeze(1), copy_weights.unsqueeze(1))
+        else:
+            return log_probs, dec_hidden
+
+
+def export_serving_model(model, path_prefix):
+    '''
+    Script the encoder and single-step decoder of model and save them to path_prefix + '.encoder.pt'/'.decode_step.pt',
+        the meta information is saved to path_prefix + '.serving.json'
+    '''
+    assert model.output_layer != 'adaptive', 'Adaptive softmax is not supported by the scripted decoder'
+    model.eval()
+    encoder = torch.jit.script(ServingEncoder(model))
+    decode_step = torch.jit.script(ServingDecodeStep(model))
+    torch.jit.save(encoder, path_prefix + '.encoder.pt')
+    torch.jit.save(decode_step, path_prefix + '.decode_step.pt')
+
+    meta = {'vocab_size': model.vocab_size, 'unk_word': model.unk_word, 'copy_attention': model.copy_attention,
+            'input_feeding': model.input_feeding or model.copy_input_feeding}
+    with open(path_prefix + '.serving.json', 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+    logging.info('Exported the scripted encoder and decoder to %s.*' % path_prefix)
+
+
+def load_serving_model(path_prefix, map_location=None):
+    encoder = torch.jit.load(path_prefix + '.encoder.pt', map_location=map_location)
+    decode_step = torch.jit.load(path_prefix + '.decode_step.pt', map_location=map_location)
+    with open(path_prefix + '.serving.json', 'r') as meta_file:
+        meta = json.load(meta_file)
+    return ScriptedSeq2Seq(encoder, decode_step, meta)
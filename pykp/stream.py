@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming prediction on raw texts (predict.py -predict_input), without preprocessing the documents into .one2many.pt datasets.
+The documents are read from a file or stdin, a buffer of -stream_buffer_size documents at a time, tokenized by copyseq_tokenize()
+    and indexed with the saved vocab on the fly, then micro-batched by the source length for beam search.
+The predictions are written as JSON lines in the order of input, thus the memory does not grow with the size of input. e.g.
+    cat docs.jsonl | python predict.py -vocab_path data/kp20k/kp20k.vocab.pt -exp kp20k -copy_attention -train_from exp/.../xxx.model
+        -predict_input - -predict_input_format json > predictions.jsonl
+"""
+import itertools
+import json
+import logging
+import sys
+import time
+
+import torch
+
+import pykp.io
+from evaluate import decode_batch, process_predseqs, if_present_duplicate_phrases
+from pykp.dataloader import MemoryBudgetBatchSampler
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+# collate_fn_one2many() truncates the sources (with <s> and </s>) to 1000 words
+MAX_SRC_LEN = 1000
+
+
+def read_documents(input_file, input_format, src_fields):
+    '''
+    :param input_format: 'json', one json object per line and the source is the concatenation of src_fields (same to pykp.io.load_json_data());
+        or 'text', one document per line
+    :return: a generator of (id, text), id is the 'id' field of a json document if given, otherwise the line number
+    '''
+    for line_number, line in enumerate(input_file):
+        if len(line.strip()) == 0:
+            continue
+        if input_format == 'json':
+            json_ = json.loads(line)
+            yield json_.get('id', line_number), '.'.join([json_[f] for f in src_fields if f in json_])
+        else:
+            yield line_number, line.strip()
+
+
+def tokenize_document(text, word2id, opt):
+    '''
+    Tokenize and index a document as pykp.io.process_data_examples(), without targets
+    '''
+    src_str = pykp.io.copyseq_tokenize(text.lower() if opt.lower else text)
+    if opt.src_seq_length_trunc and len(src_str) > opt.src_seq_length_trunc:
+        src_str = src_str[:opt.src_seq_length_trunc]
+    src_str = src_str[:MAX_SRC_LEN - 2]
+
+    unk_id = word2id[pykp.io.UNK_WORD]
+    src = [word2id[w] if w in word2id and word2id[w] < opt.vocab_size else unk_id for w in src_str]
+    src_oov, _, oov_list = pykp.io.extend_vocab_OOV(src_str, word2id, opt.vocab_size, opt.max_unk_words)
+    return {'src_str': src_str, 'src': src, 'src_oov': src_oov, 'oov_list': oov_list}
+
+
+def micro_batches(examples, opt):
+    '''
+    :return: lists of indices of examples, sorted by the source length (descending) and packed by -beam_search_memory_mb if set,
+        otherwise by -beam_search_batch_example
+    '''
+    order = sorted(range(len(examples)), key=lambda i: len(examples[i]['src']), reverse=True)
+    if opt.beam_search_memory_mb > 0:
+        src_lens = [len(e['src']) + 2 for e in examples]
+        oov_numbers = [len(e['oov_list']) for e in examples]
+        return list(MemoryBudgetBatchSampler(order, src_lens, oov_numbers, opt.beam_search_memory_mb * 1024 * 1024, opt))
+    return [order[i: i + opt.beam_search_batch_example] for i in range(0, len(order), opt.beam_search_batch_example)]
+
+
+def collate_examples(examples, word2id):
+    '''
+    Pad the sources with <s> and </s> as KeyphraseDataset.collate_fn_one2many(), the examples must be sorted by the source length
+    :return: src, src_len, src_oov and oov_lists
+    '''
+    bos, eos, pad = word2id[pykp.io.BOS_WORD], word2id[pykp.io.EOS_WORD], word2id[pykp.io.PAD_WORD]
+    src_len = [len(e['src']) + 2 for e in examples]
+    src = torch.LongTensor(len(examples), max(src_len)).fill_(pad)
+    src_oov = torch.LongTensor(len(examples), max(src_len)).fill_(pad)
+    for i, e in enumerate(examples):
+        src[i, :src_len[i]] = torch.LongTensor([bos] + e['src'] + [eos])
+        src_oov[i, :src_len[i]] = torch.LongTensor([bos] + e['src_oov'] + [eos])
+    if torch.cuda.is_available():
+        src, src_oov = src.cuda(), src_oov.cuda()
+    return src, src_len, src_oov, [e['oov_list'] for e in examples]
+
+
+def filter_predictions(pred_seqs, example, opt):
+    '''
+    The same filterings as evaluate_beam_search(): drop the phrases with <unk> or punctuations, and if -must_appear_in_src,
+        the ones absent from the source or duplicate after stemming
+    :return: a list of (phrase, score)
+    '''
+    is_valid_flags, _, pred_str_seqs, pred_scores = process_predseqs(pred_seqs, example['oov_list'], opt.id2word, opt)
+    if opt.must_appear_in_src:
+        is_present_flags, _ = if_present_duplicate_phrases(example['src_str'], pred_str_seqs)
+    else:
+        is_present_flags = [True] * len(pred_str_seqs)
+    return [(' '.join(words), float(score)) for words, score, is_valid, is_present in zip(pred_str_seqs, pred_scores, is_valid_flags, is_present_flags)
+            if is_valid and is_present]
+
+
+def predict_stream(generator, input_file, output_file, opt):
+    '''
+    Predict the keyphrases of the documents in input_file, write a JSON line {"id", "keyphrases", "scores"} of each document to output_file
+    '''
+    logger = logging.getLogger()
+    documents = read_documents(input_file, opt.predict_input_format, opt.predict_src_fields)
+    num_docs, decode_time, start_time = 0, 0.0, time.time()
+
+    while True:
+        buffer = list(itertools.islice(documents, opt.stream_buffer_size))
+        if len(buffer) == 0:
+            break
+        examples = [tokenize_document(text, opt.word2id, opt) for _, text in buffer]
+
+        predictions = [None] * len(examples)
+        for batch in micro_batches(examples, opt):
+            batch_examples = [examples[i] for i in batch]
+            src, src_len, src_oov, oov_lists = collate_examples(batch_examples, opt.word2id)
+            batch_start_time = time.time()
+            pred_seq_list = decode_batch(generator, src, src_len, src_oov, oov_lists, opt.word2id)
+            decode_time += time.time() - batch_start_time
+            for i, example, pred_seqs in zip(batch, batch_examples, pred_seq_list):
+                predictions[i] = filter_predictions(pred_seqs, example, opt)
+
+        for (doc_id, _), phrases in zip(buffer, predictions):
+            output_file.write(json.dumps({'id': doc_id, 'keyphrases': [phrase for phrase, _ in phrases],
+                                          'scores': [score for _, score in phrases]}) + '\n')
+        output_file.flush()
+
+        num_docs += len(buffer)
+        logger.info('Predicted %d documents, %.2f docs/s (beam search %.2f docs/s)'
+                    % (num_docs, num_docs / max(time.time() - start_time, 1e-8), num_docs / max(decode_time, 1e-8)))
+
+    return num_docs
+
+
+def open_stream(path, mode):
+    if path == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+    return open(path, mode, encoding='utf-8')
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the gradient accumulation of train.train_ml() under -accum_token_budget (train.TokenBudgetAccumulator):
+    K micro-batches accumulated make the same update as one concatenated batch, also with an RL update
+    (train.train_rl(), whose optimizer covers the same parameters) or a failed batch in between.
+"""
+import argparse
+import copy
+import unittest
+from unittest import mock
+
+import torch
+
+import config
+import pykp.io
+import train
+from pykp.model import Seq2SeqLSTMAttention
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+VOCAB_SIZE = 30
+
+
+def build_opt(**kwargs):
+    parser = argparse.ArgumentParser()
+    config.preprocess_opts(parser)
+    config.model_opts(parser)
+    config.train_opts(parser)
+    config.predict_opts(parser)
+    opt = parser.parse_args(['-data_path_prefix', 'x', '-vocab_path', 'y'])
+    opt.vocab_size = VOCAB_SIZE
+    opt.word_vec_size = 6
+    opt.rnn_size = 8
+    opt.bidirectional = True
+    opt.dropout = 0.0
+    opt.copy_attention = True
+    opt.word2id = dict([(w, i) for i, w in enumerate([pykp.io.PAD_WORD, pykp.io.BOS_WORD, pykp.io.EOS_WORD, pykp.io.UNK_WORD])]
+                       + [('w%d' % i, i) for i in range(4, VOCAB_SIZE)])
+    opt.id2word = dict([(i, w) for w, i in opt.word2id.items()])
+    for k, v in kwargs.items():
+        setattr(opt, k, v)
+    return opt
+
+
+def build_examples(seed=0):
+    '''
+    :return: 6 (src_oov, trg_copy_target, oov_list) sorted by the source length (descending), the first word of each source is an oov,
+        which is also the first word of its target
+    '''
+    generator = torch.Generator().manual_seed(seed)
+    examples = []
+    for i, (src_len, trg_len) in enumerate([(9, 3), (8, 5), (7, 2), (6, 4), (5, 3), (4, 2)]):
+        src_oov = torch.randint(4, VOCAB_SIZE, (src_len,), generator=generator)
+        trg_copy_target = torch.randint(4, VOCAB_SIZE, (trg_len,), generator=generator)
+        src_oov[0], trg_copy_target[0] = VOCAB_SIZE, VOCAB_SIZE
+        examples.append((src_oov, trg_copy_target, ['oov_%d' % i]))
+    return examples
+
+
+def collate(examples):
+    '''
+    :return: an one2one batch (src, src_len, trg (starting with <s>), trg_target, trg_copy_target, src_oov, oov_lists)
+    '''
+    src_len = [len(e[0]) for e in examples]
+    trg_len = max([len(e[1]) for e in examples])
+    src_oov = torch.zeros(len(examples), max(src_len), dtype=torch.long)
+    trg_copy_target = torch.zeros(len(examples), trg_len, dtype=torch.long)
+    for i, e in enumerate(examples):
+        src_oov[i, :len(e[0])] = e[0]
+        trg_copy_target[i, :len(e[1])] = e[1]
+    src = src_oov.masked_fill(src_oov >= VOCAB_SIZE, 3)
+    trg_target = trg_copy_target.masked_fill(trg_copy_target >= VOCAB_SIZE, 3)
+    trg = torch.cat([torch.ones(len(examples), 1, dtype=torch.long), trg_target], dim=1)
+    return src, src_len, trg, trg_target, trg_copy_target, src_oov, [e[2] for e in examples]
+
+
+def fake_train_rl_0(one2many_batch, model, optimizer, generator, opt, reward_engine):
+    '''
+    A policy-gradient-like update: zero the gradients, backprop a loss over all the parameters and step
+    '''
+    optimizer.zero_grad()
+    sum([p.sum() for p in model.parameters()]).backward()
+    optimizer.step()
+    return 0.0
+
+
+class TokenBudgetAccumulatorTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(1)
+        self.opt = build_opt()
+        self.model = Seq2SeqLSTMAttention(self.opt)
+        self.examples = build_examples()
+        self.micro_batches = [collate(self.examples[i: i + 2]) for i in range(0, len(self.examples), 2)]
+        self.num_tokens = sum([len(e[1]) for e in self.examples])
+
+    def expected_parameters(self):
+        '''
+        :return: the parameters after one update on the concatenated batch, without accumulation
+        '''
+        model = copy.deepcopy(self.model)
+        optimizer = torch.optim.SGD(model.parameters(), lr=1.0)
+        self.assertIsNotNone(train.train_ml(collate(self.examples), model, optimizer, None, self.opt)[1])
+        return dict(model.named_parameters())
+
+    def accumulate(self, between_batches=None):
+        '''
+        Train the micro-batches with a TokenBudgetAccumulator of the total number of target words, call between_batches(model) after the first one
+        '''
+        model = copy.deepcopy(self.model)
+        optimizer = torch.optim.SGD(model.parameters(), lr=1.0)
+        accumulator = train.TokenBudgetAccumulator(model, optimizer, self.num_tokens, self.opt.max_grad_norm)
+        accumulator.reset()
+        initial_parameters = [p.detach().clone() for p in model.parameters()]
+        for i, batch in enumerate(self.micro_batches):
+            self.assertIsNotNone(train.train_ml(batch, model, optimizer, None, self.opt, accumulator=accumulator)[1])
+            if i < len(self.micro_batches) - 1:
+                self.assertTrue(all([torch.equal(p, p0) for p, p0 in zip(model.parameters(), initial_parameters)]), 'Updated before the budget')
+            if i == 0 and between_batches is not None:
+                between_batches(model, accumulator)
+        self.assertEqual(accumulator.num_tokens, 0)
+        return dict(model.named_parameters())
+
+    def assert_same_parameters(self, parameters, expected):
+        for name in expected:
+            self.assertTrue(torch.allclose(parameters[name], expected[name], atol=1e-6), name)
+
+    def test_same_update_as_concatenated_batch(self):
+        self.assert_same_parameters(self.accumulate(), self.expected_parameters())
+
+    def test_rl_update_in_between(self):
+        def train_rl(model, accumulator):
+            # the RL learning rate is 0, thus the parameters are unchanged and only the gradients may interfere with the accumulation
+            optimizer_rl = torch.optim.SGD(model.parameters(), lr=0.0)
+            with mock.patch.object(train, 'train_rl_0', fake_train_rl_0):
+                train.train_rl(None, model, optimizer_rl, None, self.opt, None, None, accumulator=accumulator)
+
+        self.assertEqual(self.opt.rl_method, 0)
+        self.assert_same_parameters(self.accumulate(train_rl), self.expected_parameters())
+
+    def test_failed_batch_in_between(self):
+        failed_batch = collate(self.examples[:2])
+
+        def train_failed_batch(model, accumulator):
+            # out of memory on the whole batch, then its first half succeeds and the second half fails
+            forward_nll = model.forward_nll
+            errors = [RuntimeError('CUDA out of memory'), None, RuntimeError('device-side assert triggered')]
+
+            def failing_forward_nll(*args, **kwargs):
+                error = errors.pop(0)
+                if error is not None:
+                    raise error
+                return forward_nll(*args, **kwargs)
+
+            with mock.patch.object(model, 'forward_nll', failing_forward_nll):
+                self.assertEqual(train.train_ml(failed_batch, model, None, None, self.opt, accumulator=accumulator), (0.0, None))
+            self.assertEqual(len(errors), 0)
+
+        self.assert_same_parameters(self.accumulate(train_failed_batch), self.expected_parameters())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Gradient tests of the scripted input-feeding decoder (Seq2SeqLSTMAttention.decode_input_feeding(), pykp.model.input_feeding_decode()),
+    compared with the eager step-by-step decoding of generate() fed with the ground-truth words.
+"""
+import argparse
+import itertools
+import unittest
+
+import torch
+
+import config
+import pykp.io
+from pykp.model import Seq2SeqLSTMAttention
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+VOCAB_SIZE = 30
+
+
+def build_opt(**kwargs):
+    parser = argparse.ArgumentParser()
+    config.preprocess_opts(parser)
+    config.model_opts(parser)
+    config.train_opts(parser)
+    config.predict_opts(parser)
+    opt = parser.parse_args(['-data_path_prefix', 'x', '-vocab_path', 'y'])
+    opt.vocab_size = VOCAB_SIZE
+    opt.word_vec_size = 6
+    opt.rnn_size = 8
+    opt.bidirectional = True
+    opt.dropout = 0.0
+    opt.word2id = dict([(w, i) for i, w in enumerate([pykp.io.PAD_WORD, pykp.io.BOS_WORD, pykp.io.EOS_WORD, pykp.io.UNK_WORD])]
+                       + [('w%d' % i, i) for i in range(4, VOCAB_SIZE)])
+    opt.id2word = dict([(i, w) for w, i in opt.word2id.items()])
+    for k, v in kwargs.items():
+        setattr(opt, k, v)
+    return opt
+
+
+def build_batch(seed=0):
+    '''
+    :return: src, src_len, trg (starting with <s>), trg_target, src_oov and oov_lists of 3 examples, the last one has no oov
+    '''
+    generator = torch.Generator().manual_seed(seed)
+    src_len = [7, 6, 4]
+    src = torch.zeros(3, 7, dtype=torch.long)
+    for i, length in enumerate(src_len):
+        src[i, :length] = torch.randint(4, VOCAB_SIZE, (length,), generator=generator)
+    src_oov = src.clone()
+    oov_lists = [['oov_a', 'oov_b'], ['oov_c'], []]
+    src_oov[0, 1], src_oov[0, 3], src_oov[1, 2] = VOCAB_SIZE, VOCAB_SIZE + 1, VOCAB_SIZE
+    src[0, 1], src[0, 3], src[1, 2] = 3, 3, 3
+
+    trg_target = torch.randint(4, VOCAB_SIZE, (3, 4), generator=generator)
+    trg_target[0, 1], trg_target[1, 0] = VOCAB_SIZE + 1, VOCAB_SIZE
+    trg_target[2, 2:] = 0
+    trg = torch.cat([torch.ones(3, 1, dtype=torch.long), trg_target.masked_fill(trg_target >= VOCAB_SIZE, 3)], dim=1)
+    return src, src_len, trg, trg_target, src_oov, oov_lists
+
+
+def nll(log_probs, trg_target):
+    return -(log_probs.gather(2, trg_target.unsqueeze(2)).squeeze(2) * trg_target.ne(0).type_as(log_probs)).sum()
+
+
+def eager_log_probs(model, src, src_len, trg, src_oov, oov_lists):
+    '''
+    Teacher forcing by running generate() word by word, the attentional vectors are fed through the decoder states
+    '''
+    ctx_mask = model.get_mask(src)
+    enc_context, (enc_h, enc_c) = model.encode(src, src_len)
+    dec_hidden = model.init_decoder_state(enc_h, enc_c)
+    log_probs = []
+    for t in range(trg.size(1) - 1):
+        log_prob, dec_hidden = model.generate(trg[:, t: t + 1], dec_hidden, enc_context, ctx_mask=ctx_mask, src_map=src_oov, oov_list=oov_lists, max_len=1)
+        log_probs.append(log_prob)
+    return torch.cat(log_probs, dim=1)
+
+
+class InputFeedingGradientTest(unittest.TestCase):
+    # (input_feeding, copy_input_feeding, copy_attention, reuse_copy_attn), copy_input_feeding is disabled by the model without copy_attention
+    SETTINGS = [setting for setting in itertools.product([True, False], [True, False], [True, False], [False, True])
+                if (setting[0] or setting[1]) and (setting[2] or not setting[3])]
+
+    def build_model(self, input_feeding, copy_input_feeding, copy_attention, reuse_copy_attn):
+        torch.manual_seed(1)
+        opt = build_opt(input_feeding=input_feeding, copy_input_feeding=copy_input_feeding, copy_attention=copy_attention,
+                        reuse_copy_attn=reuse_copy_attn, copy_mode='general', attention_mode='general')
+        model = Seq2SeqLSTMAttention(opt)
+        model.eval()
+        return model
+
+    def test_loss_and_gradients_match_eager_loop(self):
+        src, src_len, trg, trg_target, src_oov, oov_lists = build_batch()
+        for setting in self.SETTINGS:
+            with self.subTest(input_feeding=setting[0], copy_input_feeding=setting[1], copy_attention=setting[2], reuse_copy_attn=setting[3]):
+                model = self.build_model(*setting)
+                targets = trg_target if model.copy_attention else trg_target.masked_fill(trg_target >= VOCAB_SIZE, 3)
+
+                model.zero_grad()
+                scripted_log_probs = model.forward(src, src_len, trg, src_oov, oov_lists)[0]
+                scripted_loss = nll(scripted_log_probs, targets)
+                scripted_loss.backward()
+                scripted_grads = dict([(name, p.grad.clone()) for name, p in model.named_parameters() if p.grad is not None])
+
+                model.zero_grad()
+                eager_log_probs_ = eager_log_probs(model, src, src_len, trg, src_oov, oov_lists)
+                eager_loss = nll(eager_log_probs_, targets)
+                eager_loss.backward()
+                eager_grads = dict([(name, p.grad.clone()) for name, p in model.named_parameters() if p.grad is not None])
+
+                self.assertTrue(torch.allclose(scripted_log_probs, eager_log_probs_, atol=1e-5))
+                self.assertAlmostEqual(scripted_loss.item(), eager_loss.item(), places=4)
+                self.assertEqual(set(scripted_grads.keys()), set(eager_grads.keys()))
+                for name in eager_grads:
+                    self.assertTrue(torch.allclose(scripted_grads[name], eager_grads[name], atol=1e-5), name)
+
+    def test_gradcheck(self):
+        src, _, trg, _, _, _ = build_batch()
+        for setting in [(True, False, False, False), (True, True, True, False), (False, True, True, False)]:
+            with self.subTest(input_feeding=setting[0], copy_input_feeding=setting[1], copy_attention=setting[2]):
+                model = self.build_model(*setting).double()
+                ctx_mask = model.get_mask(src).double()
+                # random encoder outputs, the encoder (with its float initial states) is not part of the scripted decoder
+                generator = torch.Generator().manual_seed(2)
+                context_dim = model.encoder2decoder_hidden.in_features
+                enc_context = torch.randn(src.size(0), src.size(1), context_dim, generator=generator).double()
+                with torch.no_grad():
+                    init_hidden = model.init_decoder_state(torch.randn(src.size(0), context_dim, generator=generator).double(),
+                                                           torch.randn(src.size(0), context_dim, generator=generator).double())
+                    trg_emb = model.embedding(trg[:, :-1]).permute(1, 0, 2)
+
+                def decode(trg_emb, enc_context):
+                    h_tildes, _, _, _, copy_logits = model.decode_input_feeding(trg_emb, enc_context, init_hidden, ctx_mask)
+                    return (h_tildes, copy_logits) if copy_logits is not None else h_tildes
+
+                self.assertTrue(torch.autograd.gradcheck(decode, (trg_emb.clone().requires_grad_(), enc_context.clone().requires_grad_())))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,8 +2,10 @@
 """
 Python File Template 
 """
+import argparse
 import json
 import os
+import shlex
 
 import logging
 import numpy as np
@@ -15,11 +17,14 @@ import torch
 
 from beam_search import SequenceGenerator
 from evaluate import evaluate_beam_search, get_match_result, self_redundancy
-from pykp.dataloader import KeyphraseDataLoader
-from utils import Progbar, plot_learning_curve_and_write_csv
+from pykp.dataloader import KeyphraseDataLoader, build_beam_search_batch_sampler, load_vocab_and_datasets_for_testing
+from utils import Progbar, plot_learning_curve_and_write_csv, OOMSplitStats, split_on_oom
 
+import config
 from config import init_logging, init_opt
 import pykp
+from pykp.distill import Distiller, SoftTargetCache
+from pykp.reward import RewardEngine
 from pykp.io import KeyphraseDataset
 from pykp.model import Seq2SeqLSTMAttention, Seq2SeqLSTMAttentionCascading
 
@@ -94,9 +99,80 @@ def _valid_error(data_loader, model, criterion, epoch, opt):
     return losses
 
 
-def train_ml(one2one_batch, model, optimizer, criterion, opt):
+class TokenBudgetAccumulator(object):
+    '''
+    Gradient accumulation over micro-batches until the number of target words (non-padding) reaches token_budget.
+    Each micro-batch backprops the sum of its NLL, and the accumulated gradients are divided by the total number of words before the update,
+        thus the update is the same as the one of a big batch averaging over all the words, while only one micro-batch is in memory at a time.
+    '''
+    def __init__(self, model, optimizer, token_budget, max_grad_norm):
+        self.model = model
+        self.optimizer = optimizer
+        self.token_budget = token_budget
+        self.max_grad_norm = max_grad_norm
+        self.num_tokens = 0
+        self.num_batches = 0
+
+    def add(self, num_tokens):
+        self.num_tokens += num_tokens
+        self.num_batches += 1
+
+    def ready(self):
+        return self.num_tokens >= self.token_budget
+
+    def step(self):
+        '''
+        Normalize the accumulated gradients by the number of words, clip and update, then start a new accumulation
+        '''
+        if self.num_tokens > 0:
+            for p in self.model.parameters():
+                if p.grad is not None:
+                    p.grad.data.div_(self.num_tokens)
+            if self.max_grad_norm > 0:
+                torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.max_grad_norm)
+            self.optimizer.step()
+            logging.debug('Updated with %d accumulated batches, %d target words' % (self.num_batches, self.num_tokens))
+        self.reset()
+
+    def reset(self):
+        self.optimizer.zero_grad()
+        self.num_tokens = 0
+        self.num_batches = 0
+
+
+def stash_gradients(model):
+    '''
+    Take the gradients away from the parameters, thus the following backward starts from None and its gradients can be dropped if it fails
+    '''
+    stashed_grads = []
+    for p in model.parameters():
+        stashed_grads.append(p.grad)
+        p.grad = None
+    return stashed_grads
+
+
+def restore_gradients(model, stashed_grads, merge=True):
+    '''
+    Put the stashed gradients back, add the new gradients to them if merge, otherwise drop the new gradients
+    '''
+    for p, stashed_grad in zip(model.parameters(), stashed_grads):
+        if merge and p.grad is not None:
+            if stashed_grad is not None:
+                p.grad = stashed_grad.add_(p.grad)
+        else:
+            p.grad = stashed_grad
+
+
+def train_ml(one2one_batch, model, optimizer, criterion, opt, accumulator=None, oom_stats=None, distiller=None):
+    '''
+    :param accumulator: a TokenBudgetAccumulator, if given the gradients are accumulated and the optimizer steps only when the token budget is reached
+    :param oom_stats: an OOMSplitStats, on out-of-memory the batch is split into pieces (see utils.split_on_oom()) and the splits are recorded in it
+    :param distiller: a pykp.distill.Distiller, if given the loss is the cross-entropy to the mixture of the ground-truth and the teacher's soft targets
+    '''
+    # the soft targets are looked up by the ids of the examples, before moving them to GPU
+    soft_targets = distiller.soft_targets(one2one_batch) if distiller is not None else None
+
     src, src_len, trg, trg_target, trg_copy_target, src_oov, oov_lists = one2one_batch
-    max_oov_number = max([len(oov) for oov in oov_lists])
 
     print("src size - ", src.size())
     print("target size - ", trg.size())
@@ -107,114 +183,91 @@ def train_ml(one2one_batch, model, optimizer, criterion, opt):
         trg_target = trg_target.cuda()
         trg_copy_target = trg_copy_target.cuda()
         src_oov = src_oov.cuda()
-
-    optimizer.zero_grad()
-
+        if soft_targets is not None:
+            soft_targets = (soft_targets[0].cuda(), soft_targets[1].cuda())
+
+    if accumulator is None:
+        optimizer.zero_grad()
+
+    target = trg_copy_target if opt.copy_attention else trg_target
+    num_tokens = int(target.ne(opt.word2id[pykp.io.PAD_WORD]).sum().item())
+    loss_scale = (1 - opt.loss_scale) if opt.train_rl else 1.0
+
+    def train_piece(start, end):
+        # trim the paddings of the shorter sources, the examples are sorted by the source length
+        piece_src_len = max(src_len[start: end])
+        stashed_grads = stash_gradients(model)
+        succeeded = False
+        try:
+            # only the non-padding target words go through the output layer, with -fused_loss they are computed chunk by chunk,
+            #   never materialize the full (batch_size, trg_len, vocab_size + max_oov_number) log-probs
+            nll, pred_log_probs, pred_ids = model.forward_nll(src[start: end, :piece_src_len], src_len[start: end], trg[start: end], target[start: end],
+                                                              src_oov[start: end, :piece_src_len], oov_lists[start: end],
+                                                              chunk_size=opt.loss_chunk_size if opt.fused_loss else None,
+                                                              soft_targets=(soft_targets[0][start: end], soft_targets[1][start: end]) if soft_targets is not None else None)
+
+            # same to NLLLoss(ignore_index=PAD), average over the non-padding words of the whole batch, thus the gradients of pieces add up
+            # with accumulation, backprop the sum and normalize by the number of words of all the micro-batches in accumulator.step()
+            loss_sum = nll.sum() * loss_scale
+
+            start_time = time.time()
+            if accumulator is None:
+                (loss_sum / num_tokens).backward()
+            else:
+                loss_sum.backward()
+            print("--backward- %s seconds ---" % (time.time() - start_time))
+            succeeded = True
+        finally:
+            restore_gradients(model, stashed_grads, merge=succeeded)
+
+        return loss_sum.item(), pred_log_probs.detach(), pred_ids
+
+    # if the batch fails after some of its pieces, all its gradients are dropped, the ones accumulated by the previous batches are kept
+    batch_stashed_grads = stash_gradients(model)
     try:
-        decoder_log_probs, _, _ = model.forward(src, src_len, trg, src_oov, oov_lists)
-
-
-        # simply average losses of all the predicitons
-        # IMPORTANT, must use logits instead of probs to compute the loss, otherwise it's super super slow at the beginning (grads of probs are small)!
-        start_time = time.time()
-
-        if not opt.copy_attention:
-            loss = criterion(
-                decoder_log_probs.contiguous().view(-1, opt.vocab_size),
-                trg_target.contiguous().view(-1)
-            )
-        else:
-            loss = criterion(
-                decoder_log_probs.contiguous().view(-1, opt.vocab_size + max_oov_number),
-                trg_copy_target.contiguous().view(-1)
-            )
-        if opt.train_rl:
-            loss = loss * (1 - opt.loss_scale)
-        print("--loss calculation- %s seconds ---" % (time.time() - start_time))
-
-        start_time = time.time()
-        loss.backward()
-        print("--backward- %s seconds ---" % (time.time() - start_time))
+        pieces = split_on_oom(train_piece, 0, len(src_len), oom_stats)
+    except RuntimeError as re:
+        logging.exception("Encountered a RuntimeError")
+        restore_gradients(model, batch_stashed_grads, merge=False)
+        return 0.0, None
+    restore_gradients(model, batch_stashed_grads)
 
+    if accumulator is None:
         if opt.max_grad_norm > 0:
             pre_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), opt.max_grad_norm)
             after_norm = (sum([p.grad.data.norm(2) ** 2 for p in model.parameters() if p.grad is not None])) ** (1.0 / 2)
             # logging.info('clip grad (%f -> %f)' % (pre_norm, after_norm))
 
         optimizer.step()
+    else:
+        accumulator.add(num_tokens)
+        if accumulator.ready():
+            accumulator.step()
 
-        if torch.cuda.is_available():
-            loss_value = loss.cpu().data.numpy()
-        else:
-            loss_value = loss.data.numpy()
-
-    except RuntimeError as re:
-        logging.exception("Encountered a RuntimeError")
-        loss_value = 0.0
-        decoder_log_probs = []
+    loss_value = sum([piece[0] for piece in pieces]) / num_tokens
+    greedy_preds = (torch.cat([piece[1] for piece in pieces], dim=0), torch.cat([piece[2] for piece in pieces], dim=0))
 
-    return loss_value, decoder_log_probs
+    return loss_value, greedy_preds
 
 
-def train_rl_0(one2many_batch, model, optimizer, generator, opt):
+def train_rl_0(one2many_batch, model, optimizer, generator, opt, reward_engine):
     src_list, src_len, trg_list, _, trg_copy_target_list, src_oov_map_list, oov_list = one2many_batch
 
     if torch.cuda.is_available():
         src_list = src_list.cuda()
         src_oov_map_list = src_oov_map_list.cuda()
 
-    # Baseline sequences for self-critic
-    baseline_seqs_list = generator.sample(src_list, src_len, src_oov_map_list, oov_list, opt.word2id, k=5, is_greedy=True)
-
-    # Sample number_batch*beam_size sequences
-    sampled_seqs_list = generator.sample(src_list, src_len, src_oov_map_list, oov_list, opt.word2id, k=5, is_greedy=False)
+    # Sample number_batch*5 sequences, and the greedy ones as baseline for self-critic in the same pass
+    sampled_seqs_list, sampled_log_probs_list, baseline_seqs_list, _ = generator.sample_batch(src_list, src_len, src_oov_map_list, oov_list, opt.word2id,
+                                                                                             k=5, greedy_baseline=True)
 
-    policy_loss = []
-    policy_rewards = []
-    # Compute their rewards and losses
-    for seq_i, (src, trg, trg_copy, sampled_seqs, baseline_seqs, oov) in enumerate(zip(src_list, trg_list, trg_copy_target_list, sampled_seqs_list, baseline_seqs_list, oov_list)):
-        # convert to string sequences
-        baseline_str_seqs = [[opt.id2word[x] if x < opt.vocab_size else oov[x - opt.vocab_size] for x in to_cpu_list(seq.sentence)] for seq in baseline_seqs]
-        baseline_str_seqs = [seq[:seq.index(pykp.io.EOS_WORD) + 1] if pykp.io.EOS_WORD in seq else seq for seq in baseline_str_seqs]
-        sampled_str_seqs = [[opt.id2word[x] if x < opt.vocab_size else oov[x - opt.vocab_size] for x in to_cpu_list(seq.sentence)] for seq in sampled_seqs]
-        sampled_str_seqs = [seq[:seq.index(pykp.io.EOS_WORD) + 1] if pykp.io.EOS_WORD in seq else seq for seq in sampled_str_seqs]
-
-        # pad trg seqs with EOS to the same length
-        trg_seqs = [[opt.id2word[x] if x < opt.vocab_size else oov[x - opt.vocab_size] for x in seq] for seq in trg_copy]
-        # trg_seqs            =  [seq + [pykp.IO.EOS_WORD] * (opt.max_sent_length - len(seq)) for seq in trg_seqs]
-
-        # local rewards (bleu)
-        bleu_baselines = get_match_result(true_seqs=trg_seqs, pred_seqs=baseline_str_seqs, type='bleu')
-        bleu_samples = get_match_result(true_seqs=trg_seqs, pred_seqs=sampled_str_seqs, type='bleu')
-
-        # global rewards
-        match_baselines = get_match_result(true_seqs=trg_seqs, pred_seqs=baseline_str_seqs, type='exact')
-        match_samples = get_match_result(true_seqs=trg_seqs, pred_seqs=sampled_str_seqs, type='exact')
-
-        _, _, fscore_baselines = evaluate.evaluate(match_baselines, baseline_str_seqs, trg_seqs, topk=5)
-        _, _, fscore_samples = evaluate.evaluate(match_samples, sampled_str_seqs, trg_seqs, topk=5)
-
-        # compute the final rewards
-        alpha = 0.0
-        baseline = alpha * np.average(bleu_baselines) + (1.0 - alpha) * fscore_baselines
-        rewards = alpha * np.asarray(bleu_samples) + (1.0 - alpha) * fscore_samples
-
-        """
-        print('*' * 20 + '  ' + str(seq_i) + '  ' + '*' * 20)
-        print('Target Sequences:\n\t\t %s' % str(trg_seqs))
-        print('Baseline Sequences:')
-        for pred_seq, reward in zip(baseline_str_seqs, baselines):
-            print('\t\t[%f] %s' % (reward, ' '.join(pred_seq)))
-        print('Predict Sequences:')
-        for pred_seq, reward in zip(sampled_str_seqs, rewards):
-            print('\t\t[%f] %s' % (reward, ' '.join(pred_seq)))
-        """
-
-        [policy_loss.append(-torch.stack(seq.logprobs, dim=0) * float(reward - baseline)) for seq, reward in zip(sampled_seqs, rewards)]
-        [policy_rewards.append(reward) for reward in rewards]
+    # rewards (batch_size, 5) of the samples and the baseline (batch_size) of each document, F-score@5 to the targets
+    rewards, baselines = reward_engine.score(sampled_seqs_list, trg_copy_target_list, oov_list, baseline_ids=baseline_seqs_list)
+    advantages = torch.from_numpy((rewards - baselines[:, None]).astype(np.float32)).to(sampled_log_probs_list.device)
 
     optimizer.zero_grad()
-    policy_loss = torch.cat(policy_loss).sum() * (1 - opt.loss_scale)
+    # (batch_size, 5, max_sent_length) log-probs of the sampled words
+    policy_loss = (-sampled_log_probs_list * advantages.unsqueeze(2)).sum() * (1 - opt.loss_scale)
     policy_loss.backward()
 
     if opt.max_grad_norm > 0:
@@ -223,76 +276,68 @@ def train_rl_0(one2many_batch, model, optimizer, generator, opt):
         # logging.info('clip grad (%f -> %f)' % (pre_norm, after_norm))
 
     optimizer.step()
-    return np.average(policy_rewards)
+    return np.average(rewards)
 
 
 class RewardCache(object):
-
+    '''
+    The last capacity rewards in a ring buffer, the average is kept by a running sum
+    '''
     def __init__(self, capacity=2000):
         # vanilla replay memory
         self.capacity = capacity
-        self.memory = []
+        self.memory = np.zeros(capacity, dtype=np.float64)
         self.reset()
 
     def push(self, stuff):
-        if len(self.memory) == self.capacity:
-            self.memory = self.memory[1:]
-        self.memory.append(stuff)
+        if self.size == self.capacity:
+            self.total -= self.memory[self.index]
+        else:
+            self.size += 1
+        self.memory[self.index] = stuff
+        self.total += stuff
+        self.index = (self.index + 1) % self.capacity
+        # re-sum once per round to avoid the drift of the running sum
+        if self.index == 0:
+            self.total = float(np.sum(self.memory[:self.size]))
 
     def get_average(self):
-        if len(self.memory) == 0:
+        if self.size == 0:
             return 0
-        return np.mean(np.array(self.memory))
+        return self.total / self.size
 
     def reset(self):
-        self.memory = []
+        self.index = 0
+        self.size = 0
+        self.total = 0.0
 
     def __len__(self):
-        return len(self.memory)
+        return self.size
 
 
-def train_rl_1(one2many_batch, model, optimizer, generator, opt, reward_cache):
+def train_rl_1(one2many_batch, model, optimizer, generator, opt, reward_cache, reward_engine):
     src_list, src_len, trg_list, _, trg_copy_target_list, src_oov_map_list, oov_list = one2many_batch
 
     if torch.cuda.is_available():
         src_list = src_list.cuda()
         src_oov_map_list = src_oov_map_list.cuda()
 
-    # Sample number_batch sequences
-    sampled_seqs_list = generator.sample(src_list, src_len, src_oov_map_list, oov_list, opt.word2id, k=5, is_greedy=False)
-
-    policy_loss = []
-    policy_rewards = []
-    # Compute their rewards and losses
-    for seq_i, (src, trg, trg_copy, sampled_seqs, oov) in enumerate(zip(src_list, trg_list, trg_copy_target_list, sampled_seqs_list, oov_list)):
-        # convert to string sequences
-        sampled_str_seqs = [[opt.id2word[x] if x < opt.vocab_size else oov[x - opt.vocab_size] for x in to_cpu_list(seq.sentence)] for seq in sampled_seqs]
-        sampled_str_seqs = [seq[:seq.index(pykp.io.EOS_WORD) + 1] if pykp.io.EOS_WORD in seq else seq for seq in sampled_str_seqs]
-
-        # pad trg seqs with EOS to the same length
-        trg_seqs = [[opt.id2word[x] if x < opt.vocab_size else oov[x - opt.vocab_size] for x in seq] for seq in trg_copy]
-        # trg_seqs            =  [seq + [pykp.IO.EOS_WORD] * (opt.max_sent_length - len(seq)) for seq in trg_seqs]
+    # Sample number_batch*5 sequences
+    sampled_seqs_list, sampled_log_probs_list = generator.sample_batch(src_list, src_len, src_oov_map_list, oov_list, opt.word2id, k=5)
 
-        # local rewards (bleu)
-        bleu_samples = get_match_result(true_seqs=trg_seqs, pred_seqs=sampled_str_seqs, type='bleu')
+    # rewards (batch_size, 5), F-score@5 to the targets
+    rewards, _ = reward_engine.score(sampled_seqs_list, trg_copy_target_list, oov_list)
 
-        # global rewards
-        match_samples = get_match_result(true_seqs=trg_seqs, pred_seqs=sampled_str_seqs, type='exact')
-
-        _, _, fscore_samples = evaluate.evaluate(match_samples, sampled_str_seqs, trg_seqs, topk=5)
-
-        # compute the final rewards
-        alpha = 0.0
-        rewards = alpha * np.asarray(bleu_samples) + (1.0 - alpha) * fscore_samples
-        baseline = reward_cache.get_average()
-        for reward in rewards:
+    # the baseline of each document is the running average of rewards before it
+    baselines = []
+    for doc_rewards in rewards:
+        baselines.append(reward_cache.get_average())
+        for reward in doc_rewards:
             reward_cache.push(float(reward))
-
-        [policy_loss.append(-torch.stack(seq.logprobs, dim=0).sum() * float(reward - baseline)) for seq, reward in zip(sampled_seqs, rewards)]
-        [policy_rewards.append(reward) for reward in rewards]
+    advantages = torch.from_numpy((rewards - np.asarray(baselines)[:, None]).astype(np.float32)).to(sampled_log_probs_list.device)
 
     optimizer.zero_grad()
-    policy_loss = torch.stack(policy_loss).mean() * (1 - opt.loss_scale)
+    policy_loss = (-sampled_log_probs_list.sum(dim=2) * advantages).mean() * (1 - opt.loss_scale)
     policy_loss.backward()
 
     if opt.max_grad_norm > 0:
@@ -301,7 +346,7 @@ def train_rl_1(one2many_batch, model, optimizer, generator, opt, reward_cache):
         # logging.info('clip grad (%f -> %f)' % (pre_norm, after_norm))
 
     optimizer.step()
-    return np.average(policy_rewards)
+    return np.average(rewards)
 
 
 def train_rl_2(one2many_batch, model, optimizer, generator, opt, reward_cache):
@@ -311,28 +356,29 @@ def train_rl_2(one2many_batch, model, optimizer, generator, opt, reward_cache):
         src_list = src_list.cuda()
         src_oov_map_list = src_oov_map_list.cuda()
 
-    # Sample number_batch sequences
-    sampled_seqs_list = generator.sample(src_list, src_len, src_oov_map_list, oov_list, opt.word2id, k=5, is_greedy=False)
+    # Sample number_batch*5 sequences
+    sampled_seqs_list, sampled_log_probs_list = generator.sample_batch(src_list, src_len, src_oov_map_list, oov_list, opt.word2id, k=5)
+    sampled_seqs_list = sampled_seqs_list.cpu().tolist()
+    eos_id = opt.word2id[pykp.io.EOS_WORD]
 
     policy_loss = []
     policy_rewards = []
     # Compute their rewards and losses
-    for seq_i, (src, trg, trg_copy, sampled_seqs, oov) in enumerate(zip(src_list, trg_list, trg_copy_target_list, sampled_seqs_list, oov_list)):
-        # convert to string sequences
-        sampled_str_seqs = [[opt.id2word[x] if x < opt.vocab_size else oov[x - opt.vocab_size] for x in to_cpu_list(seq.sentence)] for seq in sampled_seqs]
-        sampled_str_seqs = [seq[:seq.index(pykp.io.EOS_WORD) + 1] if pykp.io.EOS_WORD in seq else seq for seq in sampled_str_seqs]
+    for seq_i, sampled_seqs in enumerate(sampled_seqs_list):
+        # cut off the words after EOS, the redundancy is computed on word ids (unique words of a document in the extended vocab)
+        sampled_seqs = [seq[:seq.index(eos_id) + 1] if eos_id in seq else seq for seq in sampled_seqs]
 
-        redundancy = self_redundancy(sampled_str_seqs)
+        redundancy = self_redundancy(sampled_seqs)
         reward = 1.0 - redundancy  # the less redundant, the better
 
         baseline = reward_cache.get_average()
         reward_cache.push(float(reward))
 
-        [policy_loss.append(-torch.stack(seq.logprobs, dim=0).sum() * float(reward - baseline)) for seq in sampled_seqs]
+        policy_loss.append(-sampled_log_probs_list[seq_i].sum(dim=1) * float(reward - baseline))
         policy_rewards.append(reward)
 
     optimizer.zero_grad()
-    policy_loss = torch.stack(policy_loss).mean() * (1 - opt.loss_scale)
+    policy_loss = torch.cat(policy_loss).mean() * (1 - opt.loss_scale)
     policy_loss.backward()
 
     if opt.max_grad_norm > 0:
@@ -344,16 +390,29 @@ def train_rl_2(one2many_batch, model, optimizer, generator, opt, reward_cache):
     return np.average(policy_rewards)
 
 
-def train_rl(one2many_batch, model, optimizer, generator, opt, reward_cache):
-    if opt.rl_method == 0:
-        return train_rl_0(one2many_batch, model, optimizer, generator, opt)
-    elif opt.rl_method == 1:
-        return train_rl_1(one2many_batch, model, optimizer, generator, opt, reward_cache)
-    elif opt.rl_method == 2:
-        return train_rl_2(one2many_batch, model, optimizer, generator, opt, reward_cache)
-
-
-def brief_report(epoch, batch_i, one2one_batch, loss_ml, decoder_log_probs, opt):
+def train_rl(one2many_batch, model, optimizer, generator, opt, reward_cache, reward_engine, accumulator=None):
+    '''
+    :param accumulator: the TokenBudgetAccumulator of train_ml(), if given its accumulated gradients are stashed during the RL update,
+        the RL optimizer covers the same parameters and would otherwise zero them, and the RL gradients would be applied again by accumulator.step()
+    '''
+    if accumulator is not None:
+        stashed_grads = stash_gradients(model)
+    try:
+        if opt.rl_method == 0:
+            return train_rl_0(one2many_batch, model, optimizer, generator, opt, reward_engine)
+        elif opt.rl_method == 1:
+            return train_rl_1(one2many_batch, model, optimizer, generator, opt, reward_cache, reward_engine)
+        elif opt.rl_method == 2:
+            return train_rl_2(one2many_batch, model, optimizer, generator, opt, reward_cache)
+    finally:
+        if accumulator is not None:
+            restore_gradients(model, stashed_grads, merge=False)
+
+
+def brief_report(epoch, batch_i, one2one_batch, loss_ml, greedy_preds, opt):
+    '''
+    :param greedy_preds: (pred_log_probs, pred_ids), log-probs and indexes of top 1 predicted words, both are (batch_size, trg_len)
+    '''
     logging.info('======================  %d  =========================' % (batch_i))
 
     logging.info('Epoch : %d Minibatch : %d, Loss=%.5f' % (epoch, batch_i, np.mean(loss_ml)))
@@ -361,16 +420,17 @@ def brief_report(epoch, batch_i, one2one_batch, loss_ml, decoder_log_probs, opt)
     logging.info('Printing predictions on %d sampled examples by greedy search' % sampled_size)
 
     src, _, trg, trg_target, trg_copy_target, src_ext, oov_lists = one2one_batch
+    pred_log_probs, max_words_pred = greedy_preds
     if torch.cuda.is_available():
         src = src.data.cpu().numpy()
-        decoder_log_probs = decoder_log_probs.data.cpu().numpy()
-        max_words_pred = decoder_log_probs.argmax(axis=-1)
+        pred_log_probs = pred_log_probs.data.cpu().numpy()
+        max_words_pred = max_words_pred.data.cpu().numpy()
         trg_target = trg_target.data.cpu().numpy()
         trg_copy_target = trg_copy_target.data.cpu().numpy()
     else:
         src = src.data.numpy()
-        decoder_log_probs = decoder_log_probs.data.numpy()
-        max_words_pred = decoder_log_probs.argmax(axis=-1)
+        pred_log_probs = pred_log_probs.data.numpy()
+        max_words_pred = max_words_pred.data.numpy()
         trg_target = trg_target.data.numpy()
         trg_copy_target = trg_copy_target.data.numpy()
 
@@ -378,7 +438,7 @@ def brief_report(epoch, batch_i, one2one_batch, loss_ml, decoder_log_probs, opt)
     src = src[sampled_trg_idx]
     oov_lists = [oov_lists[i] for i in sampled_trg_idx]
     max_words_pred = [max_words_pred[i] for i in sampled_trg_idx]
-    decoder_log_probs = decoder_log_probs[sampled_trg_idx]
+    pred_log_probs = pred_log_probs[sampled_trg_idx]
     if not opt.copy_attention:
         trg_target = [trg_target[i] for i in
                       sampled_trg_idx]  # use the real target trg_loss (the starting <BOS> has been removed and contains oov ground-truth)
@@ -387,7 +447,7 @@ def brief_report(epoch, batch_i, one2one_batch, loss_ml, decoder_log_probs, opt)
 
     for i, (src_wi, pred_wi, trg_i, oov_i) in enumerate(
             zip(src, max_words_pred, trg_target, oov_lists)):
-        nll_prob = -np.sum([decoder_log_probs[i][l][pred_wi[l]] for l in range(len(trg_i))])
+        nll_prob = -np.sum([pred_log_probs[i][l] for l in range(len(trg_i))])
         find_copy = np.any([x >= opt.vocab_size for x in src_wi])
         has_copy = np.any([x >= opt.vocab_size for x in trg_i])
 
@@ -414,10 +474,15 @@ def brief_report(epoch, batch_i, one2one_batch, loss_ml, decoder_log_probs, opt)
 
 
 def train_model(model, optimizer_ml, optimizer_rl, criterion, train_data_loader, valid_data_loaders, test_data_loaders, opt):
+    shortlist = torch.load(open(opt.shortlist_path, 'rb')) if opt.shortlist_path else None
     generator = SequenceGenerator(model,
                                   eos_id=opt.word2id[pykp.io.EOS_WORD],
                                   beam_size=opt.beam_size,
-                                  max_sequence_length=opt.max_sent_length
+                                  max_sequence_length=opt.max_sent_length,
+                                  n_best=opt.n_best,
+                                  dedup=opt.beam_dedup,
+                                  block_ngram=opt.beam_block_ngram,
+                                  shortlist=shortlist
                                   )
     logger = logging.getLogger('train.py')
     logger.info('======================  Checking GPU Availability  =========================')
@@ -447,6 +512,24 @@ def train_model(model, optimizer_ml, optimizer_rl, criterion, train_data_loader,
     early_stop_flag = False
     if opt.train_rl:
         reward_cache = RewardCache(2000)
+        reward_engine = RewardEngine(opt.id2word, opt.vocab_size, opt.word2id[pykp.io.EOS_WORD], num_workers=opt.rl_reward_workers)
+
+    distiller = None
+    if opt.train_ml and opt.teacher_model:
+        teacher, teacher_opt = init_teacher(opt)
+        cache = SoftTargetCache(opt.distill_cache_path or '%s.top%d.cache' % (opt.teacher_model, opt.distill_topk), opt.distill_topk)
+        distiller = Distiller(teacher, cache, opt, teacher_opt)
+        logger.info('Distilling the teacher %s, top %d soft targets with weight %.2f, %d examples cached in %s'
+                    % (opt.teacher_model, opt.distill_topk, opt.distill_alpha, len(cache), cache.path))
+
+    # the batches split on out-of-memory in training, reported every epoch
+    oom_stats = OOMSplitStats('train')
+
+    accumulator = None
+    if opt.train_ml and opt.accum_token_budget > 0:
+        logger.info('Accumulating gradients until %d target words per update' % opt.accum_token_budget)
+        accumulator = TokenBudgetAccumulator(model, optimizer_ml, opt.accum_token_budget, opt.max_grad_norm)
+        accumulator.reset()
 
     # if False:  # opt.train_from:
     #     state_path = opt.train_from.replace('.model', '.state')
@@ -471,10 +554,21 @@ def train_model(model, optimizer_ml, optimizer_rl, criterion, train_data_loader,
 
             # Training
             if opt.train_ml:
-                loss_ml, decoder_log_probs = train_ml(one2one_batch, model, optimizer_ml, criterion, opt)
-
-                # len(decoder_log_probs) == 0 if encountered OOM
-                if len(decoder_log_probs) == 0:
+                loss_ml, greedy_preds = train_ml(one2one_batch, model, optimizer_ml, criterion, opt, accumulator=accumulator, oom_stats=oom_stats,
+                                                 distiller=distiller)
+                # apply the leftover of accumulation at the end of epoch
+                if accumulator is not None and batch_i == len(train_data_loader) - 1:
+                    accumulator.step()
+                # report the out-of-memory splits of this epoch
+                if batch_i == len(train_data_loader) - 1:
+                    oom_stats.log_summary(logger)
+                    oom_stats.reset()
+                    # the teacher's soft targets of all the examples are predicted in the first epoch
+                    if distiller is not None:
+                        distiller.cache.save()
+
+                # greedy_preds is None if failed even after splitting the batch (e.g. a single example out-of-memory)
+                if greedy_preds is None:
                     continue
 
                 train_ml_losses.append(loss_ml)
@@ -483,12 +577,12 @@ def train_model(model, optimizer_ml, optimizer_rl, criterion, train_data_loader,
 
                 # Brief report
                 if batch_i % opt.report_every == 0:
-                    brief_report(epoch, batch_i, one2one_batch, loss_ml, decoder_log_probs, opt)
+                    brief_report(epoch, batch_i, one2one_batch, loss_ml, greedy_preds, opt)
 
             # do not apply rl in 0th epoch, need to get a resonable model before that.
             if opt.train_rl:
                 if epoch >= opt.rl_start_epoch:
-                    loss_rl = train_rl(one2many_batch, model, optimizer_rl, generator, opt, reward_cache)
+                    loss_rl = train_rl(one2many_batch, model, optimizer_rl, generator, opt, reward_cache, reward_engine, accumulator=accumulator)
                 else:
                     loss_rl = 0.0
                 train_rl_losses.append(loss_rl)
@@ -624,6 +718,9 @@ def train_model(model, optimizer_ml, optimizer_rl, criterion, train_data_loader,
 
                 logging.info('*' * 50)
 
+    if opt.train_rl:
+        reward_engine.close()
+
 
 def load_data_vocab_for_training(opt, load_train=True):
 
@@ -692,6 +789,7 @@ def load_data_vocab_for_training(opt, load_train=True):
                                                 num_workers=opt.batch_workers,
                                                 max_batch_example=opt.beam_search_batch_example,
                                                 max_batch_pair=opt.beam_search_batch_size,
+                                                batch_sampler=build_beam_search_batch_sampler(valid_one2many_dataset, opt),
                                                 pin_memory=pin_memory,
                                                 shuffle=False)
     test_one2many_loader = KeyphraseDataLoader(dataset=test_one2many_dataset,
@@ -699,6 +797,7 @@ def load_data_vocab_for_training(opt, load_train=True):
                                                num_workers=opt.batch_workers,
                                                max_batch_example=opt.beam_search_batch_example,
                                                max_batch_pair=opt.beam_search_batch_size,
+                                               batch_sampler=build_beam_search_batch_sampler(test_one2many_dataset, opt),
                                                pin_memory=pin_memory,
                                                shuffle=False)
 
@@ -719,61 +818,6 @@ def load_data_vocab_for_training(opt, load_train=True):
     return train_one2many_loader, valid_one2many_loader, test_one2many_loader, word2id, id2word, vocab
 
 
-def load_vocab_and_datasets_for_testing(dataset_names, type, opt):
-    '''
-    Load additional datasets from disk
-    For now seven datasets are included: 'inspec', 'nus', 'semeval', 'krapivin', 'kp20k', 'duc', 'stackexchange'
-     Only 'kp20k', 'stackexchange' provide train/valid/test data.
-     The others have only train/test, and the train is mostly used for validation.
-    :param type:
-    :param opt:
-    :return:
-    '''
-    assert type == 'test' or type == 'valid'
-
-    logger.info("Loading vocab from disk: %s" % (opt.vocab_path))
-    word2id, id2word, vocab = torch.load(opt.vocab_path, 'rb')
-    logger.info('#(vocab)=%d' % len(vocab))
-
-    pin_memory = torch.cuda.is_available()
-    one2many_loaders = []
-
-    for dataset_name in dataset_names:
-        logger.info("Loading test dataset %s" % dataset_name)
-        if type == 'test':
-            dataset_path = os.path.join(opt.test_dataset_root_path, dataset_name, dataset_name + '.test.one2many.pt')
-        elif type == 'valid' and dataset_name in ['kp20k', 'stackexchange', 'twacg']:
-            dataset_path = os.path.join(opt.test_dataset_root_path, dataset_name, dataset_name + '.valid.one2many.pt')
-        elif type == 'valid' and dataset_name in ['inspec', 'nus', 'semeval', 'krapivin', 'duc']:
-            dataset_path = os.path.join(opt.test_dataset_root_path, dataset_name, dataset_name + '.train.one2many.pt')
-        else:
-            raise Exception('Unsupported dataset: %s, type=%s' % (dataset_name, type))
-
-        one2many_dataset = KeyphraseDataset(dataset_path,
-                                            word2id=word2id,
-                                            id2word=id2word,
-                                            type='one2many',
-                                            include_original=True,
-                                            lazy_load=True)
-        one2many_loader = KeyphraseDataLoader(dataset=one2many_dataset,
-                                              collate_fn=one2many_dataset.collate_fn_one2many,
-                                              num_workers=opt.batch_workers,
-                                              max_batch_example=opt.beam_search_batch_example,
-                                              max_batch_pair=opt.beam_search_batch_size,
-                                              pin_memory=pin_memory,
-                                              shuffle=False)
-
-        one2many_loaders.append(one2many_loader)
-
-        logger.info('#(%s data size:  #(one2many pair)=%d, #(one2one pair)=%d, #(batch)=%d' %
-                    (type, len(one2many_loader.dataset),
-                     one2many_loader.one2one_number(),
-                     len(one2many_loader)))
-        logger.info('*' * 50)
-
-    return one2many_loaders, word2id, id2word, vocab
-
-
 def init_optimizer_criterion(model, opt):
     """
     mask the PAD <pad> when computing loss, before we used weight matrix, but not handy for copy-model, change to ignore_index
@@ -852,6 +896,29 @@ def init_model(opt):
     return model
 
 
+def init_teacher(opt):
+    '''
+    Load the teacher of distillation from -teacher_model, its model options are the student's overridden by -teacher_opts
+    '''
+    parser = argparse.ArgumentParser()
+    config.preprocess_opts(parser)
+    config.model_opts(parser)
+    # argparse doesn't set the defaults of the options which are in the namespace already
+    teacher_opt = copy.copy(opt)
+    parser.parse_args(shlex.split(opt.teacher_opts), namespace=teacher_opt)
+    teacher_opt.vocab_size = min(teacher_opt.vocab_size, len(opt.vocab))
+    teacher_opt.train_from = opt.teacher_model
+
+    teacher = init_model(teacher_opt)
+    if torch.cuda.is_available():
+        teacher = teacher.cuda()
+    teacher.eval()
+    for p in teacher.parameters():
+        p.requires_grad = False
+
+    return teacher, teacher_opt
+
+
 def main():
     # load settings for training
     opt = init_opt(description='train.py')
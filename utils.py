@@ -2,6 +2,8 @@ from os.path import join, dirname
 import numpy as np
 import time
 import sys,logging
+from collections import Counter
+import torch
 import matplotlib
 matplotlib.use('agg')
 import matplotlib.pyplot as plt
@@ -197,6 +199,72 @@ class Progbar(object):
         self.seen_so_far = 0
 
 
+def is_oom_error(error):
+    '''
+    Whether the exception is an allocation failure, on GPU (including torch.cuda.OutOfMemoryError) or CPU
+    '''
+    message = str(error)
+    return isinstance(error, RuntimeError) and ('out of memory' in message or "can't allocate memory" in message)
+
+
+class OOMSplitStats(object):
+    '''
+    Record the batches split because of out-of-memory, the sizes that failed are the hints to tune the batch size/token budgets
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.num_split_batches = 0  # number of batches (at the top level) hit an OOM
+        self.num_splits = 0  # number of OOMs, each splits a piece into halves
+        self.max_depth = 0
+        self.failed_sizes = Counter()  # number of examples of the pieces that hit an OOM
+
+    def record(self, batch_size, depth):
+        if depth == 0:
+            self.num_split_batches += 1
+        self.num_splits += 1
+        self.max_depth = max(self.max_depth, depth + 1)
+        self.failed_sizes[batch_size] += 1
+
+    def as_dict(self):
+        return {'num_split_batches': self.num_split_batches, 'num_splits': self.num_splits, 'max_depth': self.max_depth,
+                'min_failed_size': min(self.failed_sizes) if self.failed_sizes else 0, 'failed_sizes': dict(self.failed_sizes)}
+
+    def log_summary(self, logger=None):
+        if self.num_splits == 0:
+            return
+        logger = logger if logger else logging.getLogger()
+        logger.info('[OOM splits][%s] %d batches split by %d OOMs, max depth=%d, failed piece sizes=%s' %
+                    (self.name, self.num_split_batches, self.num_splits, self.max_depth, str(sorted(self.failed_sizes.items()))))
+
+
+def split_on_oom(function, start, end, stats=None, depth=0):
+    '''
+    Run function(start, end) on the examples [start, end) of a batch. On out-of-memory, split the examples into halves and run
+        the pieces one after another, recursively until a single example, so no example of the batch is dropped.
+    function() must leave no side effect if it fails (e.g. drop the gradients of a failed backward), as the pieces are re-run.
+    :param stats: an OOMSplitStats to record the splits
+    :return: a list of the outputs of function() on the pieces, in the order of the examples
+    '''
+    try:
+        return [function(start, end)]
+    except RuntimeError as error:
+        if not is_oom_error(error) or end - start <= 1:
+            raise
+        logging.warning('Out of memory on a batch of %d examples, split it into halves' % (end - start))
+
+    # the exception (and the tensors referred in its traceback) is released out of the except block
+    if stats is not None:
+        stats.record(end - start, depth)
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+    middle = (start + end) // 2
+    return split_on_oom(function, start, middle, stats, depth + 1) + split_on_oom(function, middle, end, stats, depth + 1)
+
+
 def plot_learning_curve_and_write_csv(scores, curve_names, checkpoint_names, title, ylim=None, save_path=None):
     """
     Generate a simple plot of the test and training learning curve.